@@ -3,185 +3,1229 @@ import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 import re
+import csv
+import codecs
 import json
 import io
+import os
+import hashlib
+import threading
+import importlib.util
+import tempfile
+import contextvars
+import sqlite3
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+from collections import OrderedDict
+from itertools import chain, islice
 import numpy as np
+from openpyxl import load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
+import xlsxwriter
+
+from parsing import parse_duration, parse_progress, parse_number
+from profiling import StageProfiler, activate, bind, stage, staged
+from audit_store import AuditStore, MISSING_IDS
+from jobs import JobRunner
 
 # ==============================================================================
 # 1. 🌸 樱花粉主题 UI 配置 (保持高颜值)
 # ==============================================================================
-st.set_page_config(page_title="智慧评价审计系统 v15.0 Pro", layout="wide", initial_sidebar_state="expanded")
-
-st.markdown("""
-    <style>
-        /* --- 全局粉色基调 --- */
-        .stApp { background-color: #FFF0F5; font-family: 'Helvetica Neue', sans-serif; }
+def setup_page():
+    # 页面配置与样式放在函数内，使本模块可被脚本（基准/批处理）无界面导入
+    st.set_page_config(page_title="智慧评价审计系统 v15.0 Pro", layout="wide", initial_sidebar_state="expanded")
+
+    st.markdown("""
+        <style>
+            /* --- 全局粉色基调 --- */
+            .stApp { background-color: #FFF0F5; font-family: 'Helvetica Neue', sans-serif; }
         
-        /* --- 侧边栏深度定制 --- */
-        [data-testid="stSidebar"] {
-            background-image: linear-gradient(180deg, #FFE4E1 0%, #FFC0CB 100%);
-            border-right: 1px solid #FFB6C1;
-        }
-        [data-testid="stSidebar"] * { color: #8B0000 !important; }
-        [data-testid="stSidebar"] h1 { color: #C71585 !important; border-bottom: 2px solid #DB7093; padding-bottom: 15px; }
-        [data-testid="stSidebar"] .stRadio label { 
-            background: rgba(255,255,255,0.4) !important; padding: 10px; border-radius: 10px; margin-bottom: 5px; transition: 0.3s; 
-        }
-        [data-testid="stSidebar"] .stRadio label:hover { background: white !important; box-shadow: 0 2px 5px rgba(0,0,0,0.05); }
+            /* --- 侧边栏深度定制 --- */
+            [data-testid="stSidebar"] {
+                background-image: linear-gradient(180deg, #FFE4E1 0%, #FFC0CB 100%);
+                border-right: 1px solid #FFB6C1;
+            }
+            [data-testid="stSidebar"] * { color: #8B0000 !important; }
+            [data-testid="stSidebar"] h1 { color: #C71585 !important; border-bottom: 2px solid #DB7093; padding-bottom: 15px; }
+            [data-testid="stSidebar"] .stRadio label { 
+                background: rgba(255,255,255,0.4) !important; padding: 10px; border-radius: 10px; margin-bottom: 5px; transition: 0.3s; 
+            }
+            [data-testid="stSidebar"] .stRadio label:hover { background: white !important; box-shadow: 0 2px 5px rgba(0,0,0,0.05); }
 
-        /* --- 核心卡片容器 --- */
-        .main-card {
-            background: white; padding: 25px; border-radius: 20px;
-            box-shadow: 0 10px 25px rgba(255, 105, 180, 0.1); margin-bottom: 25px;
-            border: 2px solid #FFF; border-left: 6px solid #FF69B4; 
-        }
+            /* --- 核心卡片容器 --- */
+            .main-card {
+                background: white; padding: 25px; border-radius: 20px;
+                box-shadow: 0 10px 25px rgba(255, 105, 180, 0.1); margin-bottom: 25px;
+                border: 2px solid #FFF; border-left: 6px solid #FF69B4; 
+            }
         
-        /* --- 统计数字卡片 --- */
-        .stat-box {
-            background: white; padding: 20px; border-radius: 15px; text-align: center;
-            box-shadow: 0 4px 10px rgba(219, 112, 147, 0.1); border: 1px solid #FFE4E1; transition: transform 0.2s;
-        }
-        .stat-box:hover { transform: translateY(-5px); }
-        .stat-val { font-size: 32px; font-weight: 800; color: #C71585; }
-        .stat-label { font-size: 13px; color: #DB7093; font-weight: 700; margin-top: 5px; }
+            /* --- 统计数字卡片 --- */
+            .stat-box {
+                background: white; padding: 20px; border-radius: 15px; text-align: center;
+                box-shadow: 0 4px 10px rgba(219, 112, 147, 0.1); border: 1px solid #FFE4E1; transition: transform 0.2s;
+            }
+            .stat-box:hover { transform: translateY(-5px); }
+            .stat-val { font-size: 32px; font-weight: 800; color: #C71585; }
+            .stat-label { font-size: 13px; color: #DB7093; font-weight: 700; margin-top: 5px; }
         
-        /* --- 标签体系 --- */
-        .tag { display: inline-block; padding: 3px 10px; border-radius: 12px; font-size: 11px; font-weight: 700; margin-right: 5px; color: white; }
-        .tag-brush { background: linear-gradient(45deg, #FF6B6B, #FF8787); } 
-        .tag-skip { background: linear-gradient(45deg, #FCC419, #FFD43B); color: #856404; }  
-        .tag-silent { background: linear-gradient(45deg, #CC5DE8, #DA77F2); }
-        .tag-pass { background: linear-gradient(45deg, #51CF66, #69DB7C); } 
-        .tag-none { background: linear-gradient(45deg, #868E96, #ADB5BD); }
+            /* --- 标签体系 --- */
+            .tag { display: inline-block; padding: 3px 10px; border-radius: 12px; font-size: 11px; font-weight: 700; margin-right: 5px; color: white; }
+            .tag-brush { background: linear-gradient(45deg, #FF6B6B, #FF8787); } 
+            .tag-skip { background: linear-gradient(45deg, #FCC419, #FFD43B); color: #856404; }  
+            .tag-silent { background: linear-gradient(45deg, #CC5DE8, #DA77F2); }
+            .tag-pass { background: linear-gradient(45deg, #51CF66, #69DB7C); } 
+            .tag-none { background: linear-gradient(45deg, #868E96, #ADB5BD); }
         
-        /* --- 诊断卡片 --- */
-        .diagnosis-card {
-            background: white; padding: 30px; border-radius: 15px;
-            box-shadow: 0 5px 15px rgba(0,0,0,0.08); border-top: 8px solid #FF6B6B;
-        }
-    </style>
-""", unsafe_allow_html=True)
+            /* --- 诊断卡片 --- */
+            .diagnosis-card {
+                background: white; padding: 30px; border-radius: 15px;
+                box-shadow: 0 5px 15px rgba(0,0,0,0.08); border-top: 8px solid #FF6B6B;
+            }
+        </style>
+    """, unsafe_allow_html=True)
 
 # ==============================================================================
 # 2. 强力数据加载内核 (双平台兼容)
 # ==============================================================================
+# 解析缓存预算（可通过环境变量调整）：内存上限 MB，溢写目录为空则不落盘
+PARSE_CACHE_MAX_MB = float(os.environ.get('AUDIT_PARSE_CACHE_MB', 512))
+PARSE_CACHE_SPILL_DIR = os.environ.get('AUDIT_PARSE_CACHE_DIR', '')
+# 表头（含“姓名/学号”的锚点行）只在前若干行内查找
+ANCHOR_SCAN_ROWS = 20
+# CSV：编码与分隔符只看文件开头的这段字节；超过阈值的文件分块解析
+CSV_SNIFF_BYTES = 64 * 1024
+CSV_DELIMITERS = ',\t;|'
+CSV_CHUNK_MB = float(os.environ.get('AUDIT_CSV_CHUNK_MB', 64))
+CSV_CHUNK_ROWS = 100000
+# 活动日志（每行一次学习事件）：按块流式读取，只保留 学号/时间 两列
+ACTIVITY_CHUNK_ROWS = 200000
+ACTIVITY_MIN_EVENTS = 5  # 事件数少于此值的学生不做深夜占比判断
+# 表头模板：团队固定的解析方案存放在此 JSON 文件（设为空字符串则只在内存中缓存自动识别的方案）
+SCHEMA_PLANS_PATH = os.environ.get('AUDIT_SCHEMA_PLANS', 'schema_plans.json')
+PLAN_CACHE_MAX = 64  # 内存中保留的自动识别方案数
+
+
+class ParseCache:
+    """按“上传内容哈希 + 工作表”缓存解析结果，避免 Streamlit 每次重跑都重新解析。
+
+    内存中按 LRU 淘汰，总占用不超过 ``max_bytes``；若配置了 ``spill_dir`` 且
+    环境中有 pyarrow，被淘汰的表会写成本地 Parquet，下次命中时直接读回。
+    """
+
+    def __init__(self, max_bytes=PARSE_CACHE_MAX_MB * 1024 ** 2, spill_dir=None):
+        self.max_bytes = int(max_bytes)
+        self.spill_dir = spill_dir if (spill_dir and importlib.util.find_spec('pyarrow')) else None
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        self._entries = OrderedDict()  # key -> (df, nbytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(data, sheet=None):
+        digest = hashlib.sha256(data).hexdigest()
+        return f"{digest}:{sheet if sheet is not None else '*'}"
+
+    def get(self, key):
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is not None:
+                self._entries.move_to_end(key)
+                return hit[0].copy(deep=False)
+        path = self._spill_path(key)
+        if path and os.path.exists(path):
+            try:
+                df = pd.read_parquet(path)
+            except Exception:
+                return None
+            self.put(key, df)
+            return df.copy(deep=False)
+        return None
+
+    def put(self, key, df):
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (df, nbytes)
+            self._bytes += nbytes
+            # 超出预算时淘汰最久未用的条目（至少保留刚放入的这一份）
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, (old_df, old_bytes) = self._entries.popitem(last=False)
+                self._bytes -= old_bytes
+                evicted.append((old_key, old_df))
+        for old_key, old_df in evicted:
+            self._spill(old_key, old_df)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _spill_path(self, key):
+        if not self.spill_dir:
+            return None
+        return os.path.join(self.spill_dir, key.replace(':', '_').replace('*', 'auto') + '.parquet')
+
+    def _spill(self, key, df):
+        path = self._spill_path(key)
+        if not path or os.path.exists(path):
+            return
+        try:
+            df.to_parquet(path, index=False)
+        except Exception:
+            # 混合类型的对象列无法写 Parquet 时直接放弃溢写
+            if os.path.exists(path):
+                os.remove(path)
+
+
+@st.cache_resource
+def get_parse_cache():
+    # cache_resource 保证缓存实例跨重跑、跨会话共享
+    return ParseCache(spill_dir=PARSE_CACHE_SPILL_DIR or None)
+
+
+# 标准列 -> 列名关键词（按顺序取第一个包含任一关键词的列）
+FIELD_KEYWORDS = {
+    'name': ['姓名', '真实姓名', '学生姓名'],
+    'id': ['学号', '工号', 'UID'],
+    'prog': ['进度', '百分比', '完成度', '任务点'],
+    'time': ['时长', '观看时长', '耗时', '总耗时'],
+    'score': ['综合成绩', '最终成绩', '总分', '成绩', '得分'],
+    'discuss': ['讨论', '互动'],
+    'last_active': ['最后学习时间', '最近学习', '最后登录', '登录时间', '提交时间', '活跃时间', '时间戳', '最后访问', '最近访问', '最后活跃']
+}
+FIELD_LABELS = {'name': '姓名', 'id': '学号', 'prog': '进度', 'time': '时长', 'score': '成绩', 'discuss': '讨论', 'last_active': '最后活跃时间'}
+# 各标准列可选的解析器；DEFAULT_PARSERS 与未引入模板前的解析方式一致
+PARSERS = {
+    'progress': ('进度百分比', parse_progress),
+    'duration': ('时长（分钟）', parse_duration),
+    'numeric': ('纯数值', lambda s: pd.to_numeric(s, errors='coerce')),
+    'number': ('宽松数值（去单位，如 85分）', parse_number),
+    'datetime': ('日期时间', lambda s: pd.to_datetime(s, errors='coerce')),
+}
+DEFAULT_PARSERS = {'prog': 'progress', 'time': 'duration', 'score': 'numeric', 'discuss': 'numeric', 'last_active': 'datetime'}
+
+
+class ParsePlan:
+    """一种导出模板的解析方案，按表头签名识别：表头所在行、列映射、各标准列的解析器与章节布局。
+
+    同一模板的文件再次上传时直接套用，不再逐列匹配关键词；教师可在侧栏修改映射并固定为团队模板。
+    """
+
+    def __init__(self, signature, columns, mapping, parsers, chapters, anchor_row=None, pinned=False, label='',
+                 header_signature=None):
+        self.signature = signature
+        self.columns = list(columns)
+        self.mapping = dict(mapping)  # 标准列 -> 原始列名
+        self.parsers = dict(parsers)  # 标准列 -> PARSERS 中的解析器名
+        self.chapters = chapters      # ChapterSchema.detect_layout 的结果
+        self.anchor_row = anchor_row  # Excel 表头所在行（从 0 起）；CSV 为 None
+        # 主表表头行的签名：拼接附表后列比表头行多，加载时按这一签名在 anchor_row 处核对；未拼接时与 signature 相同
+        self.header_signature = header_signature or signature
+        self.pinned = pinned
+        self.label = label
+
+    @staticmethod
+    def signature_of(columns):
+        return hashlib.sha1('\x1f'.join(map(str, columns)).encode('utf-8')).hexdigest()[:16]
+
+    @classmethod
+    def detect(cls, columns, anchor_row=None, header_signature=None):
+        columns = [str(c) for c in columns]
+        return cls(cls.signature_of(columns), columns, AuditCore._map_columns(columns), DEFAULT_PARSERS,
+                   ChapterSchema.detect_layout(columns), anchor_row, label=f'{len(columns)} 列模板',
+                   header_signature=header_signature)
+
+    @property
+    def version(self):
+        """映射、解析器或章节布局任一变化都会得到新版本；用于区分同一文件在不同方案下的解析结果。"""
+        return data_version(sorted(self.mapping.items()), sorted(self.parsers.items()), list(self.chapters.items()))
+
+    def parser(self, field):
+        return PARSERS[self.parsers.get(field, DEFAULT_PARSERS[field])][1]
+
+    def to_dict(self):
+        return {'signature': self.signature, 'label': self.label, 'anchor_row': self.anchor_row,
+                'header_signature': self.header_signature, 'columns': self.columns,
+                'mapping': self.mapping, 'parsers': self.parsers, 'chapters': self.chapters}
+
+    @classmethod
+    def from_dict(cls, d, pinned=True):
+        return cls(d['signature'], d['columns'], d['mapping'], d.get('parsers', DEFAULT_PARSERS), d['chapters'],
+                   d.get('anchor_row'), pinned, d.get('label', ''), d.get('header_signature'))
+
+
+class PlanRegistry:
+    """表头签名 -> ParsePlan。
+
+    自动识别的方案只在内存中按 LRU 保留；固定的方案写入 ``path``（JSON），团队共用一个文件即可共享映射。
+    文件被他人修改后，下次查找时按修改时间自动重新读取。
+    """
+
+    def __init__(self, path=None, max_auto=PLAN_CACHE_MAX):
+        self.path = path or None
+        self.max_auto = max_auto
+        self._auto = OrderedDict()
+        self._pinned = {}
+        self._mtime = None
+        self._lock = threading.RLock()
+        self._reload()
+
+    def _reload(self):
+        if not self.path:
+            return
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, encoding='utf-8') as fh:
+                data = json.load(fh)
+            self._pinned = {d['signature']: ParsePlan.from_dict(d) for d in data.get('plans', [])}
+        except (OSError, ValueError, KeyError, TypeError):
+            pass  # 文件损坏或正在被替换时沿用已读入的方案，不影响审计
+        self._mtime = mtime
+
+    def _save(self):
+        if not self.path:
+            return
+        data = {'plans': [plan.to_dict() for plan in self._pinned.values()]}
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fh:
+            json.dump(data, fh, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)  # 整体替换，其他会话不会读到写了一半的文件
+        self._mtime = os.path.getmtime(self.path)
+
+    def get(self, signature):
+        with self._lock:
+            self._reload()
+            plan = self._pinned.get(signature) or self._auto.get(signature)
+            if plan is not None and not plan.pinned:
+                self._auto.move_to_end(signature)
+            return plan
+
+    def plan_for(self, columns, anchor_row=None, header_signature=None):
+        """表头对应的方案；未见过的表头按关键词识别一次后缓存。
+
+        ``columns`` 含拼接进来的附表列时，``header_signature`` 为主表表头行的签名，与 ``anchor_row`` 一起记在方案上。
+        """
+        columns = [str(c) for c in columns]
+        signature = ParsePlan.signature_of(columns)
+        with self._lock:
+            plan = self.get(signature)
+            if plan is None:
+                with stage('识别表头模板'):
+                    plan = ParsePlan.detect(columns, anchor_row, header_signature)
+                self._auto[signature] = plan
+                while len(self._auto) > self.max_auto:
+                    self._auto.popitem(last=False)
+            elif anchor_row is not None and not plan.pinned:
+                plan.anchor_row = anchor_row
+                plan.header_signature = header_signature or signature
+            return plan
+
+    def knows_header(self, header_signature):
+        """是否有方案以该签名的表头行开始（含拼接了附表的方案）。"""
+        with self._lock:
+            self._reload()
+            plans = list(self._pinned.values()) + list(self._auto.values())
+        return any(p.header_signature == header_signature for p in plans)
+
+    def anchor_rows(self):
+        """已知模板的表头行号，加载 Excel 时先检查这些行。"""
+        with self._lock:
+            self._reload()
+            plans = list(self._pinned.values()) + list(self._auto.values())
+        return sorted({p.anchor_row for p in plans if p.anchor_row is not None})
+
+    def pin(self, plan):
+        with self._lock:
+            self._reload()
+            plan.pinned = True
+            self._pinned[plan.signature] = plan
+            self._auto.pop(plan.signature, None)
+            self._save()
+
+    def unpin(self, signature):
+        with self._lock:
+            self._reload()
+            plan = self._pinned.pop(signature, None)
+            if plan is not None:
+                self._save()
+                self._auto[signature] = ParsePlan.detect(plan.columns, plan.anchor_row, plan.header_signature)  # 退回自动识别的映射
+
+    def pinned(self):
+        with self._lock:
+            self._reload()
+            return list(self._pinned.values())
+
+
+@st.cache_resource
+def get_plan_registry():
+    return PlanRegistry(SCHEMA_PLANS_PATH)
+
+
 class UniversalLoader:
     @staticmethod
-    def load_file(file):
+    def content_key(file, sheet=None):
+        """上传内容的哈希键（同时用作解析缓存与章节索引缓存的键）。"""
+        file.seek(0)
+        key = ParseCache.make_key(file.read(), sheet)
+        file.seek(0)
+        return key
+
+    @staticmethod
+    def load_file(file, cache=None, key=None, plans=None):
+        """解析上传文件；传入 ``cache`` 时，相同内容的重跑只需一次哈希查找。
+
+        传入 ``plans``（PlanRegistry）时，Excel 先按已知模板的表头行号核对表头签名，命中则跳过关键词查找。
+        """
+        with stage(f'加载:{file.name}') as rec:
+            if cache is not None:
+                key = key or UniversalLoader.content_key(file)
+                cached = cache.get(key)
+                if cached is not None:
+                    rec['阶段'] += ' (缓存命中)'
+                    rec['行数'] = len(cached)
+                    return cached, None
+            df, err = UniversalLoader._load_uncached(file, plans)
+            if cache is not None and err is None and df is not None:
+                cache.put(key, df)
+                df = df.copy(deep=False)
+            rec['行数'] = len(df) if df is not None else 0
+            return df, err
+
+    @staticmethod
+    def load_files(files, cache=None, max_workers=None, plans=None):
+        """并行解析多个上传文件，按上传顺序返回 [(file, key, df, err)]；已解析过的内容直接命中缓存。"""
+        def load_one(file):
+            key = UniversalLoader.content_key(file)
+            df, err = UniversalLoader.load_file(file, cache=cache, key=key, plans=plans)
+            return file, key, df, err
+        if len(files) <= 1:
+            return [load_one(f) for f in files]
+        with ThreadPoolExecutor(max_workers=max_workers or min(8, len(files))) as pool:
+            # 每个任务带上提交时的上下文，工作线程里的阶段计时才能记到当前运行
+            futures = [pool.submit(contextvars.copy_context().run, load_one, f) for f in files]
+            return [f.result() for f in futures]
+
+    @staticmethod
+    def _load_uncached(file, plans=None):
         try:
             if file.name.lower().endswith('.csv'):
-                for encoding in ['utf-8-sig', 'gb18030', 'gbk', 'utf-16']:
-                    try:
-                        file.seek(0)
-                        df = pd.read_csv(file, encoding=encoding)
-                        if len(df.columns) > 1: return UniversalLoader._sanitize(df)
-                    except: continue
-                return None, "CSV读取失败"
+                return UniversalLoader._load_csv(file)
             else:
-                xls = pd.ExcelFile(file)
-                target_sheet = xls.sheet_names[0]
-                for sheet in xls.sheet_names:
-                    if "进度" in sheet or "详情" in sheet:
-                        target_sheet = sheet
-                        break
-                
-                df_raw = pd.read_excel(xls, sheet_name=target_sheet, header=None, nrows=20)
-                anchor_idx = -1
-                for idx, row in df_raw.iterrows():
-                    row_str = " ".join([str(val) for val in row.values])
-                    if ('姓名' in row_str or '学号' in row_str) and \
-                       ('进度' in row_str or '时长' in row_str or '任务点' in row_str or \
-                        '耗时' in row_str or '成绩' in row_str or '分' in row_str):
-                        anchor_idx = idx
-                        break
-                
-                if anchor_idx == -1: return None, "未找到有效表头"
-                file.seek(0)
-                df = pd.read_excel(xls, sheet_name=target_sheet, header=anchor_idx)
-                return UniversalLoader._sanitize(df)
+                try:
+                    return UniversalLoader._load_excel_streaming(file, plans=plans)
+                except (InvalidFileException, zipfile.BadZipFile):
+                    # openpyxl 打不开的格式（如 .xls、非 zip 封装的文件）退回 pandas 双遍读取
+                    file.seek(0)
+                    return UniversalLoader._load_excel_two_pass(file, plans=plans)
         except Exception as e: return None, f"文件解析错误: {str(e)}"
 
+    @staticmethod
+    def sniff_csv(sample):
+        """由文件开头的字节样本判断 (编码, 分隔符)；无法识别编码时编码为 None。
+
+        先看 BOM，再按 utf-8 → gb18030（兼容 gbk）依次增量解码样本；样本末尾被截断的多字节字符不算错误。
+        """
+        if sample.startswith(codecs.BOM_UTF8):
+            encoding = 'utf-8-sig'
+        elif sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            encoding = 'utf-16'
+        elif len(sample) >= 4 and sample[1::2].count(0) > len(sample) // 4:
+            # 无 BOM 的 UTF-16：ASCII 字符的高位字节为 0
+            encoding = 'utf-16-le'
+        elif len(sample) >= 4 and sample[0::2].count(0) > len(sample) // 4:
+            encoding = 'utf-16-be'
+        else:
+            encoding = None
+            for candidate in ('utf-8', 'gb18030'):
+                try:
+                    codecs.getincrementaldecoder(candidate)().decode(sample, final=False)
+                    encoding = candidate
+                    break
+                except UnicodeDecodeError:
+                    continue
+        if encoding is None:
+            return None, ','
+        text = codecs.getincrementaldecoder(encoding)(errors='ignore').decode(sample, final=False)
+        lines = '\n'.join(text.splitlines()[:ANCHOR_SCAN_ROWS])
+        try:
+            delimiter = csv.Sniffer().sniff(lines, delimiters=CSV_DELIMITERS).delimiter
+        except csv.Error:
+            delimiter = ','
+        return encoding, delimiter
+
+    @staticmethod
+    def iter_csv_chunks(file, encoding, delimiter, chunk_rows=CSV_CHUNK_ROWS):
+        """按行分块解析 CSV，边读边解码，逐块清理后产出；整份解码文本不会同时留在内存里。"""
+        file.seek(0)
+        with pd.read_csv(file, encoding=encoding, sep=delimiter, chunksize=chunk_rows) as reader:
+            for chunk in reader:
+                yield UniversalLoader._sanitize(chunk)[0]
+
+    @staticmethod
+    def _load_csv(file, chunk_mb=CSV_CHUNK_MB):
+        """只读一次样本判断编码与分隔符，然后只解析一遍；大文件走分块解析。"""
+        file.seek(0)
+        sample = file.read(CSV_SNIFF_BYTES)
+        size = file.seek(0, 2)
+        encoding, delimiter = UniversalLoader.sniff_csv(sample)
+        if encoding is None:
+            return None, "CSV读取失败：无法识别文件编码"
+
+        def parse(enc):
+            if size > chunk_mb * 1024 ** 2:
+                return pd.concat(UniversalLoader.iter_csv_chunks(file, enc, delimiter), ignore_index=True)
+            file.seek(0)
+            return pd.read_csv(file, encoding=enc, sep=delimiter)
+        try:
+            df = parse(encoding)
+        except UnicodeDecodeError:
+            # 样本之后才出现非 UTF-8 字节时，按 gb18030 再解析一次
+            if encoding != 'utf-8':
+                raise
+            df = parse('gb18030')
+        if len(df.columns) <= 1:
+            return None, "CSV读取失败：未识别出多列数据"
+        return UniversalLoader._sanitize(df)
+
+    @staticmethod
+    def _pick_sheet(sheet_names):
+        for sheet in sheet_names:
+            if "进度" in sheet or "详情" in sheet:
+                return sheet
+        return sheet_names[0]
+
+    @staticmethod
+    def _is_anchor_row(values):
+        row_str = " ".join([str(val) for val in values])
+        return ('姓名' in row_str or '学号' in row_str) and \
+               ('进度' in row_str or '时长' in row_str or '任务点' in row_str or \
+                '耗时' in row_str or '成绩' in row_str or '分' in row_str)
+
+    @staticmethod
+    def _find_anchor(rows, plans=None):
+        """在表头扫描范围内的行中定位表头，返回行号（找不到为 -1）。
+
+        先核对已知模板记录的表头行：签名一致即命中，列名不含关键词的固定模板也能识别；否则按关键词查找，
+        找到后把表头行号记入方案，下次同一模板直接命中。
+        """
+        if plans is not None:
+            for i in plans.anchor_rows():
+                if i < len(rows) and plans.knows_header(ParsePlan.signature_of(UniversalLoader._column_names(rows[i]))):
+                    return i
+        for i, row in enumerate(rows):
+            if UniversalLoader._is_anchor_row(row):
+                if plans is not None:
+                    plans.plan_for(UniversalLoader._column_names(row), anchor_row=i)
+                return i
+        return -1
+
+    @staticmethod
+    def _column_names(header):
+        """表头行解析后的列名（与 _sanitize 之后的 DataFrame 列名一致，末尾的空表头不计）。"""
+        header = list(header)
+        while header and UniversalLoader._blank_cell(header[-1]):
+            header.pop()
+        return [name.strip().replace('\n', '') for name in UniversalLoader._header_names(header)]
+
+    @staticmethod
+    def _blank_cell(val):
+        """pandas 读表时按空处理的单元格：空单元格、NaN 或空字符串。"""
+        return val is None or (isinstance(val, str) and val == '') or (isinstance(val, float) and np.isnan(val))
+
+    @staticmethod
+    def _header_names(header):
+        # 与 pd.read_excel 一致：空表头记为 Unnamed: i，重复列名追加 .1/.2 后缀
+        names, seen = [], {}
+        for j, val in enumerate(header):
+            name = f"Unnamed: {j}" if val is None or pd.isna(val) or str(val).strip() == '' else str(val)
+            base = name
+            while name in seen:
+                seen[base] += 1
+                name = f"{base}.{seen[base]}"
+            seen[name] = 0
+            names.append(name)
+        return names
+
+    @staticmethod
+    def _find_key_row(rows):
+        """附表的表头：含姓名或学号列，且至少还有一个可映射的标准列（如 成绩、讨论）。"""
+        for i, row in enumerate(rows):
+            mapping = AuditCore._map_columns([str(v) for v in row if v is not None])
+            if ('name' in mapping or 'id' in mapping) and set(mapping) - {'name', 'id'}:
+                return i
+        return -1
+
+    @staticmethod
+    def _read_rows(header, rows, chunk_rows=4096):
+        """表头之后的数据行按块转置写入列缓冲，返回清理后的 DataFrame。"""
+        names = UniversalLoader._header_names(header)
+        width = len(names)
+        buffers = [[] for _ in range(width)]
+        while True:
+            chunk = list(islice(rows, chunk_rows))
+            if not chunk:
+                break
+            # 只读模式下个别行可能短于表头，补齐后按列转置写入缓冲
+            chunk = [r if len(r) == width else (tuple(r) + (None,) * width)[:width] for r in chunk]
+            for buf, col in zip(buffers, zip(*chunk)):
+                buf.extend(col)
+        # 与 pandas 一致：末尾既无表头也无取值（空单元格或空字符串）的列不保留，
+        # 否则设置过格式的空白列会变成 Unnamed 列，再被当成多出来的章节
+        blank = UniversalLoader._blank_cell
+        while width and blank(header[width - 1]) and all(blank(v) for v in buffers[width - 1]):
+            width -= 1
+            names.pop(), buffers.pop()
+        df = pd.DataFrame({name: buf for name, buf in zip(names, buffers)}, columns=names)
+        return UniversalLoader._sanitize(df)[0]
+
+    @staticmethod
+    def _load_excel_streaming(file, chunk_rows=4096, plans=None):
+        """单遍读取：工作簿只打开一次，各工作表只读模式逐行扫描，定位表头后继续把数据行写入列缓冲。
+
+        主表按 ``_pick_sheet`` 选取（没有表头时依次尝试其余工作表）；其余工作表中含学号/姓名的附表
+        （例如成绩、讨论分表）与主表并行读出，再按学号（两边都有时）或姓名拼到主表右侧。
+        """
+        file.seek(0)
+        wb = load_workbook(file, read_only=True, data_only=True)
+        try:
+            picked = UniversalLoader._pick_sheet(wb.sheetnames)
+            sheets = []  # (工作表名, 表头行, 剩余行)，第一项为主表
+            for name in [picked] + [n for n in wb.sheetnames if n != picked]:
+                rows = wb[name].iter_rows(values_only=True)
+                head = list(islice(rows, ANCHOR_SCAN_ROWS))
+                anchor = UniversalLoader._find_anchor(head, plans) if not sheets else UniversalLoader._find_key_row(head)
+                if anchor == -1:
+                    continue
+                if not sheets:
+                    main_anchor = anchor
+                    main_names = UniversalLoader._column_names(head[anchor])
+                    main_map, taken = AuditCore._map_columns(main_names), set(main_names)
+                else:
+                    # 按扫描到的表头先判断附表能否连接、有没有新列，不能贡献列的附表不整表读出
+                    names = UniversalLoader._column_names(head[anchor])
+                    mapping = AuditCore._map_columns(names)
+                    extra = [c for c in names if c not in taken]
+                    if not extra or not any(f in main_map and f in mapping for f in ('id', 'name')):
+                        continue
+                    taken.update(extra)
+                # 扫描范围内表头之后的行已是数据
+                sheets.append((name, head[anchor], chain(head[anchor + 1:], rows)))
+            if not sheets: return None, "未找到有效表头"
+
+            def read(name, header, rows):
+                with stage(f'工作表:{name}') as rec:
+                    df = UniversalLoader._read_rows(header, rows, chunk_rows)
+                    rec['行数'] = len(df)
+                    return name, df
+            if len(sheets) == 1:
+                frames = [read(*sheets[0])]
+            else:
+                # 各表共用同一个已解析的工作簿（共享字符串、样式只读一次），每个任务带上当前上下文以记录阶段耗时
+                with ThreadPoolExecutor(max_workers=min(4, len(sheets))) as pool:
+                    futures = [pool.submit(contextvars.copy_context().run, read, *sheet) for sheet in sheets]
+                    frames = [f.result() for f in futures]
+        finally:
+            wb.close()
+        df = UniversalLoader._join_sheets(frames[0][1], frames[1:])
+        if plans is not None and list(df.columns) != main_names:
+            # 读出的列与主表表头不同（拼接了附表，或末尾空表头列下有取值）：方案按读出的列记录，同时记下主表表头行号与签名，固定模板后仍能按表头行命中
+            plans.plan_for(df.columns, anchor_row=main_anchor, header_signature=ParsePlan.signature_of(main_names))
+        return df, None
+
+    @staticmethod
+    def _join_key(series):
+        """连接键：统一成去空白的字符串（学号在不同表里可能分别是数字和文本）。"""
+        if pd.api.types.is_float_dtype(series) and (series.dropna() % 1 == 0).all():
+            series = series.astype('Int64')
+        return series.astype('string').str.strip().str.replace(r'\.0$', '', regex=True)
+
+    @staticmethod
+    def _join_sheets(base, others):
+        """把附表按学号（两边都有时）或姓名左连接到主表，行数与行序保持主表不变。
+
+        附表中重复的学号只取第一行；按姓名连接时任一边有重名就无法确定对应关系，该附表不拼接。
+        与已有列重名的列不再加入（主表或先读到的附表优先），因此附表只补充主表缺少的列，例如主表没有的成绩或讨论数。
+        各附表的拼接情况记在结果的 ``attrs['sheet_joins']``：[(工作表名, 连接键, 加入列数, 未拼接原因)]。
+        """
+        if not others:
+            return base
+        base_map = AuditCore._map_columns(base.columns)
+        parts, joins = [base], []
+        taken = set(base.columns)
+        for sheet, df in others:
+            mapping = AuditCore._map_columns(df.columns)
+            field = next((f for f in ('id', 'name') if f in base_map and f in mapping), None)
+            extra = [c for c in df.columns if c not in taken]
+            if field is None or not extra:
+                continue
+            left, right_key = UniversalLoader._join_key(base[base_map[field]]), UniversalLoader._join_key(df[mapping[field]])
+            if field == 'name':
+                dup = [side for side, key in (('主表', left), ('附表', right_key)) if key.dropna().duplicated().any()]
+                if dup:
+                    joins.append((sheet, FIELD_LABELS[field], 0, f"{'与'.join(dup)}有重名，无法按姓名对应"))
+                    continue
+            right = df[extra].set_axis(pd.Index(right_key), axis=0)
+            right = right[right.index.notna() & ~right.index.duplicated()]
+            joined = right.reindex(left.to_numpy())
+            joined.index = base.index
+            taken.update(extra)
+            parts.append(joined)
+            joins.append((sheet, FIELD_LABELS[field], len(extra), ''))
+        out = pd.concat(parts, axis=1) if len(parts) > 1 else base.copy(deep=False)
+        out.attrs['sheet_joins'] = joins
+        return out
+
+    @staticmethod
+    def _load_excel_two_pass(file, plans=None):
+        """旧版路径：先读前 20 行找表头，再按表头行整表重读（保留作回退与基准对照）。"""
+        xls = pd.ExcelFile(file)
+        target_sheet = UniversalLoader._pick_sheet(xls.sheet_names)
+
+        df_raw = pd.read_excel(xls, sheet_name=target_sheet, header=None, nrows=ANCHOR_SCAN_ROWS)
+        anchor_idx = UniversalLoader._find_anchor([row.values for _, row in df_raw.iterrows()], plans)
+
+        if anchor_idx == -1: return None, "未找到有效表头"
+        file.seek(0)
+        df = pd.read_excel(xls, sheet_name=target_sheet, header=anchor_idx)
+        return UniversalLoader._sanitize(df)
+
     @staticmethod
     def _sanitize(df):
         df = df.dropna(how='all', axis=0)
         df.columns = [str(c).strip().replace('\n', '') for c in df.columns]
         return df, None
 
+def class_labels(names):
+    """由文件名得到班级名（去掉目录与扩展名），重名时依次追加 (2)、(3)…"""
+    labels, seen = [], {}
+    for name in names:
+        base = os.path.splitext(os.path.basename(name))[0]
+        seen[base] = seen.get(base, 0) + 1
+        labels.append(base if seen[base] == 1 else f"{base} ({seen[base]})")
+    return labels
+
+
+
+class ActivityProfile:
+    """活动日志的聚合结果：每个学号一张 星期×小时 事件计数（7×24），大小只与学生数有关。"""
+
+    def __init__(self, key, ids, counts, events, skipped):
+        self.key = key
+        self.ids = pd.Index(ids)
+        self.counts = counts      # (学生数, 7, 24)，星期一为 0
+        self.events = events      # 计入的事件数
+        self.skipped = skipped    # 缺学号或时间无法解析而跳过的行数
+
+    def positions(self, student_ids):
+        """审计表各行在日志中的位置，日志中没有的学生为 -1。"""
+        return self.ids.get_indexer(pd.Index(as_text(pd.Series(student_ids)).str.strip().to_numpy(dtype=object)))
+
+    def matrix(self, student_ids):
+        """所给学生的 星期×小时 事件数合计。"""
+        pos = self.positions(student_ids)
+        return self.counts[pos[pos >= 0]].sum(axis=0, dtype=np.int64)
+
+    def night_share(self, student_ids, night_window):
+        """返回 (深夜事件占比 %, 事件数)，按审计表行序；没有事件的学生占比为 NaN。"""
+        hours = AuditCore.night_mask(np.arange(24), night_window)
+        total = self.counts.sum(axis=(1, 2), dtype=np.int64)
+        night = self.counts[:, :, hours].sum(axis=(1, 2), dtype=np.int64)
+        pos = self.positions(student_ids)
+        found = pos >= 0
+        events = np.where(found, total[pos], 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            share = np.where(found & (events > 0), night[pos] / events * 100, np.nan)
+        return share, events
+
+    def night_mask(self, student_ids, night_window, min_share):
+        share, events = self.night_share(student_ids, night_window)
+        return (events >= ACTIVITY_MIN_EVENTS) & (np.nan_to_num(share) >= min_share)
+
+
+class ActivityLog:
+    """活动日志的流式导入：逐块读取 学号/时间 两列，按学号累加 星期×小时 计数。
+
+    计数用 np.bincount 累加到按学号增长的数组里，内存只与学生数有关，与日志行数无关。
+    """
+
+    ID_KEYS = ('学号', '学生ID', '用户ID', '账号')
+    TIME_KEYS = ('时间', '日期', 'time', 'Time')
+
+    @staticmethod
+    def find_columns(columns):
+        """返回 (学号列, 时间列)，找不到时对应项为 None。"""
+        names = [str(c).strip() for c in columns]
+        id_col = next((c for c in names if any(k in c for k in ActivityLog.ID_KEYS)), None)
+        time_col = next((c for c in names if c != id_col and any(k in c for k in ActivityLog.TIME_KEYS)), None)
+        return id_col, time_col
+
+    @staticmethod
+    def content_key(file, block=1 << 20):
+        """分块计算内容哈希，避免为大日志再复制一份字节。"""
+        digest = hashlib.sha256()
+        file.seek(0)
+        for piece in iter(lambda: file.read(block), b''):
+            digest.update(piece)
+        file.seek(0)
+        return digest.hexdigest()
+
+    @staticmethod
+    def iter_chunks(file, chunk_rows=ACTIVITY_CHUNK_ROWS, encoding=None):
+        """逐块产出只含 学号、时间 两列的表；CSV 与 xlsx 都不会整表读入内存。"""
+        file.seek(0)
+        if file.name.lower().endswith('.csv'):
+            sniffed, delimiter = UniversalLoader.sniff_csv(file.read(CSV_SNIFF_BYTES))
+            encoding = encoding or sniffed
+            if encoding is None:
+                raise ValueError('无法识别文件编码')
+            file.seek(0)
+            header = pd.read_csv(file, encoding=encoding, sep=delimiter, nrows=0).columns
+            id_col, time_col = ActivityLog.find_columns(header)
+            if id_col is None or time_col is None:
+                raise ValueError('日志中未找到【学号】与【时间】列')
+            file.seek(0)
+            cols = [c for c in header if str(c).strip() in (id_col, time_col)]
+            with pd.read_csv(file, encoding=encoding, sep=delimiter, usecols=cols, dtype=str,
+                             chunksize=chunk_rows) as reader:
+                for chunk in reader:
+                    chunk.columns = [str(c).strip() for c in chunk.columns]
+                    yield chunk[[id_col, time_col]].set_axis(['学号', '时间'], axis=1)
+            return
+        wb = load_workbook(file, read_only=True, data_only=True)
+        try:
+            ws = wb[wb.sheetnames[0]]
+            rows = ws.iter_rows(values_only=True)
+            for _, row in zip(range(ANCHOR_SCAN_ROWS), rows):
+                id_col, time_col = ActivityLog.find_columns(['' if v is None else v for v in row])
+                if id_col is not None and time_col is not None:
+                    names = [str(v).strip() if v is not None else '' for v in row]
+                    i, j = names.index(id_col), names.index(time_col)
+                    break
+            else:
+                raise ValueError('日志中未找到【学号】与【时间】列')
+            while True:
+                chunk = list(islice(rows, chunk_rows))
+                if not chunk:
+                    break
+                yield pd.DataFrame({'学号': [r[i] if len(r) > i else None for r in chunk],
+                                    '时间': [r[j] if len(r) > j else None for r in chunk]})
+        finally:
+            wb.close()
+
+    @staticmethod
+    def ingest(file, key=None, chunk_rows=ACTIVITY_CHUNK_ROWS):
+        """流式聚合整个日志，返回 (ActivityProfile, 错误信息)。"""
+        with stage(f'活动日志:{file.name}') as rec:
+            try:
+                try:
+                    profile = ActivityLog._accumulate(ActivityLog.iter_chunks(file, chunk_rows))
+                except UnicodeDecodeError:
+                    # 样本之后才出现非 UTF-8 字节时，按 gb18030 从头再读一遍
+                    profile = ActivityLog._accumulate(ActivityLog.iter_chunks(file, chunk_rows, 'gb18030'))
+            except Exception as e:
+                return None, f"活动日志解析错误: {e}"
+            profile.key = key
+            rec['行数'] = profile.events + profile.skipped
+        if profile.events == 0:
+            return None, "活动日志中没有可识别的 学号/时间 记录"
+        return profile, None
+
+    @staticmethod
+    def _accumulate(chunks):
+        index = {}
+        flat = np.zeros(0, dtype=np.uint32)  # 学生数 × 168 的计数，按需成倍扩容
+        events = skipped = 0
+        for chunk in chunks:
+            sid = as_text(chunk['学号']).str.strip()
+            ts = pd.to_datetime(chunk['时间'], errors='coerce')
+            ok = (sid.notna() & (sid != '') & ts.notna()).to_numpy()
+            skipped += int((~ok).sum())
+            if not ok.any():
+                continue
+            codes, uniques = pd.factorize(sid[ok].to_numpy(dtype=object))
+            slots = np.fromiter((index.setdefault(u, len(index)) for u in uniques), dtype=np.int64, count=len(uniques))
+            ts = ts[ok]
+            cells = slots[codes] * 168 + ts.dt.dayofweek.to_numpy() * 24 + ts.dt.hour.to_numpy()
+            if len(index) * 168 > flat.size:
+                grown = np.zeros(max(len(index), flat.size // 168 * 2) * 168, dtype=np.uint32)
+                grown[:flat.size] = flat
+                flat = grown
+            if flat.size <= 8 * len(cells):
+                flat += np.bincount(cells, minlength=flat.size).astype(np.uint32)
+            else:
+                # 学生很多、本块事件较少时只累加出现过的格子，避免每块分配整张计数表
+                cell, count = np.unique(cells, return_counts=True)
+                flat[cell] += count.astype(np.uint32)
+            events += len(cells)
+        counts = flat[:len(index) * 168].reshape(len(index), 7, 24)
+        return ActivityProfile(None, list(index), counts, events, skipped)
+
+
+@st.cache_resource(max_entries=4)
+def get_activity_profile(log_key, _file):
+    return ActivityLog.ingest(_file, log_key)
+
 # ==============================================================================
 # 3. AI 审计核心 (集成聚类逻辑)
 # ==============================================================================
+def _fmt(fmt, values):
+    """对一列数值批量套用 % 格式，返回 object 字符串数组，便于与文本片段拼接。
+
+    实际数据中取值高度重复，只格式化去重后的值再按下标广播回去。
+    """
+    uniq, inv = np.unique(values, return_inverse=True)
+    return np.char.mod(fmt, uniq).astype(object)[inv.reshape(-1)]
+
+
+# 审计规则表：每条规则对整列求布尔掩码，按顺序求值。
+# - group 相同的规则构成 if/elif 链，组内先命中者生效；
+# - reason 为空的规则只贴标签，若该生没有任何带原因的规则命中，则整体视为正常。
+# 规则函数的参数 c 为列数组字典：p=进度, t=时长, score=成绩, discuss=讨论, avg=班级平均时长。
+AUDIT_RULES = {
+    'LMS': [
+        # 秒刷：进度 >90% 但时长低于 15 分钟或班级平均的 15%
+        {'tag': '🚨AI:秒刷', 'group': 'speed',
+         'when': lambda c: (c['p'] > 90) & ((c['t'] < 15) | (c['t'] < c['avg'] * 0.15)),
+         'reason': lambda c, i: '进度' + _fmt('%.0f', c['p'][i]) + '%，但时长仅' + _fmt('%.1f', c['t'][i])
+                                + '分(班级平均' + _fmt('%.0f', c['avg'][i]) + '分)，极速完成'},
+        # 时长存疑：进度 >80% 但时长不足班级平均的 40%
+        {'tag': '🟡时长存疑', 'group': 'speed',
+         'when': lambda c: (c['p'] > 80) & (c['t'] < c['avg'] * 0.4),
+         'reason': lambda c, i: '进度' + _fmt('%.0f', c['p'][i]) + '%但时长' + _fmt('%.1f', c['t'][i]) + '分，严重不成正比'},
+        {'tag': '🟣零互动',
+         'when': lambda c: (c['p'] > 50) & (c['discuss'] == 0)},
+        {'tag': '🐌无效刷课',
+         'when': lambda c: (c['p'] > 90) & (c['score'] < 40) & (c['score'] > 0),
+         'reason': lambda c, i: '进度满但成绩极低(' + _fmt('%s', c['score'][i]) + '分)'},
+    ],
+    'HG': [
+        {'tag': '🌑未开始', 'group': 'hg',
+         'when': lambda c: (c['score'] == 0) & (c['t'] < 1),
+         'reason': lambda c, i: np.full(len(i), '未开始实训', dtype=object)},
+        {'tag': '🚨代码拷贝', 'group': 'hg',
+         'when': lambda c: (c['score'] >= 90) & (c['t'] < 15),
+         'reason': lambda c, i: '高分(' + _fmt('%s', c['score'][i]) + '分)但耗时极短'},
+        {'tag': '⚡极速完成', 'group': 'hg',
+         'when': lambda c: (c['score'] >= 60) & (c['t'] < 5)},
+    ],
+}
+
+
+# 证据链标签登记表：位序固定，同时决定标签的展示顺序（与各环节追加顺序一致）
+TAG_REGISTRY = [
+    '🚨AI:秒刷', '🟡时长存疑', '🟣零互动', '🐌无效刷课',   # 学习通规则
+    '🌑未开始', '🚨代码拷贝', '⚡极速完成',                 # 头歌规则
+    '🌙深夜学习', '⚠️未完结', '🟠参与度低', '🚨高效可疑',   # 附加检测
+]
+TAG_BITS = {tag: 1 << k for k, tag in enumerate(TAG_REGISTRY)}
+TAG_DTYPE = np.uint16  # 登记表超过 16 个标签时需加宽
+NORMAL_TAG = "🟢正常"
+# 附加标签的固定原因文本；规则标签的原因由 AUDIT_RULES 的模板按指标列现算
+TAG_REASONS = {'🌙深夜学习': '深夜活跃', '⚠️未完结': '未完结', '🟠参与度低': '参与度低', '🚨高效可疑': '高效异常'}
+_RULE_REASONS = {r['tag']: r['reason'] for rules in AUDIT_RULES.values() for r in rules if 'reason' in r}
+# 只有命中“带原因”的标签才算异常（零互动、极速完成单独出现时不报）
+REASON_BITS = sum(TAG_BITS[t] for t in TAG_REGISTRY if t in _RULE_REASONS or t in TAG_REASONS)
+
+
+class TagCodec:
+    """``标签码`` 位掩码列的编解码：标签计数、筛选、文本列与异常原因都由位运算得到。"""
+
+    @staticmethod
+    def tags_of(code):
+        tags = [t for t in TAG_REGISTRY if int(code) & TAG_BITS[t]]
+        return tags or [NORMAL_TAG]
+
+    @staticmethod
+    def has(codes, tag):
+        return (np.asarray(codes) & TAG_BITS[tag]) != 0
+
+    @staticmethod
+    def at_risk(codes):
+        """计入预警人数的行：不计“参与度低”与“高效可疑”（看板与历史存档共用）。"""
+        return (np.asarray(codes) & ~TAG_DTYPE(TAG_BITS['🟠参与度低'] | TAG_BITS['🚨高效可疑'])) != 0
+
+    @staticmethod
+    def _decode(codes, fn):
+        # 不同的标签组合很少：每种组合解码一次，再按下标广播
+        uniq, inv = np.unique(np.asarray(codes), return_inverse=True)
+        return np.array([fn(int(u)) for u in uniq], dtype=object)[inv.reshape(-1)]
+
+    @staticmethod
+    def to_text(codes, sep=','):
+        return TagCodec._decode(codes, lambda u: sep.join(TagCodec.tags_of(u)))
+
+    @staticmethod
+    def primary(codes):
+        return TagCodec._decode(codes, lambda u: TagCodec.tags_of(u)[0])
+
+    @staticmethod
+    def counts(codes, include_normal=False):
+        codes = np.asarray(codes)
+        counts = pd.Series({t: int(((codes & TAG_BITS[t]) != 0).sum()) for t in TAG_REGISTRY})
+        counts = counts[counts > 0].sort_values(ascending=False)
+        if include_normal or counts.empty:
+            n_normal = int((codes == 0).sum())
+            if n_normal or counts.empty:
+                counts[NORMAL_TAG] = n_normal
+        return counts
+
+    @staticmethod
+    def reasons(df, rows=None):
+        """由位掩码与指标列按需生成“异常原因”文本；``rows`` 为行掩码时只生成这些行。"""
+        def col(name, dtype=None):
+            values = df[name].to_numpy(dtype=dtype)
+            return values if rows is None else values[rows]
+        codes = col('标签码')
+        n = len(codes)
+        c = {
+            'p': col('进度', float),
+            't': col('时长', float),
+            'score': col('成绩'),
+            'discuss': col('讨论'),
+            'avg': col('基准时长', float) if '基准时长' in df.columns else np.full(n, 60.0),
+        }
+        out = np.full(n, '', dtype=object)
+        for tag in TAG_REGISTRY:
+            mask = (codes & TAG_BITS[tag]) != 0
+            if not mask.any() or not (tag in _RULE_REASONS or tag in TAG_REASONS):
+                continue
+            idx = np.flatnonzero(mask)
+            frag = _RULE_REASONS[tag](c, idx) if tag in _RULE_REASONS else TAG_REASONS[tag]
+            cur = out[idx]
+            out[idx] = np.where(cur == '', frag, cur + ' | ' + frag)
+        out[out == ''] = '符合常态'
+        return out
+
+    @staticmethod
+    def refresh(df):
+        codes = df['标签码'].to_numpy()
+        df['状态'] = pd.Categorical.from_codes((codes != 0).astype(np.int8), categories=['正常', '异常'])
+        df['主标签'] = pd.Categorical(TagCodec.primary(codes))
+
+    @staticmethod
+    def add(df, mask, tag, refresh=True):
+        """为 mask（布尔掩码或行号数组）命中的行追加标签；``refresh`` 为假时由调用方最后统一同步 状态/主标签。"""
+        mask = np.asarray(mask)
+        if not np.issubdtype(mask.dtype, np.integer):
+            mask = mask.astype(bool)
+        if not mask.size or (mask.dtype == bool and not mask.any()):
+            return
+        codes = df['标签码'].to_numpy().copy()
+        codes[mask] |= TAG_DTYPE(TAG_BITS[tag])
+        df['标签码'] = codes
+        if refresh:
+            TagCodec.refresh(df)
+
+    @staticmethod
+    def export_view(df, rows=None, drop=()):
+        """导出/展示用视图：把位掩码还原为“证据链”文本与“异常原因”，去掉内部列与 ``drop`` 中的列。
+
+        先按列取子集（与原表共享数据），``rows`` 为行掩码时最后只对留下的列筛一次行，不复制整表。
+        """
+        keep = [c for c in df.columns if c not in ('标签码', '基准时长') and c not in drop]
+        out = df[keep] if rows is None else df.loc[rows, keep]
+        if '标签码' in df.columns:
+            codes = df['标签码'].to_numpy()
+            pos = sum(1 for c in df.columns[:df.columns.get_loc('标签码')] if c in keep)
+            if '证据链' not in drop:
+                out.insert(pos, '证据链', TagCodec.to_text(codes if rows is None else codes[rows]))
+                pos += 1
+            if '异常原因' not in drop:
+                out.insert(pos, '异常原因', TagCodec.reasons(df, rows))
+        return out
+
+# 四象限群体名及其配色（散点图沿用）
+QUADRANT_COLORS = {
+    "🌟 领跑集团 (双高)": "#10B981",
+    "🚀 效率/刷课组 (低时高产)": "#FF6B6B",
+    "🐢 努力困境组 (高时低产)": "#F59E0B",
+    "💤 待激活组 (双低)": "#ADB5BD",
+}
+# 超过该人数时 K-Means 改用小批量更新
+KMEANS_MINIBATCH_ROWS = 50000
+KMEANS_BATCH_SIZE = 4096
+
+# 审计结果的列类型：取值重复的文本列用分类，分数类派生指标用 float32，姓名/学号用 Arrow 字符串。
+# 进度/时长/成绩/讨论 参与规则阈值比较（如 进度 < 99.9），保持 float64 以免结果随精度变化。
+try:
+    TEXT_DTYPE = pd.StringDtype('pyarrow', na_value=np.nan) if importlib.util.find_spec('pyarrow') else object
+except TypeError:  # pandas < 2.3 的 StringDtype 不支持 na_value
+    TEXT_DTYPE = object
+SCORE_DTYPE = np.float32
+RESULT_SCHEMA = {
+    '姓名': TEXT_DTYPE, '学号': TEXT_DTYPE, '班级': 'category',
+    '最后活跃小时': np.int8,
+    '基准时长': SCORE_DTYPE, '综合得分': SCORE_DTYPE, '综合百分位': SCORE_DTYPE, '参与度': SCORE_DTYPE, '深夜占比': SCORE_DTYPE,
+    '状态': 'category', '主标签': 'category', '学习群体': 'category', '综合分组': 'category', '进度区间': 'category',
+}
+
+
+def as_text(series):
+    """学号等标识列转文本；整数值的浮点列（CSV 中带空值的学号）先去掉 “.0”。"""
+    if pd.api.types.is_float_dtype(series) and (series.dropna() % 1 == 0).all():
+        series = series.astype('Int64')
+    return series.astype(TEXT_DTYPE) if TEXT_DTYPE is not object else series.astype(str).where(series.notna())
+
+
+def compact_result(df):
+    """按 RESULT_SCHEMA 收紧列类型，返回新表（未变的列与原表共享数据）。"""
+    todo = {}
+    for col, dtype in RESULT_SCHEMA.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        if dtype == 'category' and isinstance(df[col].dtype, pd.CategoricalDtype):
+            continue
+        todo[col] = dtype
+    if not todo:
+        return df
+    df = df.copy(deep=False)
+    for col, dtype in todo.items():
+        df[col] = as_text(df[col]) if dtype is TEXT_DTYPE else df[col].astype(dtype)
+    return df
+
 class AuditCore:
-    def __init__(self, df):
+    def __init__(self, df, plans=None):
+        """``plans`` 为 PlanRegistry 时按表头签名套用（或识别并缓存）解析方案，否则每次按关键词识别。"""
         self.df = df
-        self.cols = self._map_columns()
+        with stage('列映射') as rec:
+            if plans is not None:
+                self.plan = plans.plan_for(df.columns)
+                rec['阶段'] += ' (团队模板)' if self.plan.pinned else ''
+            else:
+                self.plan = ParsePlan.detect(df.columns)
+        # 方案中的列在本表中不存在时（例如固定模板后列被改名）视为未映射
+        self.cols = {k: v for k, v in self.plan.mapping.items() if v in df.columns}
 
-    def _map_columns(self):
+    @staticmethod
+    def _map_columns(columns):
+        """按 FIELD_KEYWORDS 为每个标准列取第一个匹配的列名。"""
         mapping = {}
-        targets = {
-            'name': ['姓名', '真实姓名', '学生姓名'],
-            'id': ['学号', '工号', 'UID'],
-            'prog': ['进度', '百分比', '完成度', '任务点'],
-            'time': ['时长', '观看时长', '耗时', '总耗时'],
-            'score': ['综合成绩', '最终成绩', '总分', '成绩', '得分'],
-            'discuss': ['讨论', '互动'],
-            'last_active': ['最后学习时间', '最近学习', '最后登录', '登录时间', '提交时间', '活跃时间', '时间戳', '最后访问', '最近访问', '最后活跃']
-        }
-        for key, possible_names in targets.items():
-            for col in self.df.columns:
+        for key, possible_names in FIELD_KEYWORDS.items():
+            for col in columns:
                 if any(p in col for p in possible_names):
                     mapping[key] = col
                     break
         return mapping
 
-    def _parse_time(self, val):
-        if pd.isna(val) or str(val).strip() in ['--', '-', '']: return 0.0
-        s = str(val)
-        nums = re.findall(r'(\d+\.?\d*)', s)
-        if not nums: return 0.0
-        if '分钟' in s: return float(nums[0])
-        if '时' in s and '分' in s: return float(nums[0]) * 60 + float(nums[1])
-        elif '时' in s: return float(nums[0]) * 60
-        else: return float(nums[0])
-
-    def _parse_progress_value(self, val):
-        """Parse a single progress value into 0-100 float.
-        Supports formats: '40%', '0.4', '40', '3/5', '40/40', numeric strings, and None.
+    @staticmethod
+    def _evaluate_rules(res, mode, avg_time):
+        """按 AUDIT_RULES 整列求值，返回与 TAG_REGISTRY 对应的位掩码数组。"""
+        rules = AUDIT_RULES['LMS' if mode == "LMS" else 'HG']
+        n = len(res)
+        c = {
+            'p': res['进度'].to_numpy(dtype=float),
+            't': res['时长'].to_numpy(dtype=float),
+            'score': res['成绩'].to_numpy(),
+            'discuss': res['讨论'].to_numpy(),
+            'avg': np.full(n, avg_time, dtype=float),
+        }
+        codes = np.zeros(n, dtype=TAG_DTYPE)
+        taken = {}
+        for rule in rules:
+            mask = np.asarray(rule['when'](c), dtype=bool)
+            group = rule.get('group')
+            if group:
+                prev = taken.get(group, np.zeros(n, dtype=bool))
+                mask &= ~prev
+                taken[group] = prev | mask
+            codes[mask] |= TAG_DTYPE(TAG_BITS[rule['tag']])
+        # 没有任何带原因的规则命中则视为正常，清掉只贴标签的位
+        codes[(codes & REASON_BITS) == 0] = 0
+        return codes
+
+    @staticmethod
+    def _kmeans(X, k, max_iter=50, batch_size=None, seed=0, tol=1e-4):
+        """纯 NumPy 的 K-Means（k-means++ 初始化）。
+
+        ``batch_size`` 为空时做整批 Lloyd 迭代；否则按小批量更新中心（mini-batch），
+        最后统一做一次全量归属，适合数十万学生的规模。返回 (labels, centers)。
         """
-        if pd.isna(val):
-            return 0.0
-        s = str(val).strip()
-        if s in ['', '--', '-']:
-            return 0.0
-        # fraction like 3/5 or 10/10
-        m = re.search(r"^(\d+(?:\.\d+)?)\s*/\s*(\d+(?:\.\d+)?)$", s)
-        if m:
-            try:
-                num = float(m.group(1)); den = float(m.group(2))
-                return 100.0 * (num / den) if den != 0 else 0.0
-            except:
-                return 0.0
-        # percentage
-        if '%' in s:
-            try:
-                return float(s.replace('%', '').strip())
-            except:
-                pass
-        # plain number
-        try:
-            v = float(s)
-            # if in 0..1 treat as fraction
-            if 0.0 <= v <= 1.0:
-                return v * 100.0
-            # if >1 and <=100 assume percent already
-            if 1.0 < v <= 1000.0:
-                return v
-        except:
-            pass
-        return 0.0
-
-    def _parse_progress_series(self, series):
-        return series.apply(self._parse_progress_value).fillna(0.0).astype(float)
-
-    def execute_audit(self, mode="LMS", detect_night=True, night_window=(0,5)):
+        rng = np.random.default_rng(seed)
+        n = len(X)
+        k = max(1, min(int(k), n))
+        # k-means++ 初始化（大样本时只在抽样上做）
+        sample = X if n <= 10000 else X[rng.choice(n, 10000, replace=False)]
+        centers = [sample[rng.integers(len(sample))]]
+        d2 = ((sample - centers[0]) ** 2).sum(axis=1)
+        for _ in range(1, k):
+            probs = d2 / d2.sum() if d2.sum() > 0 else None
+            centers.append(sample[rng.choice(len(sample), p=probs)])
+            d2 = np.minimum(d2, ((sample - centers[-1]) ** 2).sum(axis=1))
+        centers = np.array(centers, dtype=float)
+
+        def assign(points):
+            # |x-c|^2 = |x|^2 - 2x·c + |c|^2，省去 n×k×d 的中间数组
+            dist = (points ** 2).sum(axis=1)[:, None] - 2 * points @ centers.T + (centers ** 2).sum(axis=1)[None, :]
+            return dist.argmin(axis=1)
+
+        if batch_size:
+            counts = np.zeros(k)
+            for _ in range(max_iter):
+                batch = X[rng.integers(0, n, batch_size)]
+                labels = assign(batch)
+                for j in np.unique(labels):
+                    pts = batch[labels == j]
+                    counts[j] += len(pts)
+                    # 每个中心按累计样本数衰减学习率
+                    centers[j] += (pts.sum(axis=0) - len(pts) * centers[j]) / counts[j]
+        else:
+            for _ in range(max_iter):
+                labels = assign(X)
+                sums = np.zeros_like(centers)
+                np.add.at(sums, labels, X)
+                sizes = np.bincount(labels, minlength=k)
+                new = np.where(sizes[:, None] > 0, sums / np.maximum(sizes, 1)[:, None], centers)
+                shift = np.abs(new - centers).max()
+                centers = new
+                if shift < tol:
+                    break
+        return assign(X), centers
+
+    @staticmethod
+    def _kmeans_clusters(res, mode, k):
+        """在标准化的 时长/进度/成绩/讨论 上做 K-Means，并给各簇生成可读的群体名。"""
+        feats = ['时长', '进度', '成绩', '讨论']
+        X = res[feats].to_numpy(dtype=float)
+        X = np.nan_to_num(X)
+        std = X.std(axis=0)
+        X = (X - X.mean(axis=0)) / np.where(std > 0, std, 1.0)
+        batch = KMEANS_BATCH_SIZE if len(X) > KMEANS_MINIBATCH_ROWS else None
+        labels, centers = AuditCore._kmeans(X, k, max_iter=100 if batch else 50, batch_size=batch)
+        # 按产出指标（学习通看进度、头歌看成绩）从高到低给簇编号，保证标签稳定
+        out_col = feats.index('进度' if mode == "LMS" else '成绩')
+        order = np.argsort(-centers[:, out_col])
+        names = {}
+        for rank, j in enumerate(order, start=1):
+            profile = '·'.join(f"{f}{'高' if centers[j, i] >= 0 else '低'}" for i, f in enumerate(feats))
+            names[j] = f"🔹 群体{rank} ({profile})"
+        return np.array([names[j] for j in range(len(centers))], dtype=object)[labels]
+
+    def execute_audit(self, mode="LMS", detect_night=True, night_window=(0,5), cluster_method="quadrant", n_clusters=4):
+        res, err = self.normalize()
+        if err: return None, err
+        return self.audit_frame(res, mode, detect_night, night_window, cluster_method, n_clusters), None
+
+    @staged('解析标准列', rows=lambda self: len(self.df))
+    def normalize(self):
+        """按列映射抽取标准列（姓名/学号/进度/时长/成绩/讨论/最后活跃），只与文件内容有关。"""
         c = self.cols
         if 'name' not in c: return None, "表格中未找到【姓名】列"
         
@@ -189,127 +1233,1422 @@ class AuditCore:
         res['姓名'] = self.df[c['name']]
         res['学号'] = self.df[c['id']] if 'id' in c else "未知"
         
+        parse = self.plan.parser
         if 'prog' in c:
-            raw_p = self._parse_progress_series(self.df[c['prog']])
+            raw_p = parse('prog')(self.df[c['prog']])
             # parsed into 0-100
             res['进度'] = raw_p.clip(0, 100)
         else: res['进度'] = 0.0
         
-        res['时长'] = self.df[c['time']].apply(self._parse_time) if 'time' in c else 0.0
-        res['成绩'] = pd.to_numeric(self.df[c['score']], errors='coerce').fillna(0) if 'score' in c else 0
-        res['讨论'] = pd.to_numeric(self.df[c['discuss']], errors='coerce').fillna(0) if 'discuss' in c else 0
+        res['时长'] = parse('time')(self.df[c['time']]).fillna(0.0) if 'time' in c else 0.0
+        res['成绩'] = parse('score')(self.df[c['score']]).fillna(0) if 'score' in c else 0
+        res['讨论'] = parse('discuss')(self.df[c['discuss']]).fillna(0) if 'discuss' in c else 0
 
         # 解析最后活跃时间（若存在），提取小时用于“深夜学习”检测
         if 'last_active' in c:
             try:
-                last_series = pd.to_datetime(self.df[c['last_active']], errors='coerce')
+                last_series = parse('last_active')(self.df[c['last_active']])
                 res['最后活跃时间'] = last_series
                 res['最后活跃小时'] = last_series.dt.hour.fillna(-1).astype(int)
             except Exception:
                 res['最后活跃时间'] = pd.NaT
                 res['最后活跃小时'] = -1
-        
+        return compact_result(res), None
+
+    @staticmethod
+    def audit_frame(res, mode="LMS", detect_night=True, night_window=(0,5), cluster_method="quadrant", n_clusters=4):
+        """在标准列上做规则审计、群体划分与深夜检测；基准时长、群体均值等都在传入的这批学生内计算。"""
+        res = AuditCore.rule_audit(res, mode, cluster_method, n_clusters)
+        # 夜间活跃检测：若 audit 调用方要求检测且存在小时列
+        if detect_night and '最后活跃小时' in res.columns:
+            TagCodec.add(res, AuditCore.night_mask(res['最后活跃小时'], night_window), '🌙深夜学习')
+        return res
+
+    @staticmethod
+    def night_mask(hours, night_window):
+        start_h, end_h = night_window
+        hours = np.asarray(hours)
+        if start_h <= end_h:
+            return (hours >= start_h) & (hours <= end_h)
+        # 跨午夜，例如 start=22 end=3；小时为 -1 表示缺失，不计入
+        return (hours >= 0) & ((hours >= start_h) | (hours <= end_h))
+
+    @staticmethod
+    def rule_audit(res, mode="LMS", cluster_method="quadrant", n_clusters=4):
+        """规则标签（AUDIT_RULES）与学习群体划分，不含深夜检测。"""
+        res = res.copy()
         valid_times = res[res['时长'] > 5]['时长']
         avg_time = valid_times.mean() if not valid_times.empty else 60 
         
-        # --- 异常判定逻辑 ---
-        def ai_diagnosis(row):
-            tags = []
-            reasons = []
-            p = row['进度']
-            t = row['时长']
-            
-            if mode == "LMS":
-                dynamic_threshold = avg_time * 0.15
-                if p > 90 and (t < 15 or t < dynamic_threshold):
-                    tags.append("🚨AI:秒刷")
-                    reasons.append(f"进度{p:.0f}%，但时长仅{t:.1f}分(班级平均{avg_time:.0f}分)，极速完成")
-                elif p > 80 and t < (avg_time * 0.4):
-                    tags.append("🟡时长存疑")
-                    reasons.append(f"进度{p:.0f}%但时长{t:.1f}分，严重不成正比")
-                if p > 50 and row['讨论'] == 0:
-                    tags.append("🟣零互动")
-                if p > 90 and row['成绩'] < 40 and row['成绩'] > 0:
-                    tags.append("🐌无效刷课")
-                    reasons.append(f"进度满但成绩极低({row['成绩']}分)")
-            else: # 头歌
-                if row['成绩'] == 0 and t < 1:
-                    tags.append("🌑未开始")
-                    reasons.append("未开始实训")
-                elif row['成绩'] >= 90 and t < 15:
-                    tags.append("🚨代码拷贝")
-                    reasons.append(f"高分({row['成绩']}分)但耗时极短")
-                elif row['成绩'] >= 60 and t < 5:
-                    tags.append("⚡极速完成")
-
-            is_abnormal = len(reasons) > 0
-            if not is_abnormal: return ["🟢正常"], "符合常态"
-            return tags, " | ".join(reasons)
-
-        analysis = res.apply(ai_diagnosis, axis=1)
-        res['证据链'] = analysis.apply(lambda x: x[0])
-        res['异常原因'] = analysis.apply(lambda x: x[1])
-        res['状态'] = res['异常原因'].apply(lambda x: '正常' if '符合常态' in x else '异常')
-        res['主标签'] = res['证据链'].apply(lambda x: x[0])
+        # --- 异常判定逻辑（规则表向量化求值，见 AUDIT_RULES） ---
+        # 标签以位掩码存储，异常原因等文本由 TagCodec 按需生成
+        with stage('规则评估', len(res)):
+            res['标签码'] = AuditCore._evaluate_rules(res, mode, avg_time)
+        res['基准时长'] = SCORE_DTYPE(avg_time)
+        TagCodec.refresh(res)
         
         # --- 聚类分析 (新增) ---
-        # 简单高效的 RFM 分层逻辑 (无需 sklearn)
-        def get_cluster(row):
-            # T: Time Score, P: Progress Score
-            t_score = 1 if row['时长'] >= avg_time else 0
-            metric = row['进度'] if mode == "LMS" else row['成绩']
-            metric_avg = res['进度'].mean() if mode == "LMS" else res['成绩'].mean()
-            p_score = 1 if metric >= metric_avg else 0
-            
-            if t_score == 1 and p_score == 1: return "🌟 领跑集团 (双高)"
-            if t_score == 0 and p_score == 1: return "🚀 效率/刷课组 (低时高产)"
-            if t_score == 1 and p_score == 0: return "🐢 努力困境组 (高时低产)"
-            return "💤 待激活组 (双低)"
-            
-        res['学习群体'] = res.apply(get_cluster, axis=1)
+        # 默认：简单高效的 RFM 四象限分层 (无需 sklearn)；可选 NumPy K-Means
+        with stage(f'群体划分:{cluster_method}', len(res)):
+            if cluster_method == "kmeans":
+                res['学习群体'] = AuditCore._kmeans_clusters(res, mode, n_clusters)
+            else:
+                # T: Time Score, P: Progress Score（整列比较，均值只算一次）
+                metric = res['进度'] if mode == "LMS" else res['成绩']
+                t_high = (res['时长'] >= avg_time).to_numpy()
+                p_high = (metric >= metric.mean()).to_numpy()
+                res['学习群体'] = pd.Categorical(np.select(
+                    [t_high & p_high, ~t_high & p_high, t_high & ~p_high],
+                    list(QUADRANT_COLORS)[:3], default=list(QUADRANT_COLORS)[3]), categories=list(QUADRANT_COLORS))
+        return compact_result(res)
+
+
+# ------------------------------------------------------------------------------
+# 综合评分：综合得分 / 班内分层 / 学习参与度（页面与批量脚本共用）
+# ------------------------------------------------------------------------------
+DEFAULT_WEIGHTS = {'w_prog': 0.4, 'w_score': 0.3, 'w_time': 0.2, 'w_discuss': 0.1}
+DEFAULT_PART_WEIGHTS = {'p_w_discuss': 0.4, 'p_w_stability': 0.3, 'p_w_complete': 0.3}
+
+
+class Scoring:
+    @staticmethod
+    def normalize(weights):
+        """按总和归一化权重；全部为 0 时平均分配。"""
+        total = sum(weights.values())
+        if total == 0:
+            return {k: 1.0 / len(weights) for k in weights}
+        return {k: v / total for k, v in weights.items()}
+
+    @staticmethod
+    def safe_minmax(s):
+        """min-max 归一化到 0-1，常量列统一取 0.5。"""
+        s = pd.to_numeric(s, errors='coerce').fillna(0).astype(float)
+        mn = s.min(); mx = s.max()
+        if pd.isna(mn) or pd.isna(mx) or mx == mn:
+            return pd.Series(0.5, index=s.index)
+        return (s - mn) / (mx - mn)
+
+    @staticmethod
+    def _norm_col(df, col):
+        if col not in df.columns:
+            return pd.Series(0.0, index=df.index)
+        if col == '进度':
+            return df['进度'].clip(0, 100) / 100.0
+        return Scoring.safe_minmax(df[col])
+
+    @staticmethod
+    def _per_group(df, by, fn, cols):
+        """by 为列名时在每组内分别调用 fn（归一化、百分位都只在组内计算），再把 cols 写回原表。"""
+        if by is None or by not in df.columns or df[by].nunique() <= 1:
+            return fn(df)
+        parts = [fn(part.copy())[cols] for _, part in df.groupby(by, sort=False, observed=True)]
+        df[cols] = pd.concat(parts).reindex(df.index)
+        return df
+
+    @staticmethod
+    def composite(df, weights=None, n_bins=4, by=None):
+        """写入 综合得分（0-100）、综合百分位 与 综合分组（按百分位等分 n_bins 层）。"""
+        if by is not None:
+            return Scoring._per_group(df, by, lambda part: Scoring.composite(part, weights, n_bins),
+                                      ['综合得分', '综合百分位', '综合分组'])
+        Scoring.composite_score(df, weights)
+        return Scoring.rank(df, n_bins)
+
+    @staticmethod
+    def composite_score(df, weights=None, by=None):
+        """只写入 综合得分（0-100），各项 min-max 归一化后按权重加权。"""
+        if by is not None:
+            return Scoring._per_group(df, by, lambda part: Scoring.composite_score(part, weights), ['综合得分'])
+        w = Scoring.normalize(weights or DEFAULT_WEIGHTS)
+        df['综合得分'] = (Scoring._norm_col(df, '进度') * w['w_prog'] + Scoring._norm_col(df, '成绩') * w['w_score']
+                      + Scoring._norm_col(df, '时长') * w['w_time'] + Scoring._norm_col(df, '讨论') * w['w_discuss']).mul(100).astype(SCORE_DTYPE)
+        return df
+
+    @staticmethod
+    def rank(df, n_bins=4, by=None, pct=None):
+        """由 综合得分 写入 综合百分位 与 综合分组；``pct`` 可传入已算好的百分位（见 SortedIndex.percentile）。"""
+        if pct is None:
+            groups = df[by] if by is not None and by in df.columns else None
+            pct = SortedIndex(df['综合得分'], groups).percentile()
+        # 分层用 float64 的百分位计算，避免 float32 舍入把恰好落在边界上的学生分到相邻层
+        bin_idx = np.ceil(np.nan_to_num(pct, nan=0.0) * n_bins / 100.0).clip(1, n_bins).astype(int)
+        labels = [f"{int((i-1) * 100 / n_bins)}-{int(i * 100 / n_bins)}%" for i in range(1, n_bins+1)]
+        df['综合百分位'] = pct.astype(SCORE_DTYPE)
+        df['综合分组'] = pd.Series(pd.Categorical.from_codes(bin_idx - 1, categories=labels, ordered=True), index=df.index)
+        return df
+
+    @staticmethod
+    def participation(df, weights=None, by=None):
+        """写入 参与度（0-100）：讨论频次 + 时长稳定性（接近中位时长视为稳定）+ 提交完整率（进度）。"""
+        if by is not None:
+            return Scoring._per_group(df, by, lambda part: Scoring.participation(part, weights), ['参与度'])
+        w = Scoring.normalize(weights or DEFAULT_PART_WEIGHTS)
+        if '时长' in df.columns:
+            time_norm = Scoring.safe_minmax(df['时长'])
+            stability_raw = 1 - (time_norm - time_norm.median()).abs()
+            if stability_raw.max() == stability_raw.min():
+                stability = pd.Series(0.5, index=df.index)
+            else:
+                stability = (stability_raw - stability_raw.min()) / (stability_raw.max() - stability_raw.min())
+        else:
+            stability = pd.Series(0.0, index=df.index)
+        df['参与度'] = (Scoring._norm_col(df, '讨论') * w['p_w_discuss'] + stability * w['p_w_stability']
+                     + Scoring._norm_col(df, '进度') * w['p_w_complete']).mul(100).astype(SCORE_DTYPE)
+        return df
+
+    @staticmethod
+    def unfinished_mask(df):
+        return pd.to_numeric(df['进度'], errors='coerce').fillna(0) < 99.9
+
+    @staticmethod
+    def run(df, weights=None, part_weights=None, n_bins=4, low_part_thr=40, by=None):
+        """审计之后的完整评分流程：未完结标记、综合得分、参与度与低参与标记。"""
+        TagCodec.add(df, Scoring.unfinished_mask(df), '⚠️未完结')
+        Scoring.composite(df, weights, n_bins, by)
+        Scoring.participation(df, part_weights, by)
+        TagCodec.add(df, Scoring.low_participation(SortedIndex(df['参与度']), low_part_thr), '🟠参与度低')
+        return df
+
+    @staticmethod
+    def low_participation(index, threshold):
+        """参与度低于阈值的行（``index`` 为参与度列的 SortedIndex）。缺失按 0 计，阈值大于 0 时一并计入。"""
+        rows = index.rows_below(threshold)
+        return np.concatenate([rows, index.rows_missing()]) if 0 < threshold else rows
+
+
+class SortedIndex:
+    """一列指标的升序排序索引，每个数据版本只建一次。
+
+    阈值查询（“多少人、是谁”）用 searchsorted 在有序数组上二分查找，不再整列比较；
+    ``groups`` 给出时先按组再按值排序，用于组内百分位。NaN 排在最后，不参与阈值与百分位。
+    """
+
+    def __init__(self, values, groups=None):
+        values = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        if groups is None:
+            self.order = np.argsort(values, kind='stable')
+            self.group_codes = None
+        else:
+            codes = pd.factorize(pd.Series(groups), use_na_sentinel=False)[0]
+            self.order = np.lexsort((values, codes))
+            self.group_codes = codes[self.order]
+        self.sorted = values[self.order]
+        self.n_valid = int(len(values) - np.isnan(values).sum())
+
+    def __len__(self):
+        return len(self.order)
+
+    def count_below(self, threshold):
+        """严格小于阈值的人数。"""
+        return int(np.searchsorted(self.sorted[:self.n_valid], threshold, side='left'))
+
+    def count_above(self, threshold):
+        """严格大于阈值的人数。"""
+        return self.n_valid - int(np.searchsorted(self.sorted[:self.n_valid], threshold, side='right'))
+
+    def rows_below(self, threshold):
+        return self.order[:self.count_below(threshold)]
+
+    def rows_above(self, threshold):
+        return self.order[self.n_valid - self.count_above(threshold):self.n_valid]
+
+    def rows_missing(self):
+        """取值为 NaN 的行。"""
+        return self.order[self.n_valid:]
+
+    def quantile(self, q):
+        """与 np.nanpercentile(values, q * 100) 相同的线性插值分位数；全为 NaN 时返回 NaN。"""
+        if self.n_valid == 0:
+            return np.nan
+        pos = (self.n_valid - 1) * q
+        lo = int(np.floor(pos))
+        hi = min(lo + 1, self.n_valid - 1)
+        return float(self.sorted[lo] + (self.sorted[hi] - self.sorted[lo]) * (pos - lo))
+
+    def max(self):
+        return float(self.sorted[self.n_valid - 1]) if self.n_valid else np.nan
+
+    def percentile(self):
+        """各行（原行序）在所属组内的百分位 0-100；并列取平均名次，与 ``Series.rank(pct=True) * 100`` 一致。"""
+        v, n = self.sorted, len(self.order)
+        if n == 0:
+            return np.array([], dtype=float)
+        g = self.group_codes if self.group_codes is not None else np.zeros(n, dtype=np.int64)
+        new_group = np.r_[True, g[1:] != g[:-1]]
+        new_tie = new_group | np.r_[True, v[1:] != v[:-1]]
+        tie_start = np.flatnonzero(new_tie)
+        tie_end = np.r_[tie_start[1:], n] - 1
+        tie_id = np.cumsum(new_tie) - 1
+        group_id = np.cumsum(new_group) - 1
+        group_start = np.flatnonzero(new_group)
+        valid = ~np.isnan(v)
+        group_valid = np.bincount(group_id, weights=valid, minlength=len(group_start))
+        ranks = (tie_start[tie_id] + tie_end[tie_id]) / 2 - group_start[group_id] + 1
+        pct = np.where(valid, ranks / group_valid[group_id] * 100, np.nan)
+        out = np.empty(n)
+        out[self.order] = pct
+        return out
+
+
+# ------------------------------------------------------------------------------
+# 章节结构索引：每个上传文件只构建一次，供章节汇总、群体对比与导出共用
+# ------------------------------------------------------------------------------
+# 章节状态中视为“已完成”的关键词
+COMPLETION_WORDS = ['通过', '已完成', '完成', '合格', '✓']
+_COMPLETION_PATTERN = '|'.join(re.escape(w) for w in COMPLETION_WORDS)
+
+
+def completed_mask(series):
+    """章节状态文本是否包含完成类关键词（缺失视为未完成）；只对去重后的状态做匹配。"""
+    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+    hits = pd.Series(uniques).astype(str).str.contains(_COMPLETION_PATTERN, regex=True, na=False).to_numpy()
+    out = np.zeros(len(codes), dtype=bool)
+    out[codes >= 0] = hits[codes[codes >= 0]]
+    return out
+
+
+class ChapterSchema:
+    """原始表的章节列结构，以及 学生×章节 的稠密矩阵。
+
+    列名中第一个 1-2 位数字视为章节号；每章取第一个匹配关键词的列作为
+    状态/得分/时长列。矩阵的行与 ``raw_df`` 的行一一对应：
+    ``attempted``/``completed`` 为布尔矩阵，``score``/``duration`` 为 float32（缺失为 NaN）。
+    """
+    STATUS_KEYS = ['状', '完成', '通过', '是否', '提交']
+    SCORE_KEYS = ['得分', '成绩', '分']
+    DUR_KEYS = ['时', '耗时', '时长']
+
+    def __init__(self, raw_df, layout=None):
+        """``layout`` 为解析方案中记录的章节布局（见 ``detect_layout``）；缺省时按列名识别。"""
+        layout = self.detect_layout(raw_df.columns) if layout is None else layout
+        self.index = raw_df.index
+        self.chapters = list(layout)
+        self.columns = {ch: layout[ch]['columns'] for ch in self.chapters}
+        self.status_col = {ch: layout[ch]['status'] for ch in self.chapters}
+        self.score_col = {ch: layout[ch]['score'] for ch in self.chapters}
+        self.dur_col = {ch: layout[ch]['duration'] for ch in self.chapters}
+
+        n, k = len(raw_df), len(self.chapters)
+        self.attempted = np.zeros((n, k), dtype=bool)
+        self.completed = np.zeros((n, k), dtype=bool)
+        self.score = np.full((n, k), np.nan, dtype=np.float32)
+        self.duration = np.full((n, k), np.nan, dtype=np.float32)
+        for j, ch in enumerate(self.chapters):
+            self.attempted[:, j] = raw_df[self.columns[ch]].notna().any(axis=1).to_numpy()
+            if self.status_col[ch] is not None:
+                self.completed[:, j] = completed_mask(raw_df[self.status_col[ch]])
+            if self.score_col[ch] is not None:
+                self.score[:, j] = parse_number(raw_df[self.score_col[ch]]).to_numpy()
+            if self.dur_col[ch] is not None:
+                self.duration[:, j] = parse_duration(raw_df[self.dur_col[ch]]).to_numpy()
+        self.has_status = np.array([self.status_col[ch] is not None for ch in self.chapters], dtype=bool)
+        self.has_score = np.array([self.score_col[ch] is not None for ch in self.chapters], dtype=bool)
+
+    @staticmethod
+    def _first(cols, keys):
+        return next((c for c in cols if any(k in c for k in keys)), None)
+
+    @staticmethod
+    def detect_layout(columns):
+        """由列名识别章节布局：章节号 -> {columns, status, score, duration}，按章节号排序。"""
+        chap_map = {}
+        for c in columns:
+            nums = re.findall(r"(\d{1,2})", str(c))
+            if nums:
+                chap_map.setdefault(nums[0], []).append(c)
+        first = ChapterSchema._first
+        return {ch: {'columns': chap_map[ch], 'status': first(chap_map[ch], ChapterSchema.STATUS_KEYS),
+                     'score': first(chap_map[ch], ChapterSchema.SCORE_KEYS), 'duration': first(chap_map[ch], ChapterSchema.DUR_KEYS)}
+                for ch in sorted(chap_map, key=int)}
+
+    def __len__(self):
+        return len(self.chapters)
+
+    def unfinished(self):
+        """有状态列的章节中未完成的格子。"""
+        return ~self.completed & self.has_status[None, :]
+
+    def low_score(self):
+        """每章分数低于“本章均值 - 标准差”的格子。"""
+        score = pd.DataFrame(self.score, dtype=float)
+        thr = (score.mean() - score.std()).to_numpy()
+        with np.errstate(invalid='ignore'):
+            return score.to_numpy() < thr[None, :]
+
+    def summary(self):
+        """章节汇总表：尝试/完成人数、完成率与平均时长。"""
+        attempts = self.attempted.sum(axis=0)
+        completions = self.completed.sum(axis=0)
+        rate = np.where(attempts > 0, completions / np.maximum(attempts, 1) * 100, np.nan)
+        avg_dur = pd.DataFrame(self.duration, dtype=float).mean().to_numpy()
+        return pd.DataFrame({
+            '章节': self.chapters,
+            '尝试人数': attempts.astype(int),
+            '完成人数': completions.astype(int),
+            '完成率(%)': np.round(rate, 1),
+            '平均时长(分)': np.round(avg_dur, 1),
+            '示例列': [','.join(self.columns[ch][:6]) for ch in self.chapters],
+        })
+
+    def examples(self, raw_df, names, per_chapter=5):
+        """每章低分（有得分列）或未完结（仅有状态列）的前若干名学生，附原始取值。"""
+        names = np.asarray(names)
+        low, unfin = self.low_score(), self.unfinished()
+        rows = []
+        for j, ch in enumerate(self.chapters):
+            if self.has_score[j]:
+                col, mask = self.score_col[ch], low[:, j]
+            elif self.has_status[j]:
+                col, mask = self.status_col[ch], unfin[:, j]
+            else:
+                continue
+            for i in np.flatnonzero(mask)[:per_chapter]:
+                rows.append({'章节': ch, '姓名': names[i], '分数列': col, '分数': raw_df[col].iloc[i]})
+        return pd.DataFrame(rows)
+
+    def group_pass_rates(self, groups):
+        """按群体的章节通过率矩阵（%）：行为群体，列为有状态列的章节。"""
+        cols = [ch for ch, ok in zip(self.chapters, self.has_status) if ok]
+        if not cols:
+            return pd.DataFrame()
+        done = pd.DataFrame(self.completed[:, self.has_status].astype(float), columns=cols)
+        return done.groupby(np.asarray(groups)).mean().mul(100).round(1)
+
+
+@st.cache_resource(max_entries=8)
+def get_chapter_schema(file_key, _raw_df):
+    # 以文件内容哈希为键：同一上传只构建一次章节索引与矩阵；章节布局取自表头模板
+    return ChapterSchema(_raw_df, layout=get_plan_registry().plan_for(_raw_df.columns).chapters)
+
+
+# ------------------------------------------------------------------------------
+# 分阶段审计流水线：标准化 → 规则审计 → 评分 → 排名 → 标签（加载由 ParseCache 按内容哈希缓存）
+# ------------------------------------------------------------------------------
+PIPELINE_MEMO_SIZE = 4  # 每个阶段保留的最近结果数
+
+
+def data_version(*parts):
+    """由上游版本与参数生成短版本号，任何一项变化都会得到新版本。"""
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:16]
+
+
+@st.cache_resource(max_entries=64)
+def get_normalized(file_key, _raw_df):
+    return AuditCore(_raw_df, plans=get_plan_registry()).normalize()
+
+
+@st.cache_resource(max_entries=64)
+def get_class_audit(file_key, mode, cluster_method, n_clusters, _raw_df):
+    # 单个文件（班级）的规则审计按 内容 + 参数 缓存：追加文件时已有班级不会重算
+    res, err = get_normalized(file_key, _raw_df)
+    if err:
+        return None, err
+    return AuditCore.rule_audit(res, mode, cluster_method, n_clusters), None
+
+
+class AuditPipeline:
+    """审计流水线。每个阶段声明依赖的上游阶段与侧栏参数，输出按“阶段版本”记忆。
+
+    阶段版本 = 上游版本 + 本阶段参数值的哈希，因此调整某个参数只会重算依赖它的阶段及其下游：
+    例如改 ``weights`` 只重算 scoring/ranking/tagging，切换 ``detect_night`` 只重算 tagging。
+    各阶段只输出自己新增的列，最后按列拼成审计表。上传了活动日志时，深夜检测按日志中的深夜事件占比判断。
+    """
+
+    # 阶段名 -> (上游阶段, 参数名)
+    STAGES = {
+        'normalize': ((), ('files',)),
+        'audit': (('normalize',), ('pooled', 'mode', 'cluster_method', 'n_clusters')),
+        'scoring': (('normalize',), ('pooled', 'weights', 'part_weights')),
+        'ranking': (('scoring',), ('n_bins',)),
+        'tagging': (('normalize', 'audit', 'scoring'), ('detect_night', 'night_window', 'low_part_thr', 'activity', 'night_share')),
+    }
+
+    def __init__(self, classes, params, memo, activity=None):
+        """``classes`` 为 [(班级, file_key, raw_df)]；``memo`` 为跨重跑保存的 dict（如 session_state 中的一项）；
+        ``activity`` 为可选的 ActivityProfile。"""
+        self.classes = classes
+        self.activity = activity
+        self.params = dict(params, files=tuple((label, key) for label, key, _ in classes),
+                           activity=activity.key if activity is not None else None)
+        self.memo = memo
+        self.computed = []  # 本次实际重算的阶段
+        self._versions = {}
+
+    def version(self, stage):
+        if stage not in self._versions:
+            deps, names = self.STAGES[stage]
+            self._versions[stage] = data_version(stage, *[self.version(d) for d in deps],
+                                                 *[self.params[n] for n in names])
+        return self._versions[stage]
+
+    def get(self, name):
+        store = self.memo.setdefault(name, OrderedDict())
+        key = self.version(name)
+        if key in store:
+            store.move_to_end(key)
+            return store[key]
+        with stage(f'流水线:{name}') as rec:
+            out = getattr(self, f'_{name}')()
+            first = out[0] if isinstance(out, tuple) else out
+            if first is not None:
+                # 拼接多个班级后分类列可能退回文本，存入记忆前统一收紧类型
+                first = compact_result(first)
+                out = (first,) + out[1:] if isinstance(out, tuple) else first
+            rec['行数'] = len(first) if first is not None else 0
+        store[key] = out
+        while len(store) > PIPELINE_MEMO_SIZE:
+            store.popitem(last=False)
+        self.computed.append(name)
+        return out
+
+    def sorted_index(self, stage, col, by=None):
+        """某阶段输出列的 SortedIndex，按阶段版本记忆；``by`` 为分组列名时按组内排序。"""
+        store = self.memo.setdefault('_index', OrderedDict())
+        key = (self.version(stage), col, by)
+        if key in store:
+            store.move_to_end(key)
+            return store[key]
+        groups = self.get('normalize')[0][by] if by else None
+        store[key] = SortedIndex(self.get(stage)[col], groups)
+        while len(store) > PIPELINE_MEMO_SIZE * 2:
+            store.popitem(last=False)
+        return store[key]
+
+    def run(self):
+        """返回 (audit_df, {班级: 错误})；列顺序与 execute_audit + 评分后的结果一致。"""
+        base, errors = self.get('normalize')
+        if base is None:
+            return None, errors
+        audit, scores, ranks, tags = self.get('audit'), self.get('scoring'), self.get('ranking'), self.get('tagging')
+        df = pd.concat([base, tags[['标签码']], audit[['基准时长']], tags[['状态', '主标签']], audit[['学习群体']],
+                        scores[['综合得分']], ranks, scores[['参与度']], tags.drop(columns=['标签码', '状态', '主标签'])], axis=1)
+        return df, errors
+
+    def _ok_classes(self):
+        errors = self.get('normalize')[1]
+        return [c for c in self.classes if c[0] not in errors]
+
+    def _score_by(self, base):
+        # 按班级统计时，归一化与百分位都在班内计算
+        return '班级' if '班级' in base.columns and not self.params['pooled'] else None
+
+    def _normalize(self):
+        frames, errors = [], {}
+        for label, key, raw in self.classes:
+            res, err = get_normalized(key, raw)
+            if err:
+                errors[label] = err
+                continue
+            if len(self.classes) > 1:
+                res = res.copy()
+                res.insert(2, '班级', label)
+            frames.append(res)
+        if not frames:
+            return None, errors
+        return (frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)), errors
+
+    def _audit(self):
+        p = self.params
+        if p['pooled']:
+            res = AuditCore.rule_audit(self.get('normalize')[0], p['mode'], p['cluster_method'], p['n_clusters'])
+        else:
+            parts = [get_class_audit(key, p['mode'], p['cluster_method'], p['n_clusters'], raw)[0]
+                     for _, key, raw in self._ok_classes()]
+            res = parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True)
+        return res[['标签码', '基准时长', '学习群体']]
+
+    def _scoring(self):
+        base = self.get('normalize')[0]
+        p, by = self.params, self._score_by(base)
+        df = base[[c for c in ['班级', '进度', '成绩', '时长', '讨论'] if c in base.columns]].copy()
+        Scoring.composite_score(df, dict(p['weights']), by)
+        Scoring.participation(df, dict(p['part_weights']), by)
+        return df[['综合得分', '参与度']]
+
+    def _ranking(self):
+        # 百分位只随评分变化，调整分层组数时只需重新分箱
+        by = self._score_by(self.get('normalize')[0])
+        df = pd.DataFrame(index=self.get('scoring').index)
+        Scoring.rank(df, self.params['n_bins'], pct=self.sorted_index('scoring', '综合得分', by).percentile())
+        return df[['综合百分位', '综合分组']]
+
+    def _tagging(self):
+        p = self.params
+        base = self.get('normalize')[0]
+        df = self.get('audit')[['标签码']].copy()
+        if self.activity is not None:
+            # 活动日志：按深夜事件占比判断，而不是只看最后一次活跃时间
+            df['深夜占比'] = self.activity.night_share(base['学号'], p['night_window'])[0].astype(SCORE_DTYPE)
+            if p['detect_night']:
+                TagCodec.add(df, self.activity.night_mask(base['学号'], p['night_window'], p['night_share']), '🌙深夜学习', refresh=False)
+        elif p['detect_night'] and '最后活跃小时' in base.columns:
+            TagCodec.add(df, AuditCore.night_mask(base['最后活跃小时'], p['night_window']), '🌙深夜学习', refresh=False)
+        # 将“未完成人群”合并到“不健康/异常人群”中：对进度 < 99.9 的记录追加证据标签
+        TagCodec.add(df, Scoring.unfinished_mask(base), '⚠️未完结', refresh=False)
+        part = self.sorted_index('scoring', '参与度')
+        TagCodec.add(df, Scoring.low_participation(part, p['low_part_thr']), '🟠参与度低', refresh=False)
+        TagCodec.refresh(df)
+        return df
+
+
+# ==============================================================================
+# 4. 报表导出 (流式写出)
+# ==============================================================================
+_XLSX_STREAM_OPTIONS = {
+    'constant_memory': True,        # 逐行落盘，内存占用与行数/工作表数无关
+    'strings_to_formulas': False,
+    'strings_to_urls': False,
+    'nan_inf_to_errors': True,
+    'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+}
+XLSX_CHECKPOINT_ROWS = 2000  # 流式写出时每隔多少行检查一次取消
+
+_XLSX_NATIVE = (str, int, float, bool, datetime.date, datetime.time)
+
+
+def _safe_sheet_name(name, used):
+    name = re.sub(r'[\[\]:*?/\\]', '_', str(name))[:31] or 'Sheet'
+    base, k = name, 1
+    while name in used:
+        suffix = f'_{k}'
+        name = base[:31 - len(suffix)] + suffix
+        k += 1
+    used.add(name)
+    return name
+
+
+def _xlsx_column_values(col):
+    """按列转为 xlsxwriter 可直接写的 Python 值：缺失值转 None（写出为空单元格），
+    区间、列表等其它对象转为文本。"""
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        col = col.astype(object)
+    values = col.astype(object).where(col.notna(), None).tolist()
+    if col.dtype == object:
+        values = [v if v is None or isinstance(v, _XLSX_NATIVE) else str(v) for v in values]
+    return values
+
+
+def write_xlsx_streaming(sheets, target, checkpoint=None):
+    """把 (工作表名, DataFrame) 序列按行写入 xlsx。
+
+    使用 xlsxwriter 的 constant_memory 模式：每行写完即落到临时文件，
+    ``sheets`` 可以是生成器，调用方每次只需持有一张表。``target`` 为路径或二进制文件对象。
+    ``checkpoint`` 每写 XLSX_CHECKPOINT_ROWS 行调用一次（例如后台任务的取消检查），抛出的异常会中止写入。
+    """
+    wb = xlsxwriter.Workbook(target, _XLSX_STREAM_OPTIONS)
+    used = set()
+    try:
+        for name, df in sheets:
+            ws = wb.add_worksheet(_safe_sheet_name(name, used))
+            ws.write_row(0, 0, [str(c) for c in df.columns])
+            cols = [_xlsx_column_values(df[c]) for c in df.columns]
+            for r, row in enumerate(zip(*cols), start=1):
+                if checkpoint is not None and r % XLSX_CHECKPOINT_ROWS == 0:
+                    checkpoint()
+                ws.write_row(r, 0, row)
+    finally:
+        wb.close()
+    return target
+
+
+EXPORT_CACHE_MAX_MB = int(os.environ.get('AUDIT_EXPORT_CACHE_MB', '128'))
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+class ExportCache:
+    """导出文件字节缓存：键为 (导出名, 数据版本, 参数)，总大小超过 ``max_bytes`` 时按 LRU 淘汰。
+
+    下载按钮的数据回调在 Streamlit 的独立线程中执行，因此这里自带锁，不依赖 session_state。
+    """
+
+    def __init__(self, max_bytes=EXPORT_CACHE_MAX_MB * 1024 ** 2):
+        self.max_bytes = int(max_bytes)
+        self._entries = OrderedDict()  # key -> bytes
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """已缓存的字节，没有时返回 None。"""
+        with self._lock:
+            return self._entries.get(key)
+
+    def get_or_build(self, key, build):
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is not None:
+                self._entries.move_to_end(key)
+                return hit
+        data = build()
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = data
+                self._bytes += len(data)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._bytes -= len(self._entries.popitem(last=False)[1])
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+
+@st.cache_resource
+def get_export_cache():
+    return ExportCache()
+
+
+def excel_bytes(sheets, index=False):
+    """把 (工作表名, DataFrame) 列表用 pandas 写成 xlsx 字节，适合小表导出。"""
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        for name, df in sheets:
+            df.to_excel(writer, index=index, sheet_name=name)
+    return output.getvalue()
+
+
+def streaming_xlsx_bytes(sheets, checkpoint=None):
+    """经磁盘临时文件流式写出 xlsx 后读回字节，内存不随表数增长。"""
+    with tempfile.TemporaryFile() as out:
+        write_xlsx_streaming(sheets, out, checkpoint)
+        out.seek(0)
+        return out.read()
+
+
+def chapter_workbook_sheets(schema, raw_df, audit_df):
+    """按章节导出的各工作表（生成器）：章节汇总、全班明细、每章详情、低分与未完结名单。
+
+    全部由 ChapterSchema 的矩阵按列取出；低分名单取本章分数低于“均值-标准差”的学生。
+    """
+    yield '章节汇总', schema.summary()
+    yield '全班明细', TagCodec.export_view(audit_df)
+
+    # 审计表与原始表按行序一一对应（单班视图的审计表已重新编号），按位置取值而不是按索引对齐
+    if len(audit_df) != len(raw_df):
+        raise ValueError(f'审计表 {len(audit_df)} 行与原始表 {len(raw_df)} 行不一致')
+    base = pd.DataFrame({
+        '姓名': audit_df['姓名'].to_numpy() if '姓名' in audit_df.columns else '',
+        '学号': audit_df['学号'].to_numpy() if '学号' in audit_df.columns else '',
+    }, index=raw_df.index)
+    low, unfin = schema.low_score(), schema.unfinished()
+    low_parts, unfin_parts = [], []
+    for j, ch in enumerate(schema.chapters):
+        status_col, score_col, dur_col = schema.status_col[ch], schema.score_col[ch], schema.dur_col[ch]
+        yield f'章{ch}_详情', base.assign(
+            章节状态=raw_df[status_col] if status_col is not None else '',
+            章节得分=raw_df[score_col] if score_col is not None else '',
+            章节时长原始=raw_df[dur_col] if dur_col is not None else '')
+
+        if low[:, j].any():
+            m = low[:, j]
+            low_parts.append(base[m].assign(章节=ch, 分数=schema.score[m, j].astype(float))[['章节', '姓名', '学号', '分数']])
+        if unfin[:, j].any():
+            m = unfin[:, j]
+            unfin_parts.append(base[m].assign(章节=ch, 状态原文=raw_df.loc[m, status_col])[['章节', '姓名', '学号', '状态原文']])
+
+    if low_parts:
+        yield '章节低分名单', pd.concat(low_parts, ignore_index=True)
+    if unfin_parts:
+        yield '章节未完结名单', pd.concat(unfin_parts, ignore_index=True)
 
-        # 夜间活跃检测：若 audit 调用方要求检测且存在小时列
-        if detect_night and '最后活跃小时' in res.columns:
-            start_h, end_h = night_window
-            def is_night(h):
-                try:
-                    h = int(h)
-                    if start_h <= end_h:
-                        return start_h <= h <= end_h
-                    else:
-                        # 跨午夜，例如 start=22 end=3
-                        return h >= start_h or h <= end_h
-                except:
-                    return False
-
-            night_mask = res['最后活跃小时'].apply(is_night)
-            for i in res[night_mask].index:
-                entry = res.at[i, '证据链']
-                if isinstance(entry, list):
-                    if '🌙深夜学习' not in entry:
-                        entry = entry + ['🌙深夜学习']
-                elif isinstance(entry, str):
-                    if entry == '🟢正常':
-                        entry = ['🌙深夜学习']
-                    else:
-                        entry = [entry, '🌙深夜学习']
-                else:
-                    entry = ['🌙深夜学习']
-                res.at[i, '证据链'] = entry
-                prev = res.at[i, '异常原因']
-                if '深夜' not in str(prev):
-                    if isinstance(prev, str) and '符合常态' in prev:
-                        res.at[i, '异常原因'] = '深夜活跃'
-                    else:
-                        res.at[i, '异常原因'] = (str(prev) + ' | 深夜活跃') if prev else '深夜活跃'
-                res.at[i, '状态'] = '异常'
-        
-        return res, None
 
 # ==============================================================================
-# 4. 主程序
+# 5. 主程序
 # ==============================================================================
+# ------------------------------------------------------------------------------
+# 视图缓存与图表构建：图表/汇总表按“数据版本 + 依赖参数”缓存，只在所在视图展示时构建
+# ------------------------------------------------------------------------------
+VIEW_CACHE_MAX = 64  # 每个会话最多保留的图表/汇总表数量
+# 散点图最多发送到浏览器的点数，超过时改画二维密度图（合并年级数据时避免浏览器卡死）
+SCATTER_MAX_POINTS = int(os.environ.get('AUDIT_SCATTER_MAX_POINTS', '20000'))
+DENSITY_BINS = 80  # 密度图每个坐标轴的分箱数
+
+
+def view_cache(name, version, build, *params):
+    """按 (视图名, 数据版本, 参数) 缓存 build() 的结果；命中时不再重新计算。"""
+    cache = st.session_state.setdefault('_view_cache', OrderedDict())
+    key = (name, version) + tuple(params)
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    with stage(f'视图:{name}'):
+        value = build()
+    cache[key] = value
+    while len(cache) > VIEW_CACHE_MAX:
+        cache.popitem(last=False)
+    return value
+
+
+def export_button(label, file_name, key, build, **kwargs):
+    """导出按钮：点击后才调用 build() 生成文件，生成的字节按 key 缓存复用。"""
+    cache = get_export_cache()
+
+    def build_timed():
+        with stage(f'导出:{file_name}'):
+            return build()
+    # 回调在点击时于另一线程执行，bind 让生成耗时记到渲染按钮的那次运行
+    st.download_button(label, bind(lambda: cache.get_or_build(key, build_timed)), file_name, mime=XLSX_MIME, **kwargs)
+
+
+# ------------------------------------------------------------------------------
+# 后台任务：大工作簿的生成交给线程池，侧栏“后台任务”显示进度、可取消，完成后下载
+# ------------------------------------------------------------------------------
+JOB_WORKERS = int(os.environ.get('AUDIT_JOB_WORKERS', '2'))  # 所有会话共用的后台线程数
+JOB_POLL_SECONDS = 1.0  # 有任务运行时侧栏面板的刷新间隔
+JOB_HISTORY = 10        # 每个会话保留的最近任务数
+
+
+@st.cache_resource
+def get_job_runner():
+    return JobRunner(max_workers=JOB_WORKERS, keep=JOB_HISTORY)
+
+
+def job_owner():
+    """当前会话的任务归属标识。"""
+    return st.session_state.setdefault('_job_owner', uuid.uuid4().hex)
+
+
+def job_export(label, file_name, key, build):
+    """耗时导出：点击后在后台生成，期间可继续浏览；生成过的直接给下载按钮。
+
+    ``build(job)`` 在后台线程执行，用 ``job.progress``/``job.track`` 回报进度（同时是取消检查点），
+    生成的字节写入导出缓存，与 ``export_button`` 共用同一键空间。
+    """
+    cache = get_export_cache()
+    data = cache.get(key)
+    if data is not None:
+        st.download_button(label, data, file_name, mime=XLSX_MIME, key=f'job_dl_{file_name}')
+        return
+    runner = get_job_runner()
+    job = runner.find(job_owner(), key)
+    if job is not None and not job.finished:
+        st.button(f'⏳ {file_name} 生成中 {job.fraction:.0%}（见侧栏“后台任务”）', disabled=True, key=f'job_wait_{file_name}')
+        return
+    if st.button(f'{label}（后台生成）', key=f'job_start_{file_name}'):
+        def run(job):
+            with stage(f'导出:{file_name}'):
+                return cache.get_or_build(key, lambda: build(job))
+        # bind 让后台线程中的阶段耗时记到提交任务的那次运行
+        runner.submit(job_owner(), file_name, bind(run), key=key, file_name=file_name)
+        st.rerun()
+
+
+def jobs_panel():
+    """侧栏“后台任务”：进度、取消与下载。有任务运行时按 JOB_POLL_SECONDS 只刷新本面板，全部结束后整页重跑一次。"""
+    runner, owner = get_job_runner(), job_owner()
+    if not runner.jobs(owner):
+        return
+    polling = any(not job.finished for job in runner.jobs(owner))
+
+    @st.fragment(run_every=JOB_POLL_SECONDS if polling else None)
+    def panel():
+        jobs = runner.jobs(owner)
+        active = [job for job in jobs if not job.finished]
+        with st.expander(f'🧵 后台任务（运行中 {len(active)}）' if active else '🧵 后台任务', expanded=bool(active)):
+            for job in jobs:
+                st.markdown(f'**#{job.id} {job.label}** · {job.status} · {job.elapsed:.1f}s')
+                if not job.finished:
+                    st.progress(job.fraction, text=job.message or None)
+                    if st.button('✖️ 取消', key=f'job_cancel_{job.id}', disabled=job.cancel_requested):
+                        runner.cancel(job.id)
+                elif job.error:
+                    st.caption(f'❌ {job.error}')
+                elif job.result is not None:
+                    st.download_button('⬇️ 下载', job.result, job.info.get('file_name', f'job_{job.id}'),
+                                       mime=XLSX_MIME, key=f'job_result_{job.id}')
+            if len(active) < len(jobs) and st.button('🧹 清除已结束任务', key='job_clear'):
+                runner.clear(owner)
+                st.rerun()
+        if polling and not active:
+            st.rerun()  # 任务全部结束：整页重跑，页面上的导出按钮换成下载按钮并停止轮询
+
+    with st.sidebar:
+        panel()
+
+
+def histogram_counts(values, nbins):
+    """服务端等宽分箱，返回 (人数, 箱边界)；空列返回两个空数组。"""
+    v = pd.to_numeric(values, errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    v = v[np.isfinite(v)]
+    if v.size == 0:
+        return np.array([], dtype=int), np.array([])
+    return np.histogram(v, bins=nbins)
+
+
+def fig_histogram(df, col, nbins, color, title=None, mean_label=None):
+    """直方图只把各箱人数发给浏览器，而不是整列原始数据。"""
+    counts, edges = histogram_counts(df[col], nbins)
+    fig = go.Figure(go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=counts, width=np.diff(edges), marker_color=color,
+                           customdata=np.column_stack([edges[:-1], edges[1:]]),
+                           hovertemplate='%{customdata[0]:.4g} ~ %{customdata[1]:.4g}<br>人数 %{y}<extra></extra>'))
+    fig.update_layout(title=title, xaxis_title=col, yaxis_title='人数', bargap=0.05)
+    if mean_label:
+        fig.add_vline(x=df[col].mean(), line_dash="dash", line_color="red", annotation_text=mean_label)
+    return fig
+
+
+def _xy(df, x, y):
+    """两列转为 float 数组，并返回两者都有效的掩码。"""
+    xv = pd.to_numeric(df[x], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    yv = pd.to_numeric(df[y], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    return xv, yv, np.isfinite(xv) & np.isfinite(yv)
+
+
+def flagged_rows(df):
+    """带任一预警标签的行，密度图中只为这些学生保留悬停详情。"""
+    return df['标签码'].to_numpy() != 0 if '标签码' in df.columns else None
+
+
+def fig_density(df, x, y, title, highlight=None, highlight_name='预警学生'):
+    """点数过多时的散点替代：服务端二维分箱成热力图，另叠加 highlight 行的 WebGL 散点（带姓名悬停）。"""
+    xv, yv, ok = _xy(df, x, y)
+    counts, xe, ye = np.histogram2d(xv[ok], yv[ok], bins=DENSITY_BINS)
+    z = counts.T
+    z[z == 0] = np.nan  # 空箱透明
+    fig = go.Figure(go.Heatmap(x=(xe[:-1] + xe[1:]) / 2, y=(ye[:-1] + ye[1:]) / 2, z=z, colorscale='RdPu',
+                               colorbar=dict(title='人数'), name='人数',
+                               hovertemplate=f'{x} %{{x:.3g}}<br>{y} %{{y:.3g}}<br>人数 %{{z}}<extra></extra>'))
+    fig.update_layout(title=f'{title}（{int(ok.sum()):,} 人，密度图）', xaxis_title=x, yaxis_title=y)
+    if highlight is not None:
+        rows = np.flatnonzero(highlight & ok)
+        name = highlight_name
+        if len(rows) > SCATTER_MAX_POINTS:
+            # 等间隔抽样，保证浏览器端点数不超过上限
+            name = f'{highlight_name}（抽样 {SCATTER_MAX_POINTS:,}/{len(rows):,}）'
+            rows = rows[np.linspace(0, len(rows) - 1, SCATTER_MAX_POINTS).astype(int)]
+        if len(rows):
+            text = df['姓名'].to_numpy(dtype=object)[rows]
+            if '主标签' in df.columns:
+                text = np.char.add(np.char.add(text.astype(str), '<br>'),
+                                   df['主标签'].astype(object).fillna('').to_numpy(dtype=str)[rows])
+            fig.add_trace(go.Scattergl(x=xv[rows], y=yv[rows], mode='markers', name=name, text=text,
+                                       marker=dict(size=5, color='#1E3A8A', opacity=0.7),
+                                       hovertemplate=f'%{{text}}<br>{x} %{{x:.3g}}<br>{y} %{{y:.3g}}<extra></extra>'))
+    fig.update_layout(legend=dict(orientation='h', yanchor='bottom', y=1.02))
+    return fig
+
+
+def fig_scatter(df, x, y, title, color=None, highlight=None):
+    """点数不超过 SCATTER_MAX_POINTS 时用 WebGL 散点，否则退化为密度图（只保留 highlight 行的悬停详情）。"""
+    if _xy(df, x, y)[2].sum() > SCATTER_MAX_POINTS:
+        return fig_density(df, x, y, title, flagged_rows(df) if highlight is None else highlight)
+    return px.scatter(df, x=x, y=y, hover_name='姓名', title=title, render_mode='webgl',
+                      color_discrete_sequence=[color] if color else None)
+
+
+def fig_tag_pie(codes):
+    tag_counts = TagCodec.counts(codes)
+    return px.pie(values=tag_counts.values, names=tag_counts.index, hole=0.5, color_discrete_sequence=px.colors.qualitative.Pastel)
+
+
+def fig_correlation(df):
+    valid_cols = [c for c in ['时长', '进度', '成绩', '讨论'] if c in df.columns]
+    if len(valid_cols) < 2:
+        return None
+    return px.imshow(df[valid_cols].corr(), text_auto=True, color_continuous_scale='RdBu_r', aspect="auto")
+
+
+def fit_analysis(df):
+    """时长 vs 成绩 线性拟合散点，及任一指标 |z|>2 的异常值表。"""
+    x, y = df['时长'], df['成绩']
+    mask = x.notna() & y.notna()
+    if mask.sum() <= 2:
+        return None, pd.DataFrame()
+    trend = np.poly1d(np.polyfit(x[mask], y[mask], 1))
+
+    # 简单异常值检测（z-score），不回写到审计表
+    z = {}
+    for col in ['时长', '成绩']:
+        col_std = df[col].std()
+        if col_std and not np.isnan(col_std):
+            z[f'{col}_z'] = (df[col] - df[col].mean()) / col_std
+    z = pd.DataFrame(z, index=df.index)
+    outlier_mask = z.abs().max(axis=1) > 2 if not z.empty else pd.Series(False, index=df.index)
+
+    # 密度图模式下只为异常值保留悬停详情
+    fig_fit = fig_scatter(df, '时长', '成绩', '时长 vs 成绩 散点与线性拟合', '#FFB6C1', highlight=outlier_mask.to_numpy())
+    xs = np.linspace(x.min(), x.max(), 50)
+    fig_fit.add_trace(go.Scatter(x=xs, y=trend(xs), mode='lines', line=dict(color='red', dash='dash'), name='线性拟合'))
+    if z.empty:
+        return fig_fit, pd.DataFrame()
+    outliers = pd.concat([df.loc[outlier_mask, ['姓名', '时长', '成绩']], z[outlier_mask]], axis=1)
+    return fig_fit, outliers.reset_index(drop=True)
+
+
+def top_k(df, col, cols, k=10, ascending=False):
+    """前 k 行：argpartition 选出候选后只对这 k 行排序；并列按原行序，NaN 排最后（与稳定排序的 head(k) 相同）。"""
+    values = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    k = min(k, len(values))
+    if k == 0:
+        return df[cols].iloc[:0].reset_index(drop=True)
+    key = np.where(np.isnan(values), np.inf, values if ascending else -values)
+    kth = np.partition(key, k - 1)[k - 1]
+    below = np.flatnonzero(key < kth)
+    rows = np.concatenate([below, np.flatnonzero(key == kth)[:k - len(below)]])
+    rows = rows[np.lexsort((rows, key[rows]))]
+    return df[cols].iloc[rows].reset_index(drop=True)
+
+
+def fig_clusters(df, y_axis):
+    if _xy(df, '时长', y_axis)[2].sum() <= SCATTER_MAX_POINTS:
+        fig = px.scatter(df, x="时长", y=y_axis, color="学习群体",
+                         hover_name="姓名", size="时长", size_max=15, render_mode='webgl',
+                         color_discrete_map=QUADRANT_COLORS)
+    else:
+        # 点数过多：密度图 + 各群体中心（气泡大小为人数）+ 预警学生
+        fig = fig_density(df, '时长', y_axis, '学习群体分布', flagged_rows(df))
+        centers = df.groupby('学习群体', observed=True).agg(x=('时长', 'mean'), y=(y_axis, 'mean'), n=('姓名', 'size'))
+        size = 12 + 28 * np.sqrt(centers['n'] / centers['n'].max())
+        for (name, row), s in zip(centers.iterrows(), size):
+            fig.add_trace(go.Scatter(x=[row['x']], y=[row['y']], mode='markers', name=str(name),
+                                     marker=dict(size=s, color=QUADRANT_COLORS.get(name), line=dict(width=1, color='white')),
+                                     hovertemplate=f'{name}<br>人数 {int(row["n"])}<br>平均时长 %{{x:.1f}}<br>平均{y_axis} %{{y:.1f}}<extra></extra>'))
+    # 添加平均线辅助线
+    fig.add_hline(y=df[y_axis].mean(), line_dash="dash", line_color="gray", annotation_text="平均产出")
+    fig.add_vline(x=df['时长'].mean(), line_dash="dash", line_color="gray", annotation_text="平均投入")
+    return fig
+
+
+def group_summary(df):
+    keys = ['班级', '学习群体'] if '班级' in df.columns else '学习群体'
+    grp = df.groupby(keys, observed=True).agg(
+        人数=('姓名', 'count'),
+        平均时长=('时长', 'mean'),
+        平均成绩=('成绩', 'mean'),
+        未完结率=('进度', lambda s: (pd.to_numeric(s, errors='coerce').fillna(0) < 99.9).mean()),
+        平均综合得分=('综合得分', 'mean'),
+        平均参与度=('参与度', 'mean')
+    ).reset_index()
+    # 美化数值
+    for col in ['平均时长', '平均成绩', '平均综合得分', '平均参与度']:
+        if col in grp.columns:
+            grp[col] = grp[col].round(1)
+    grp['未完结率'] = (grp['未完结率'] * 100).round(1).astype(str) + '%'
+    return grp
+
+
+def group_stats_sheets(grp, df):
+    """群体统计工作簿的各工作表（生成器）：全班明细在写到时才取视图。"""
+    yield '群体汇总', grp
+    yield '全班明细', TagCodec.export_view(df)
+
+
+def class_summary(df):
+    """多班级对比：各班人数、预警/未完结人数与主要指标均值。"""
+    stats = df.assign(_预警=df['标签码'] != 0, _未完结=Scoring.unfinished_mask(df)).groupby('班级', sort=False, observed=True).agg(
+        人数=('姓名', 'count'),
+        预警人数=('_预警', 'sum'),
+        未完结人数=('_未完结', 'sum'),
+        平均进度=('进度', 'mean'),
+        平均时长=('时长', 'mean'),
+        平均成绩=('成绩', 'mean'),
+        平均综合得分=('综合得分', 'mean'),
+        平均参与度=('参与度', 'mean')
+    )
+    return stats.round(1).reset_index()
+
+
+def hour_activity(df):
+    """按小时的活跃分布：有群体列时返回 (群体×小时 透视表, 热力图)，否则返回 (None, 柱状图)。"""
+    df_hour = df[df['最后活跃小时'] >= 0]
+    if df_hour.empty:
+        return None, None
+    group_col = '学习群体' if '学习群体' in df.columns else ('综合分组' if '综合分组' in df.columns else None)
+    if group_col:
+        pivot = pd.crosstab(df_hour[group_col], df_hour['最后活跃小时']).reindex(columns=list(range(24)), fill_value=0)
+        fig = px.imshow(pivot.values, x=pivot.columns, y=pivot.index, labels={'x':'小时','y':'群体','color':'人数'}, color_continuous_scale='YlOrRd')
+        return pivot, fig
+    counts = df_hour['最后活跃小时'].value_counts().reindex(list(range(24)), fill_value=0)
+    return None, px.bar(x=counts.index, y=counts.values, labels={'x':'小时','y':'活跃人数'}, title='按小时活跃人数')
+
+
+WEEKDAYS = ['周一', '周二', '周三', '周四', '周五', '周六', '周日']
+
+
+def fig_week_hour(matrix, title):
+    return px.imshow(matrix, x=list(range(24)), y=WEEKDAYS, aspect='auto', color_continuous_scale='YlOrRd',
+                     labels={'x': '小时', 'y': '星期', 'color': '事件数'}, title=f'{title}：星期 × 小时 事件数')
+
+
+def week_hour_table(activity, df):
+    """各学习群体的 星期×小时 事件数，行为 (群体, 星期)，列为 0-23 时。"""
+    parts = {}
+    for group, ids in df.groupby('学习群体', observed=True)['学号']:
+        parts[group] = pd.DataFrame(activity.matrix(ids), index=WEEKDAYS, columns=range(24))
+    parts['全部学生'] = pd.DataFrame(activity.matrix(df['学号']), index=WEEKDAYS, columns=range(24))
+    return pd.concat(parts, names=['群体', '星期'])
+
+
+def coverage_analysis(df):
+    """学习路径覆盖：按 进度区间 统计人数与占比。"""
+    cov_grp = df.groupby('进度区间', observed=False).size().reset_index(name='人数')
+    cov_grp['占比'] = (cov_grp['人数'] / cov_grp['人数'].sum() * 100).round(1)
+    # 将区间转换为字符串以避免 Plotly JSON 序列化错误
+    cov_grp['进度区间'] = cov_grp['进度区间'].astype(str)
+    # 使用 Plotly Graph Objects，确保传入的 x/y/text 为原生 Python 列表，避免序列化错误
+    fig_cov = go.Figure(data=[go.Bar(x=cov_grp['进度区间'].tolist(), y=cov_grp['人数'].tolist(),
+                                     text=cov_grp['占比'].astype(str).tolist(), marker_color='#7DD3FC')])
+    fig_cov.update_layout(title='学习路径覆盖：进度区间人数分布', xaxis_title='进度区间', yaxis_title='人数')
+    return cov_grp, fig_cov
+
+
+def fig_chapter_completion(chap_df):
+    # 可序列化的章节完成人数柱状图
+    fig = go.Figure(data=[go.Bar(x=chap_df['章节'].astype(str).tolist(), y=chap_df['完成人数'].fillna(0).astype(int).tolist(), marker_color='#FFB6C1')])
+    fig.update_layout(title='各章节完成人数', xaxis_title='章节', yaxis_title='完成人数')
+    return fig
+
+
+# ------------------------------------------------------------------------------
+# 表头模板：查看自动识别的列映射，修改后固定为团队模板（写入 SCHEMA_PLANS_PATH）
+# ------------------------------------------------------------------------------
+def plan_panel(plans, class_plans):
+    """侧栏“表头模板”：逐个文件查看列映射与解析器，可修改并固定，或取消固定。"""
+    with st.sidebar.expander('🧭 表头模板'):
+        labels = [label for label, _ in class_plans]
+        label = st.selectbox('文件', labels, key='plan_file') if len(labels) > 1 else labels[0]
+        plan = dict(class_plans)[label]
+        state = '📌 团队模板' if plan.pinned else '自动识别（已缓存）'
+        st.caption(f'{plan.label} · 签名 {plan.signature} · {state}'
+                   + (f' · 表头在第 {plan.anchor_row + 1} 行' if plan.anchor_row is not None else ''))
+        with st.form(f'plan_form_{plan.signature}', border=False):
+            options = [None] + plan.columns
+            mapping, parsers = {}, {}
+            for field, name in FIELD_LABELS.items():
+                current = plan.mapping.get(field)
+                mapping[field] = st.selectbox(name, options, index=options.index(current) if current in options else 0,
+                                              format_func=lambda c: '（无）' if c is None else c, key=f'plan_{plan.signature}_{field}')
+                if field in DEFAULT_PARSERS:
+                    choices = list(PARSERS)
+                    parsers[field] = st.selectbox(f'{name} 解析方式', choices, index=choices.index(plan.parsers.get(field, DEFAULT_PARSERS[field])),
+                                                  format_func=lambda p: PARSERS[p][0], key=f'plan_{plan.signature}_{field}_parser')
+            name = st.text_input('模板名称', value=plan.label, key=f'plan_{plan.signature}_label')
+            pin = st.form_submit_button('📌 固定为团队模板' if not plan.pinned else '💾 保存模板修改')
+        if pin:
+            pinned = ParsePlan(plan.signature, plan.columns, {k: v for k, v in mapping.items() if v is not None},
+                               parsers, plan.chapters, plan.anchor_row, label=name.strip() or plan.label,
+                               header_signature=plan.header_signature)
+            try:
+                plans.pin(pinned)
+            except OSError as e:
+                st.warning(f'模板保存失败: {e}')
+            else:
+                st.rerun()
+        if plan.pinned and st.button('取消固定', key='plan_unpin'):
+            plans.unpin(plan.signature)
+            st.rerun()
+        if plans.path:
+            st.caption(f'团队模板保存在 {plans.path}（共 {len(plans.pinned())} 个）；同一表头的导出文件会直接套用。')
+
+
+# ------------------------------------------------------------------------------
+# 历史存档：审计结果按 课程/学期 存入本地 SQLite，跨学期查询学生记录与课程趋势
+# ------------------------------------------------------------------------------
+AUDIT_STORE_PATH = os.environ.get('AUDIT_STORE_PATH', 'audit_history.sqlite')  # 设为空字符串则不存档
+
+
+@st.cache_resource
+def get_audit_store():
+    if not AUDIT_STORE_PATH:
+        return None
+    try:
+        return AuditStore(AUDIT_STORE_PATH)
+    except sqlite3.Error:
+        return None  # 目录不可写等情况下不存档，不影响审计本身
+
+
+def default_term(today=None):
+    """按日期推断学期：2-7 月为春季学期，其余为秋季学期（1 月属于上一年的秋季学期）。"""
+    today = today or datetime.date.today()
+    if 2 <= today.month <= 7:
+        return f'{today.year}春'
+    return f'{today.year if today.month >= 8 else today.year - 1}秋'
+
+
+def archive_panel(store, audit_df, source, default_course, mode, params):
+    """侧栏存档设置：同一课程、学期下每份新数据自动存一次，可按当前参数覆盖；返回快照 id。"""
+    with st.sidebar.expander('🗄️ 历史存档'):
+        course = st.text_input('课程', value=default_course, key='archive_course').strip() or default_course
+        term = st.text_input('学期', value=default_term(), key='archive_term').strip() or default_term()
+        auto = st.checkbox('自动存档（每份数据存一次）', value=True, key='archive_auto')
+        n_flagged = int(TagCodec.at_risk(audit_df['标签码'].to_numpy()).sum())
+        try:
+            snapshot = store.find(course, term, source)
+            if snapshot is None and auto:
+                with stage('历史存档', len(audit_df)):
+                    snapshot = store.save(audit_df, course, term, source, TAG_BITS, n_flagged, mode, params)
+            if st.button('💾 按当前参数更新存档', key='archive_update'):
+                with stage('历史存档', len(audit_df)):
+                    snapshot = store.save(audit_df, course, term, source, TAG_BITS, n_flagged, mode, params, replace=True)
+        except sqlite3.Error as e:
+            st.warning(f'存档失败: {e}')
+            return None
+        st.caption(f'已存为快照 #{snapshot}（{term} · {course}）' if snapshot else '本次结果尚未存档')
+    return snapshot
+
+
+SNAPSHOT_JUMP_PROGRESS = 80.0  # 进度骤增：相邻两次快照间进度增加超过此百分点……
+SNAPSHOT_JUMP_MINUTES = 10.0   # ……而同期新增时长不足此分钟数
+SNAPSHOT_DIFF_DEFAULT = 8      # 快照对比默认选取最近的快照数
+
+
+class SnapshotDiff:
+    """同一课程多次快照按学号对齐（无学号时按姓名），逐项为 学生×快照 矩阵，相邻快照作差得到增量与速率。
+
+    对齐用 ``pd.factorize`` 对全部快照的学生键做一次哈希编码，之后的增量、速率与规则判断都是整矩阵运算；
+    快照数据直接读存档明细，不重新审计。某次快照中缺席的学生对应位置为 NaN，不参与该区间的规则。
+    """
+    FIELDS = {'进度': 'progress', '时长': 'duration', '成绩': 'score'}
+
+    def __init__(self, results, snapshots):
+        snapshots = snapshots.sort_values(['保存时间', '快照']).reset_index(drop=True)
+        self.snapshots = snapshots
+        self.labels = [f"#{i} {term}" for i, term in zip(snapshots['快照'], snapshots['学期'])]
+        self.taken = pd.to_datetime(snapshots['保存时间']).to_numpy()
+        sid = results['student_id'].to_numpy(dtype=object)
+        name = results['name'].to_numpy(dtype=object)
+        # 空白与占位的“未知”（没有学号列时审计表填入）都视为缺学号，改按姓名对齐
+        has_id = ~pd.isna(sid) & ~pd.Series(sid, dtype=object).astype(str).str.strip().isin(MISSING_IDS).to_numpy()
+        if not has_id.all():
+            # 缺学号的行按姓名借用其他快照中的学号；同名对应多个学号时不借用，按姓名单独成行
+            pairs = pd.DataFrame({'name': name[has_id], 'sid': sid[has_id]}).drop_duplicates()
+            pairs = pairs[~pairs['name'].duplicated(keep=False)]
+            borrowed = pd.Series(name[~has_id]).map(pd.Series(pairs['sid'].to_numpy(), index=pairs['name'])).to_numpy(dtype=object)
+            fallback = '姓名:' + pd.Series(name[~has_id], dtype=object).fillna('').astype(str).to_numpy(dtype=object)
+            sid = sid.copy()
+            sid[~has_id] = np.where(pd.isna(borrowed), None, borrowed)
+            key = np.where(has_id, sid, None)
+            key[~has_id] = np.where(pd.isna(borrowed), fallback, borrowed)
+            has_id = ~pd.isna(sid)
+        else:
+            key = sid
+        codes, keys = pd.factorize(key)
+        cols = pd.Index(snapshots['快照']).get_indexer(results['snapshot_id'])
+        shape = (len(keys), len(snapshots))
+        self.present = np.zeros(shape, dtype=bool)
+        self.present[codes, cols] = True
+        self.values = {}
+        for label, col in self.FIELDS.items():
+            mat = np.full(shape, np.nan)
+            mat[codes, cols] = pd.to_numeric(results[col], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+            self.values[label] = mat
+        # 每个学生取最近一次快照中的学号与姓名（同一快照内重复的学生以后一行为准）
+        order = np.argsort(cols, kind='stable')
+        self.ids = np.full(len(keys), None, dtype=object)
+        self.names = np.full(len(keys), None, dtype=object)
+        self.ids[codes[order]] = np.where(has_id, sid, None)[order]
+        self.names[codes[order]] = name[order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def deltas(self, field):
+        """相邻快照的增量矩阵，形状为 (学生数, 快照数 - 1)。"""
+        return np.diff(self.values[field], axis=1)
+
+    def days(self):
+        """相邻快照间隔的天数（不足 1 小时按 1 小时计，避免速率除零）。"""
+        return np.maximum(np.diff(self.taken) / np.timedelta64(1, 'D'), 1 / 24)
+
+    def rules(self, jump_progress=SNAPSHOT_JUMP_PROGRESS, jump_minutes=SNAPSHOT_JUMP_MINUTES):
+        """规则名 -> (学生数, 快照数 - 1) 布尔矩阵。"""
+        prog = self.values['进度']
+        d_prog, d_time = self.deltas('进度'), self.deltas('时长')
+        return {
+            '⏫进度骤增': (d_prog > jump_progress) & (d_time < jump_minutes),
+            '🎯0→100%': (prog[:, :-1] <= 0) & (prog[:, 1:] >= 99.9),
+            '⏪进度回退': d_prog < -1,
+            '⏪时长回退': d_time < -1,
+        }
+
+    def events(self, jump_progress=SNAPSHOT_JUMP_PROGRESS, jump_minutes=SNAPSHOT_JUMP_MINUTES):
+        """触发任一增量规则的 (学生, 区间) 明细，按进度增量从大到小。"""
+        rules = self.rules(jump_progress, jump_minutes)
+        rows, cols = np.nonzero(np.logical_or.reduce(list(rules.values())))
+        prog = self.values['进度']
+        d_prog = self.deltas('进度')[rows, cols]
+        days = self.days()[cols]
+        hit = pd.Series('', index=range(len(rows)), dtype=object)
+        for name, mask in rules.items():
+            hit += np.where(mask[rows, cols], name + ' ', '')
+        labels = np.asarray(self.labels, dtype=object)
+        out = pd.DataFrame({
+            '学号': self.ids[rows], '姓名': self.names[rows],
+            '区间': labels[cols] + ' → ' + labels[cols + 1], '间隔(天)': days.round(1),
+            '进度(前)': prog[rows, cols], '进度(后)': prog[rows, cols + 1], 'Δ进度': d_prog,
+            'Δ时长(分钟)': self.deltas('时长')[rows, cols], 'Δ成绩': self.deltas('成绩')[rows, cols],
+            '进度速率(%/天)': (d_prog / days).round(1), '触发规则': hit.str.strip().to_numpy(),
+        })
+        out = out.round({'进度(前)': 1, '进度(后)': 1, 'Δ进度': 1, 'Δ时长(分钟)': 1, 'Δ成绩': 1})
+        return out.sort_values('Δ进度', ascending=False, kind='stable').reset_index(drop=True)
+
+    def rule_counts(self, jump_progress=SNAPSHOT_JUMP_PROGRESS, jump_minutes=SNAPSHOT_JUMP_MINUTES):
+        """各区间触发每条规则的人数，行为区间、列为规则。"""
+        rules = self.rules(jump_progress, jump_minutes)
+        index = [f'{a} → {b}' for a, b in zip(self.labels[:-1], self.labels[1:])]
+        return pd.DataFrame({name: mask.sum(axis=0) for name, mask in rules.items()}, index=index)
+
+    def summary(self):
+        """每个学生从首次到最近一次出现的累计变化。"""
+        m = self.present.shape[1]
+        first = self.present.argmax(axis=1)
+        last = m - 1 - self.present[:, ::-1].argmax(axis=1)
+        rows = np.arange(len(self))
+        span = np.maximum((self.taken[last] - self.taken[first]) / np.timedelta64(1, 'D'), 1 / 24)
+        prog, time_ = self.values['进度'], self.values['时长']
+        d_prog = prog[rows, last] - prog[rows, first]
+        return pd.DataFrame({
+            '学号': self.ids, '姓名': self.names, '快照数': self.present.sum(axis=1),
+            '首次进度': prog[rows, first], '最近进度': prog[rows, last], '累计Δ进度': d_prog,
+            '累计Δ时长(分钟)': time_[rows, last] - time_[rows, first],
+            '平均进度速率(%/天)': np.where(last > first, d_prog / span, np.nan),
+        }).round(1)
+
+
+# 快照只增删不修改（覆盖存档会换新 id），读出的明细与对齐结果都可按 id 缓存：每周新增一次快照时只读新的那一次
+@st.cache_data(max_entries=64, show_spinner=False)
+def snapshot_results(snapshot_id):
+    with stage('读取快照', 1):
+        return get_audit_store().results([snapshot_id])
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def snapshot_diff(snapshot_ids):
+    snaps = get_audit_store().snapshots()
+    results = pd.concat([snapshot_results(i) for i in snapshot_ids], ignore_index=True)
+    with stage('快照对比', len(results)):
+        return SnapshotDiff(results, snaps[snaps['快照'].isin(snapshot_ids)])
+
+
+def history_view(store):
+    """历史档案页：课程趋势、学生历次记录、按标签查询与快照管理，全部直接查询存档库。"""
+    st.markdown('### 🗄️ 历史档案')
+    courses = store.courses()
+    if not courses:
+        st.info('尚无存档。上传数据后会按侧栏“🗄️ 历史存档”中的课程与学期自动保存。')
+        return
+    course = st.selectbox('课程', courses, key='history_course')
+
+    st.markdown('#### 📈 课程趋势')
+    trend = store.course_trend(course)
+    st.dataframe(trend, use_container_width=True, hide_index=True)
+    if len(trend) > 1:
+        fig = px.line(trend, x='保存时间', y=['预警率(%)', '平均综合得分'], markers=True, hover_data=['学期', '人数'])
+        fig.update_layout(yaxis_title='', legend_title='')
+        st.plotly_chart(fig, use_container_width=True)
+
+    st.markdown('#### 👤 学生历次记录')
+    student_id = st.text_input('学号（没有学号的存档按姓名查找）', key='history_student').strip()
+    if student_id:
+        hist = store.student_history(student_id, name=student_id)
+        if hist.empty:
+            st.info('存档中没有该学生的记录。')
+        else:
+            st.dataframe(hist, use_container_width=True, hide_index=True)
+
+    st.markdown('#### 🏷️ 按标签查询')
+    col_tag, col_term = st.columns(2)
+    tag = col_tag.selectbox('标签', TAG_REGISTRY, key='history_tag')
+    terms = ['全部学期'] + sorted(store.snapshots(course)['学期'].unique().tolist())
+    term = col_term.selectbox('学期', terms, key='history_term')
+    hits = store.tagged(tag, course, None if term == '全部学期' else term)
+    st.caption(f'共 {len(hits)} 条记录。')
+    st.dataframe(hits, use_container_width=True, hide_index=True)
+
+    st.markdown('#### 🔀 快照对比')
+    snaps = store.snapshots(course)
+    if len(snaps) < 2:
+        st.caption('同一课程至少有两次快照（例如每周导出一次）后可对比各学生的进度与时长变化。')
+    else:
+        options = snaps['快照'].tolist()
+        labels = dict(zip(options, '#' + snaps['快照'].astype(str) + ' ' + snaps['学期'] + ' · ' + snaps['保存时间']))
+        chosen = st.multiselect('参与对比的快照（按保存时间排序）', options, default=options[-SNAPSHOT_DIFF_DEFAULT:],
+                                format_func=labels.get, key='diff_snapshots')
+        col_prog, col_min = st.columns(2)
+        jump_progress = col_prog.number_input('进度骤增阈值（百分点）', 0.0, 100.0, SNAPSHOT_JUMP_PROGRESS, 5.0, key='diff_jump_progress')
+        jump_minutes = col_min.number_input('同期新增时长低于（分钟）', 0.0, 600.0, SNAPSHOT_JUMP_MINUTES, 5.0, key='diff_jump_minutes')
+        if len(chosen) < 2:
+            st.info('请至少选择两次快照。')
+        else:
+            diff = snapshot_diff(tuple(sorted(chosen)))
+            events = diff.events(jump_progress, jump_minutes)
+            st.caption(f'{len(chosen)} 次快照共对齐 {len(diff)} 名学生（按学号，无学号时按姓名），{len(events[["学号", "姓名"]].drop_duplicates())} 名学生触发增量规则。')
+            st.dataframe(diff.rule_counts(jump_progress, jump_minutes), use_container_width=True)
+            st.dataframe(events, use_container_width=True, hide_index=True)
+            summary = diff.summary()
+            st.dataframe(summary.sort_values('累计Δ进度', ascending=False), use_container_width=True, hide_index=True)
+            export_button('📥 导出快照对比', '快照对比.xlsx', ('快照对比', tuple(sorted(chosen)), jump_progress, jump_minutes),
+                          lambda: excel_bytes([('增量预警', events), ('累计变化', summary)]))
+
+    with st.expander('🗂️ 快照管理'):
+        snaps = store.snapshots()
+        st.dataframe(snaps, use_container_width=True, hide_index=True)
+        target = st.selectbox('删除快照', snaps['快照'].tolist(), key='history_delete',
+                              format_func=lambda i: f"#{i} " + ' · '.join(snaps.loc[snaps['快照'] == i, ['学期', '课程', '保存时间']].iloc[0]))
+        if st.button('🗑️ 删除所选快照', key='history_delete_btn'):
+            store.delete(target)
+            st.rerun()
+
+
+# ------------------------------------------------------------------------------
+# 运行诊断：分阶段耗时 / 行数 / 内存峰值，可导出 JSON trace 与 cProfile
+# ------------------------------------------------------------------------------
+PROFILE_HISTORY = 5  # 面板保留的最近运行数
+
+
+def diagnostics_panel(profiler):
+    """侧栏底部的“运行诊断”面板；勾选的开关在下一次重跑开始时生效。"""
+    with st.sidebar.expander('🩺 运行诊断', expanded=profiler is not None):
+        st.checkbox('记录分阶段耗时', key='profile_on', help='记录加载、列映射、解析、规则、聚类、评分、各图表与导出的耗时')
+        st.checkbox('记录内存峰值 (tracemalloc，会明显变慢)', key='profile_memory')
+        st.checkbox('记录 cProfile', key='profile_cprofile')
+        history = st.session_state.setdefault('_profiles', deque(maxlen=PROFILE_HISTORY))
+        if profiler is not None:
+            history.append(profiler)
+        if not history:
+            return
+        runs = list(reversed(history))
+        idx = st.selectbox('运行记录', range(len(runs)), format_func=lambda i: runs[i].label)
+        prof = runs[idx]
+        table = pd.DataFrame(prof.table(), columns=['阶段', '耗时(s)', '行数', '内存峰值(MB)', '层级', '线程', '开始(s)'])
+        if table.empty:
+            st.caption('本次运行没有需要重新计算的阶段（全部命中缓存）。')
+        else:
+            # 按嵌套层级缩进阶段名
+            table['阶段'] = ['\u3000' * d + name for d, name in zip(table['层级'], table['阶段'])]
+            table['行数'] = table['行数'].astype('Int64')
+            st.dataframe(table.drop(columns=['层级']).round(4), hide_index=True, use_container_width=True)
+        st.caption('命中缓存的阶段不会出现；导出在点击时生成，记在渲染该按钮的那次运行里。')
+        stamp = f"{prof.started_at:%Y%m%d_%H%M%S}"
+        st.download_button('⬇️ 导出 JSON trace', prof.trace_json(), f'trace_{stamp}.json', mime='application/json')
+        if prof.has_cprofile:
+            st.download_button('⬇️ 导出 cProfile (.prof)', prof.pstats_bytes(), f'profile_{stamp}.prof')
+            st.code(prof.pstats_text(limit=20), language=None)
+        elif prof.cprofile_error:
+            st.warning(f'cProfile 未启用: {prof.cprofile_error}')
+
+
 def main():
+    setup_page()
+    # 勾选状态在重跑开始前已写入 session_state，面板本身在侧栏最后渲染
+    profiler = None
+    if st.session_state.get('profile_on'):
+        profiler = StageProfiler(trace_memory=st.session_state.get('profile_memory', False),
+                                 cprofile=st.session_state.get('profile_cprofile', False))
+    with activate(profiler):
+        render_app()
+    jobs_panel()
+    diagnostics_panel(profiler)
+
+
+def render_app():
     st.sidebar.markdown("""
         <div style="text-align: center; padding: 20px;">
             <h1 style="font-size: 60px; margin:0;">🌸</h1>
@@ -320,58 +2659,65 @@ def main():
     
     mode_label = st.sidebar.radio("选择平台", ["学习通 (LMS)", "头歌 (EduCoder)"], label_visibility="collapsed")
     mode = "LMS" if "学习通" in mode_label else "HG"
-    file = st.sidebar.file_uploader("📂 上传原始数据", type=['xlsx', 'csv'])
+    files = st.sidebar.file_uploader("📂 上传原始数据", type=['xlsx', 'csv'], accept_multiple_files=True,
+                                     help="可同时选择多个文件，每个文件视为一个班级")
 
-    if file:
+    if files:
         with st.spinner("🤖 AI 正在挖掘数据价值..."):
-            raw_df, err = UniversalLoader.load_file(file)
-            if err:
-                st.error(f"❌ {err}")
+            # 多个文件并行解析；已解析过的文件按内容哈希直接命中缓存
+            plans = get_plan_registry()
+            classes, class_plans = [], []
+            for label, (file, key, df, err) in zip(class_labels([f.name for f in files]),
+                                                  UniversalLoader.load_files(files, cache=get_parse_cache(), plans=plans)):
+                if err:
+                    st.error(f"❌ {file.name}: {err}")
+                    continue
+                for sheet, key_label, n_cols, problem in df.attrs.get('sheet_joins', ()):
+                    if problem:
+                        st.warning(f"⚠️ {file.name} · 工作表「{sheet}」未拼接：{problem}")
+                    else:
+                        st.sidebar.caption(f"🔗 {file.name}：工作表「{sheet}」按{key_label}拼接 {n_cols} 列")
+                plan = plans.plan_for(df.columns)
+                if plan.pinned:
+                    key = data_version(key, plan.version)  # 团队模板改动后重新解析，缓存按新键区分
+                classes.append((label, key, df))
+                class_plans.append((label, plan))
+            if not classes:
                 return
+            plan_panel(plans, class_plans)
+            file_key = classes[0][1] if len(classes) == 1 else data_version(*[key for _, key, _ in classes])
 
             # 侧边栏：深夜活跃检测设置（教师可配置）
             st.sidebar.markdown('**深夜活跃检测**')
             detect_night = st.sidebar.checkbox('启用深夜活跃可疑检测', value=True, key='detect_night')
             night_start = st.sidebar.slider('深夜开始小时', 0, 23, 0, key='night_start')
             night_end = st.sidebar.slider('深夜结束小时', 0, 23, 5, key='night_end')
+            log_file = st.sidebar.file_uploader('📒 活动日志（可选）', type=['csv', 'xlsx'], key='activity_log',
+                                                help='每行一次学习事件，需含学号与时间列；上传后深夜检测按深夜事件占比判断')
+            activity, night_share = None, None
+            if log_file is not None:
+                activity, log_err = get_activity_profile(ActivityLog.content_key(log_file), log_file)
+                if log_err:
+                    st.sidebar.error(f"❌ {log_err}")
+                else:
+                    night_share = st.sidebar.slider('深夜事件占比阈值 (%)', 5, 100, 30, 5, key='night_share',
+                                                    help=f'事件数不少于 {ACTIVITY_MIN_EVENTS} 的学生，深夜时段事件占比达到该值时标记')
+                    st.sidebar.caption(f"日志 {activity.events:,} 条事件 · {len(activity.ids):,} 个学号"
+                                       + (f" · 跳过 {activity.skipped:,} 行" if activity.skipped else ''))
+
+            # 侧边栏：学习群体划分方式
+            st.sidebar.markdown('**学习群体划分**')
+            cluster_label = st.sidebar.radio('划分方式', ['四象限 (投入-产出)', 'K-Means 聚类'], key='cluster_method')
+            cluster_method = "kmeans" if "K-Means" in cluster_label else "quadrant"
+            n_clusters = st.sidebar.slider('聚类数 k', 2, 8, 4, key='n_clusters') if cluster_method == "kmeans" else 4
+
+            # 侧边栏：多班级统计口径（基准时长、群体均值、综合得分归一化按班级分别计算或全部合并计算）
+            pooled, class_view = False, '全部班级'
+            if len(classes) > 1:
+                st.sidebar.markdown('**多班级统计**')
+                pooled = '合并' in st.sidebar.radio('统计口径', ['按班级分别统计', '全部班级合并统计'], key='class_scope')
+                class_view = st.sidebar.selectbox('查看班级', ['全部班级'] + [label for label, _, _ in classes], key='class_view')
 
-            engine = AuditCore(raw_df)
-            audit_df, logic_err = engine.execute_audit(mode, detect_night=detect_night, night_window=(night_start, night_end))
-            
-            if audit_df is None or audit_df.empty:
-                st.warning("⚠️ 数据解析为空，请检查文件。")
-                return
-
-            # 将“未完成人群”合并到“不健康/异常人群”中：
-            # 对进度 < 99.9 的记录，追加证据标签并标记为异常，便于合并统计
-            unfinished_mask = pd.to_numeric(audit_df['进度'], errors='coerce').fillna(0) < 99.9
-            if unfinished_mask.any():
-                for i in audit_df[unfinished_mask].index:
-                    entry = audit_df.at[i, '证据链']
-                    # 规范化并追加标签
-                    if isinstance(entry, list):
-                        if '⚠️未完结' not in entry:
-                            entry = entry + ['⚠️未完结']
-                    elif isinstance(entry, str):
-                        if entry == '🟢正常':
-                            entry = ['⚠️未完结']
-                        else:
-                            entry = [entry, '⚠️未完结']
-                    else:
-                        entry = ['⚠️未完结']
-                    audit_df.at[i, '证据链'] = entry
-                    prev = audit_df.at[i, '异常原因']
-                    if '未完结' not in str(prev):
-                        if isinstance(prev, str) and '符合常态' in prev:
-                            audit_df.at[i, '异常原因'] = '未完结'
-                        else:
-                            audit_df.at[i, '异常原因'] = (str(prev) + ' | 未完结') if prev else '未完结'
-                    audit_df.at[i, '状态'] = '异常'
-
-            risk_count = len(audit_df[audit_df['状态']=='异常'])
-            # 修复未完结统计逻辑（保持未完结下载视图用）
-            unfinished_count = len(audit_df[pd.to_numeric(audit_df['进度'], errors='coerce').fillna(0) < 99.9])
-            
             # 侧边栏：综合得分权重（可调）
             st.sidebar.markdown("---")
             st.sidebar.markdown("**综合得分权重（归一化后应用）**")
@@ -379,13 +2725,6 @@ def main():
             w_score = st.sidebar.slider('成绩 权重', 0.0, 1.0, 0.3, 0.05, key='w_score')
             w_time = st.sidebar.slider('时长 权重', 0.0, 1.0, 0.2, 0.05, key='w_time')
             w_discuss = st.sidebar.slider('讨论 权重', 0.0, 1.0, 0.1, 0.05, key='w_discuss')
-            # 归一化权重
-            total_w = (w_prog + w_score + w_time + w_discuss)
-            if total_w == 0:
-                w_prog = w_score = w_time = w_discuss = 0.25
-                total_w = 1.0
-            w_prog /= total_w; w_score /= total_w; w_time /= total_w; w_discuss /= total_w
-
             # 权重配置管理（导出/导入）
             st.sidebar.markdown('**权重配置管理**')
             cfg = {
@@ -406,86 +2745,83 @@ def main():
                 except Exception as e:
                     st.sidebar.error(f'配置加载失败: {e}')
 
-            # 计算综合得分（0-100），使用 min-max 归一化（稳健处理常量列）
-            def safe_minmax(s):
-                s = pd.to_numeric(s, errors='coerce').fillna(0).astype(float)
-                mn = s.min(); mx = s.max()
-                if pd.isna(mn) or pd.isna(mx) or mx == mn:
-                    return pd.Series(0.5, index=s.index)
-                return (s - mn) / (mx - mn)
-
-            prog_norm = audit_df['进度'].clip(0,100) / 100.0 if '进度' in audit_df.columns else pd.Series(0.0, index=audit_df.index)
-            time_norm = safe_minmax(audit_df['时长']) if '时长' in audit_df.columns else pd.Series(0.0, index=audit_df.index)
-            score_norm = safe_minmax(audit_df['成绩']) if '成绩' in audit_df.columns else pd.Series(0.0, index=audit_df.index)
-            discuss_norm = safe_minmax(audit_df['讨论']) if '讨论' in audit_df.columns else pd.Series(0.0, index=audit_df.index)
-
-            audit_df['综合得分'] = (prog_norm * w_prog + score_norm * w_score + time_norm * w_time + discuss_norm * w_discuss) * 100
-            # 计算班内百分位与分组（用于排名/分层）
-            if '综合得分' in audit_df.columns:
-                audit_df['综合百分位'] = audit_df['综合得分'].rank(pct=True).mul(100)
-                n_bins = st.sidebar.slider('分层组数 (用于排名，越大越细)', 2, 10, 4, key='n_bins')
-                bin_idx = (audit_df['综合百分位'] * n_bins / 100.0).apply(np.ceil).clip(1, n_bins).astype(int)
-                labels = []
-                for i in range(1, n_bins+1):
-                    lo = int((i-1) * 100 / n_bins)
-                    hi = int(i * 100 / n_bins)
-                    labels.append(f"{lo}-{hi}%")
-                audit_df['综合分组'] = bin_idx.apply(lambda x: labels[x-1])
+            n_bins = st.sidebar.slider('分层组数 (用于排名，越大越细)', 2, 10, 4, key='n_bins')
 
             # 参与度权重（老师可调）
             st.sidebar.markdown('**学习参与度权重（讨论 / 时长稳定 / 完整率）**')
             p_w_discuss = st.sidebar.slider('讨论 权重', 0.0, 1.0, 0.4, 0.05, key='p_w_discuss')
             p_w_stability = st.sidebar.slider('时长稳定性 权重', 0.0, 1.0, 0.3, 0.05, key='p_w_stability')
             p_w_complete = st.sidebar.slider('提交完整率(进度) 权重', 0.0, 1.0, 0.3, 0.05, key='p_w_complete')
-            p_total = (p_w_discuss + p_w_stability + p_w_complete)
-            if p_total == 0:
-                p_w_discuss = p_w_stability = p_w_complete = 1/3
-                p_total = 1.0
-            p_w_discuss /= p_total; p_w_stability /= p_total; p_w_complete /= p_total
-
-            # 计算参与度：讨论频次（discuss_norm） + 时长稳定性 + 提交完整率（prog_norm）
-            # discuss_norm 已计算为 discuss_norm
-            discuss_norm = discuss_norm if 'discuss_norm' in locals() else (safe_minmax(audit_df['讨论']) if '讨论' in audit_df.columns else pd.Series(0.0, index=audit_df.index))
-            # 时长稳定性：接近中位时长视为稳定
-            if '时长' in audit_df.columns:
-                time_norm_local = time_norm if 'time_norm' in locals() else safe_minmax(audit_df['时长'])
-                median_t = time_norm_local.median()
-                stability_raw = 1 - (time_norm_local - median_t).abs()
-                if stability_raw.max() == stability_raw.min():
-                    stability_norm = pd.Series(0.5, index=stability_raw.index)
-                else:
-                    stability_norm = (stability_raw - stability_raw.min()) / (stability_raw.max() - stability_raw.min())
-            else:
-                stability_norm = pd.Series(0.0, index=audit_df.index)
-
-            prog_norm_local = prog_norm if 'prog_norm' in locals() else (audit_df['进度'].clip(0,100) / 100.0 if '进度' in audit_df.columns else pd.Series(0.0, index=audit_df.index))
-
-            audit_df['参与度'] = (discuss_norm * p_w_discuss + stability_norm * p_w_stability + prog_norm_local * p_w_complete) * 100
 
             # 参与度阈值（低参与标记）
             low_part_thr = st.sidebar.slider('低参与度阈值', 0, 100, 40, key='low_part_thr')
-            low_part_mask = pd.to_numeric(audit_df['参与度'], errors='coerce').fillna(0) < low_part_thr
-            if low_part_mask.any():
-                def add_low_part_tag(x):
-                    if isinstance(x, list):
-                        return x + ['🟠参与度低'] if '🟠参与度低' not in x else x
-                    if isinstance(x, str):
-                        if x == '🟢正常':
-                            return ['🟠参与度低']
-                        return [x, '🟠参与度低']
-                    return ['🟠参与度低']
-
-                audit_df.loc[low_part_mask, '证据链'] = audit_df.loc[low_part_mask, '证据链'].apply(add_low_part_tag)
-                audit_df.loc[low_part_mask, '异常原因'] = audit_df.loc[low_part_mask, '异常原因'].apply(lambda x: (str(x) + ' | 参与度低') if '参与度低' not in str(x) else x)
-                audit_df.loc[low_part_mask, '状态'] = '异常'
+
+            # 分阶段计算：每个阶段只在其上游结果或所依赖的参数变化时重算
+            pipeline = AuditPipeline(classes, {
+                'pooled': pooled, 'mode': mode, 'cluster_method': cluster_method, 'n_clusters': n_clusters,
+                'weights': (('w_prog', w_prog), ('w_score', w_score), ('w_time', w_time), ('w_discuss', w_discuss)),
+                'part_weights': (('p_w_discuss', p_w_discuss), ('p_w_stability', p_w_stability), ('p_w_complete', p_w_complete)),
+                'n_bins': n_bins, 'detect_night': detect_night, 'night_window': (night_start, night_end),
+                'low_part_thr': low_part_thr, 'night_share': night_share,
+            }, st.session_state.setdefault('_pipeline_memo', {}), activity)
+            audit_df, class_errs = pipeline.run()
+            for label, e in class_errs.items():
+                st.error(f"❌ {label}: {e}")
+            if audit_df is None or audit_df.empty:
+                st.warning("⚠️ 数据解析为空，请检查文件。")
+                return
+            classes = [c for c in classes if c[0] not in class_errs]
+            # 历史存档：保存的是全部班级的结果（查看单个班级之前）
+            store = get_audit_store()
+            if store is not None:
+                labels = [label for label, _, _ in classes]
+                archive_panel(store, audit_df, file_key, os.path.commonprefix(labels).strip(' _-') or labels[0], mode,
+                              {k: v for k, v in pipeline.params.items() if k != 'files'})
+
+            # 只查看单个班级时，审计表与对应的原始表一起筛选（两者行序一致）
+            if class_view != '全部班级':
+                keep = (audit_df['班级'] == class_view).to_numpy()
+                audit_df = audit_df[keep].reset_index(drop=True)
+                classes = [c for c in classes if c[0] == class_view]
+            # 图表缓存版本：审计版本（规则与群体）与评分版本（含全部阶段），都区分所查看的班级
+            audit_ver = data_version(pipeline.version('audit'), class_view)
+            score_ver = data_version(pipeline.version('tagging'), pipeline.version('ranking'), class_view)
+            # 预警人数不计“参与度低”与“高效可疑”（与未完结、深夜等合并统计）
+            risk_mask = TagCodec.at_risk(audit_df['标签码'].to_numpy())
+            unfinished_mask = TagCodec.has(audit_df['标签码'], '⚠️未完结')
+
+            # 学习效率与“高效可疑”标记在进入各分栏之前算好，统计与导出都带上这两项
+            eff_index = eff_thr = None
+            if '时长' in audit_df.columns and '进度' in audit_df.columns:
+                # 计算效率（单位：进度百分比/分钟）
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    eff = audit_df['进度'] / audit_df['时长'].replace(0, np.nan)
+                audit_df['效率(进度/分)'] = eff.fillna(0)
+                # 效率列按数据版本建一次有序索引，拖动阈值时只做二分查找
+                eff_index = view_cache('eff_index', audit_ver, lambda: SortedIndex(audit_df['效率(进度/分)']))
+                eff_max = eff_index.max() if eff_index.n_valid else 100.0
+                # 阈值滑块在“深度数据挖掘”页，按数据版本记住老师上次的取值
+                eff_thr = st.session_state.setdefault('_eff_thr', {}).get(
+                    audit_ver, eff_index.quantile(0.9) if eff_index.n_valid else eff_max * 0.5)
+                sus_rows = view_cache('eff_sus', audit_ver, lambda: eff_index.rows_above(eff_thr), eff_thr)
+                TagCodec.add(audit_df, sus_rows, '🚨高效可疑')
+                score_ver = data_version(score_ver, eff_thr)
+
+            risk_count = int(risk_mask.sum())
+            # 修复未完结统计逻辑（保持未完结下载视图用）
+            unfinished_count = int(unfinished_mask.sum())
+            # 章节统计使用的原始表：多个班级时按上传顺序拼接
+            chapter_key = data_version(file_key, class_view) if len(files) > 1 else file_key
+            def combined_raw():
+                return classes[0][2] if len(classes) == 1 else pd.concat([raw for _, _, raw in classes], ignore_index=True)
 
             nav = st.sidebar.radio("功能导航", [
                 "📊 全局数据看板",
                 "🔮 深度数据挖掘 (New!)",
                 f"🚨 异常数据分栏 ({risk_count})",
                 f"📉 未完结名单统计 ({unfinished_count})",
-                "📋 原始数据表"
-            ])
+                "📋 原始数据表",
+            ] + (["🗄️ 历史档案"] if store is not None else []))
 
             # === VIEW 1: Dashboard ===
             if "全局数据看板" in nav:
@@ -502,26 +2838,23 @@ def main():
                     col_chart1, col_chart2 = st.columns(2)
                     with col_chart1:
                         st.markdown('<div class="main-card"><h5>🎨 证据画像分布</h5>', unsafe_allow_html=True)
-                        tags_flat = []
-                        for entry in audit_df['证据链']:
-                            if isinstance(entry, list):
-                                tags_flat.extend([t for t in entry if t != '🟢正常'])
-                            elif isinstance(entry, str):
-                                if entry != '🟢正常':
-                                    tags_flat.append(entry)
-                        if not tags_flat:
-                            tags_flat = ["🟢正常"]
-                        tag_counts = pd.Series(tags_flat).value_counts()
-                        fig = px.pie(values=tag_counts.values, names=tag_counts.index, hole=0.5, color_discrete_sequence=px.colors.qualitative.Pastel)
+                        fig = view_cache('tag_pie', score_ver, lambda: fig_tag_pie(audit_df['标签码']))
                         st.plotly_chart(fig, use_container_width=True)
                         st.markdown('</div>', unsafe_allow_html=True)
                     
                     with col_chart2:
                         st.markdown('<div class="main-card"><h5>⏱️ 学习时长分布</h5>', unsafe_allow_html=True)
-                        fig_hist = px.histogram(audit_df, x="时长", nbins=20, color_discrete_sequence=['#FFB6C1'])
-                        fig_hist.add_vline(x=audit_df['时长'].mean(), line_dash="dash", line_color="red", annotation_text="平均时长")
+                        fig_hist = view_cache('duration_hist', audit_ver, lambda: fig_histogram(audit_df, '时长', 20, '#FFB6C1', mean_label='平均时长'))
                         st.plotly_chart(fig_hist, use_container_width=True)
                         st.markdown('</div>', unsafe_allow_html=True)
+
+                    # 多班级：各班对比
+                    if '班级' in audit_df.columns and audit_df['班级'].nunique() > 1:
+                        st.markdown('#### 🏫 班级对比')
+                        cls = view_cache('class_summary', score_ver, lambda: class_summary(audit_df))
+                        st.dataframe(cls, use_container_width=True, hide_index=True)
+                        export_button('📥 导出班级对比', '班级对比.xlsx', ('班级对比', score_ver),
+                                      lambda: excel_bytes([('班级对比', cls), ('全班明细', TagCodec.export_view(audit_df))]))
                 except Exception as e: st.error(f"渲染错误: {e}")
 
             # === VIEW 2: 深度数据挖掘 (New!) ===
@@ -529,24 +2862,22 @@ def main():
                 st.markdown("### 🔮 深度数据价值挖掘")
                 st.info("💡 运用统计学方法，发现数据背后的隐藏规律。")
                 
-                tab1, tab2, tab3 = st.tabs(["🔥 关联性分析", "🧩 智能聚类画像", "📈 时序热力图"])
+                # 只计算当前选中的模块；各图表按数据版本缓存，调整某个模块的参数不会重建其他模块
+                section = st.radio("分析模块", ["🔥 关联性分析", "🧩 智能聚类画像", "📈 时序热力图"], horizontal=True, key='mining_section')
                 
-                with tab1:
+                if "关联性分析" in section:
                     st.markdown("#### 核心指标相关性热力图")
                     st.caption("颜色越红/越深，代表两个指标之间的关系越紧密（例如：投入时长是否真正带来了高分？）")
                     
                     # 计算相关性矩阵
-                    corr_cols = ['时长', '进度', '成绩', '讨论']
-                    valid_cols = [c for c in corr_cols if c in audit_df.columns]
-                    if len(valid_cols) > 1:
-                        corr_matrix = audit_df[valid_cols].corr()
-                        fig_corr = px.imshow(corr_matrix, text_auto=True, color_continuous_scale='RdBu_r', aspect="auto")
+                    fig_corr = view_cache('corr', audit_ver, lambda: fig_correlation(audit_df))
+                    if fig_corr is not None:
                         st.plotly_chart(fig_corr, use_container_width=True)
                     
                     st.markdown("#### 📈 成绩正态分布检测")
                     col_d1, col_d2 = st.columns(2)
                     with col_d1:
-                        fig_dist = px.histogram(audit_df, x="成绩", nbins=15, title="成绩分布图", color_discrete_sequence=['#87CEFA'])
+                        fig_dist = view_cache('score_hist', audit_ver, lambda: fig_histogram(audit_df, '成绩', 15, '#87CEFA', title="成绩分布图"))
                         st.plotly_chart(fig_dist, use_container_width=True)
                     with col_d2:
                         st.markdown("""
@@ -558,137 +2889,79 @@ def main():
 
                     # --- 时长 vs 成绩 回归拟合与异常值检测 ---
                     if '时长' in audit_df.columns and '成绩' in audit_df.columns:
-                        x = audit_df['时长']
-                        y = audit_df['成绩']
-                        mask = x.notna() & y.notna()
-                        if mask.sum() > 2:
-                            coeff = np.polyfit(x[mask], y[mask], 1)
-                            trend = np.poly1d(coeff)
-                            fig_fit = px.scatter(audit_df, x='时长', y='成绩', title='时长 vs 成绩 散点与线性拟合', color_discrete_sequence=['#FFB6C1'])
-                            xs = np.linspace(x.min(), x.max(), 50)
-                            fig_fit.add_trace(go.Scatter(x=xs, y=trend(xs), mode='lines', line=dict(color='red', dash='dash'), name='线性拟合'))
+                        fig_fit, outliers = view_cache('fit', audit_ver, lambda: fit_analysis(audit_df))
+                        if fig_fit is not None:
                             st.plotly_chart(fig_fit, use_container_width=True)
-
-                            # 简单异常值检测（z-score）
-                            outliers = pd.DataFrame()
-                            for col in ['时长', '成绩']:
-                                if col in audit_df.columns:
-                                    col_mean = audit_df[col].mean()
-                                    col_std = audit_df[col].std()
-                                    if col_std and not np.isnan(col_std):
-                                        z = (audit_df[col] - col_mean) / col_std
-                                        audit_df[f'{col}_z'] = z
-                            # 标出任一指标 z-score 超过 2 的记录
-                            if any(c.endswith('_z') for c in audit_df.columns):
-                                z_cols = [c for c in audit_df.columns if c.endswith('_z')]
-                                outlier_mask = audit_df[z_cols].abs().max(axis=1) > 2
-                                outliers = audit_df[outlier_mask][['姓名','时长','成绩'] + z_cols]
-                                if not outliers.empty:
-                                    st.markdown('#### ⚠️ 检测到异常值 (任一指标 |z|>2)')
-                                    st.dataframe(outliers.reset_index(drop=True), use_container_width=True)
+                        # 标出任一指标 z-score 超过 2 的记录
+                        if not outliers.empty:
+                            st.markdown('#### ⚠️ 检测到异常值 (任一指标 |z|>2)')
+                            st.dataframe(outliers, use_container_width=True)
 
                     # --- 新增：学习效率分析（进度/时长） ---
-                    if '时长' in audit_df.columns and '进度' in audit_df.columns:
-                        # 计算效率（单位：进度百分比/分钟）
-                        with np.errstate(divide='ignore', invalid='ignore'):
-                            eff = audit_df['进度'] / audit_df['时长'].replace(0, np.nan)
-                        audit_df['效率(进度/分)'] = eff.fillna(0)
-
+                    if eff_index is not None:
                         st.markdown('#### 📊 学习效率分析 (进度% / 时长(分))')
                         ce1, ce2 = st.columns([3,1])
                         with ce1:
-                            fig_eff = px.histogram(audit_df, x='效率(进度/分)', nbins=30, title='学习效率分布', color_discrete_sequence=['#FFB6C1'])
+                            fig_eff = view_cache('eff_hist', audit_ver, lambda: fig_histogram(audit_df, '效率(进度/分)', 30, '#FFB6C1', title='学习效率分布'))
                             st.plotly_chart(fig_eff, use_container_width=True)
                         with ce2:
-                            # 计算安全的上界与默认阈值
-                            valid_eff = audit_df['效率(进度/分)'].replace([np.inf, -np.inf], np.nan).dropna()
-                            max_val = float(valid_eff.max()) if not valid_eff.empty else 100.0
-                            default_thr = float(np.nanpercentile(valid_eff, 90)) if not valid_eff.empty else max_val * 0.5
-                            eff_thr = st.slider('效率上界阈值 (用于标记高效可疑)', min_value=0.0, max_value=max(max_val * 2.0, default_thr + 1.0), value=default_thr, step=0.1, key='eff_thr')
-                            st.caption('阈值用于识别可能的“速刷/高效可疑”行为，可调整灵敏度。')
+                            def remember_eff_thr():
+                                st.session_state['_eff_thr'][audit_ver] = st.session_state[f'eff_thr_{audit_ver}']
+                            st.slider('效率上界阈值 (用于标记高效可疑)', min_value=0.0, max_value=max(eff_max * 2.0, eff_thr + 1.0), value=eff_thr, step=0.1,
+                                      key=f'eff_thr_{audit_ver}', on_change=remember_eff_thr)
+                            st.caption(f'当前阈值下高效可疑 {len(sus_rows)} 人。阈值用于识别可能的“速刷/高效可疑”行为，可调整灵敏度。')
 
                         # 列出高/低效率学生
-                        top_eff = audit_df.sort_values('效率(进度/分)', ascending=False).head(10)[['姓名', '进度', '时长', '效率(进度/分)']]
-                        low_eff = audit_df.sort_values('效率(进度/分)').head(10)[['姓名', '进度', '时长', '效率(进度/分)']]
+                        eff_cols = ['姓名', '进度', '时长', '效率(进度/分)']
+                        top_eff = view_cache('eff_top', audit_ver, lambda: top_k(audit_df, '效率(进度/分)', eff_cols))
+                        low_eff = view_cache('eff_low', audit_ver, lambda: top_k(audit_df, '效率(进度/分)', eff_cols, ascending=True))
                         st.markdown('**效率 Top10（可能异常高效）**')
-                        st.dataframe(top_eff.reset_index(drop=True), use_container_width=True)
+                        st.dataframe(top_eff, use_container_width=True)
                         st.markdown('**效率 最低10（学习投入高但产出低）**')
-                        st.dataframe(low_eff.reset_index(drop=True), use_container_width=True)
+                        st.dataframe(low_eff, use_container_width=True)
 
                         # 散点视图：时长 vs 效率
-                        fig_sc = px.scatter(audit_df, x='时长', y='效率(进度/分)', hover_name='姓名', title='时长 vs 学习效率', color_discrete_sequence=['#FF6B6B'])
+                        fig_sc = view_cache('eff_scatter', score_ver, lambda: fig_scatter(audit_df, '时长', '效率(进度/分)', '时长 vs 学习效率', '#FF6B6B'))
                         st.plotly_chart(fig_sc, use_container_width=True)
 
-                        # 将高效可疑者标注到证据链与异常原因中
-                        try:
-                            sus_mask = audit_df['效率(进度/分)'] > eff_thr
-                            if sus_mask.any():
-                                def add_high_eff_tag(x):
-                                    if isinstance(x, list):
-                                        return x + ['🚨高效可疑'] if '🚨高效可疑' not in x else x
-                                    if isinstance(x, str):
-                                        if x == '🟢正常':
-                                            return ['🚨高效可疑']
-                                        return [x, '🚨高效可疑']
-                                    return ['🚨高效可疑']
-
-                                audit_df.loc[sus_mask, '证据链'] = audit_df.loc[sus_mask, '证据链'].apply(add_high_eff_tag)
-                                audit_df.loc[sus_mask, '异常原因'] = audit_df.loc[sus_mask, '异常原因'].apply(lambda x: (str(x) + ' | 高效异常') if '高效异常' not in str(x) else x)
-                                audit_df.loc[sus_mask, '状态'] = '异常'
-                        except Exception:
-                            pass
-
                     # --- 新增：综合得分分布与排名展示 ---
                     if '综合得分' in audit_df.columns:
                         st.markdown('#### 🧾 综合得分分布与排名')
                         comp_col1, comp_col2 = st.columns([3,1])
                         with comp_col1:
-                            fig_comp = px.histogram(audit_df, x='综合得分', nbins=20, title='综合得分分布', color_discrete_sequence=['#B19CD9'])
-                            fig_comp.add_vline(x=audit_df['综合得分'].mean(), line_dash='dash', line_color='red', annotation_text='平均综合得分')
+                            fig_comp = view_cache('comp_hist', score_ver, lambda: fig_histogram(audit_df, '综合得分', 20, '#B19CD9', title='综合得分分布', mean_label='平均综合得分'))
                             st.plotly_chart(fig_comp, use_container_width=True)
                         with comp_col2:
-                            top_comp = audit_df.sort_values('综合得分', ascending=False).head(10)[['姓名','综合得分']]
-                            low_comp = audit_df.sort_values('综合得分').head(10)[['姓名','综合得分']]
+                            top_comp = view_cache('comp_top', score_ver, lambda: top_k(audit_df, '综合得分', ['姓名','综合得分']))
+                            low_comp = view_cache('comp_low', score_ver, lambda: top_k(audit_df, '综合得分', ['姓名','综合得分'], ascending=True))
                             st.markdown('**Top 综合得分**')
-                            st.table(top_comp.reset_index(drop=True))
+                            st.table(top_comp)
                             st.markdown('**Lowest 综合得分**')
-                            st.table(low_comp.reset_index(drop=True))
+                            st.table(low_comp)
                         # --- 新增：参与度分布与低参与名单 ---
                         if '参与度' in audit_df.columns:
                             st.markdown('#### 📣 学习参与度分布与低参与预警')
                             pcol1, pcol2 = st.columns([3,1])
                             with pcol1:
-                                fig_part = px.histogram(audit_df, x='参与度', nbins=20, title='参与度分布', color_discrete_sequence=['#FFD580'])
-                                fig_part.add_vline(x=audit_df['参与度'].mean(), line_dash='dash', line_color='red', annotation_text='平均参与度')
+                                fig_part = view_cache('part_hist', score_ver, lambda: fig_histogram(audit_df, '参与度', 20, '#FFD580', title='参与度分布', mean_label='平均参与度'))
                                 st.plotly_chart(fig_part, use_container_width=True)
                             with pcol2:
-                                low_p = audit_df.sort_values('参与度').head(10)[['姓名','参与度']]
+                                low_p = view_cache('part_low', score_ver, lambda: top_k(audit_df, '参与度', ['姓名','参与度'], ascending=True))
                                 st.markdown('**低参与 Top10**')
-                                st.table(low_p.reset_index(drop=True))
+                                st.table(low_p)
 
                             # 参与度 vs 综合得分 散点
-                            if '综合得分' in audit_df.columns:
-                                fig_pp = px.scatter(audit_df, x='参与度', y='综合得分', hover_name='姓名', title='参与度 vs 综合得分')
-                                st.plotly_chart(fig_pp, use_container_width=True)
+                            fig_pp = view_cache('part_scatter', score_ver, lambda: fig_scatter(audit_df, '参与度', '综合得分', '参与度 vs 综合得分'))
+                            st.plotly_chart(fig_pp, use_container_width=True)
 
-                with tab2:
+                elif "智能聚类画像" in section:
                     st.markdown("#### 🧩 学生群体智能聚类")
                     st.caption("基于“投入-产出”模型，自动将学生划分为四大典型群体：")
                     
                     col_q1, col_q2 = st.columns([3, 1])
+                    y_axis = "进度" if mode == "LMS" else "成绩"
                     with col_q1:
-                        y_axis = "进度" if mode == "LMS" else "成绩"
-                        fig_clus = px.scatter(audit_df, x="时长", y=y_axis, color="学习群体", 
-                                            hover_name="姓名", size="时长", size_max=15,
-                                            color_discrete_map={
-                                                "🌟 领跑集团 (双高)": "#10B981", 
-                                                "🚀 效率/刷课组 (低时高产)": "#FF6B6B", 
-                                                "🐢 努力困境组 (高时低产)": "#F59E0B", 
-                                                "💤 待激活组 (双低)": "#ADB5BD"
-                                            })
-                        # 添加平均线辅助线
-                        fig_clus.add_hline(y=audit_df[y_axis].mean(), line_dash="dash", line_color="gray", annotation_text="平均产出")
-                        fig_clus.add_vline(x=audit_df['时长'].mean(), line_dash="dash", line_color="gray", annotation_text="平均投入")
+                        fig_clus = view_cache('clusters', score_ver, lambda: fig_clusters(audit_df, y_axis))
                         st.plotly_chart(fig_clus, use_container_width=True)
                     
                     with col_q2:
@@ -701,51 +2974,50 @@ def main():
                         # 群体汇总统计与导出
                         st.markdown("---")
                         st.markdown("**群体/班级汇总统计**")
-                        grp = audit_df.groupby('学习群体').agg(
-                            人数=('姓名', 'count'),
-                            平均时长=('时长', 'mean'),
-                            平均成绩=('成绩', 'mean'),
-                            未完结率=('进度', lambda s: (pd.to_numeric(s, errors='coerce').fillna(0) < 99.9).mean()),
-                            平均综合得分=('综合得分', 'mean'),
-                            平均参与度=('参与度', 'mean')
-                        ).reset_index()
-                        # 美化数值
-                        for col in ['平均时长', '平均成绩', '平均综合得分', '平均参与度']:
-                            if col in grp.columns:
-                                grp[col] = grp[col].round(1)
-                        grp['未完结率'] = (grp['未完结率'] * 100).round(1).astype(str) + '%'
+                        grp = view_cache('group_summary', score_ver, lambda: group_summary(audit_df))
                         st.dataframe(grp, use_container_width=True)
 
-                        output_grp = io.BytesIO()
-                        with pd.ExcelWriter(output_grp, engine='xlsxwriter') as writer:
-                            grp.to_excel(writer, index=False, sheet_name='群体汇总')
-                            # 同时写入全表供老师进一步分析
-                            audit_df.to_excel(writer, index=False, sheet_name='全班明细')
-                        output_grp.seek(0)
-                        st.download_button('📥 导出群体统计与明细', output_grp.getvalue(), '群体统计.xlsx')
+                        # 同时写入全表供老师进一步分析
+                        # 后台线程只读浅拷贝，页面随后给 audit_df 加列不影响正在生成的文件
+                        detail = audit_df.copy(deep=False)
+                        job_export('📥 导出群体统计与明细', '群体统计.xlsx', ('群体统计', score_ver),
+                                   lambda job: streaming_xlsx_bytes(job.track(group_stats_sheets(grp, detail), 2, lambda item: f'写入 {item[0]}'),
+                                                                    checkpoint=job.checkpoint))
 
-                with tab3:
+                elif "时序热力图" in section:
                     st.markdown('#### 📈 时序热力图 & 学习路径覆盖')
                     st.caption('展示按小时的活跃分布与进度覆盖率，支持按群体/分组拆分。')
 
+                    # 活动日志：星期×小时 热力图，可按群体或单个学生查看
+                    if activity is not None:
+                        log_ver = data_version(score_ver, activity.key)
+                        matched = view_cache('activity_matched', log_ver, lambda: int((activity.positions(audit_df['学号']) >= 0).sum()))
+                        st.markdown('**📒 活动日志：星期 × 小时 活跃分布**')
+                        st.caption(f'按学号匹配到 {matched:,} / {len(audit_df):,} 名学生。')
+                        scope_col, id_col = st.columns([2, 1])
+                        groups = [g for g in audit_df['学习群体'].unique() if pd.notna(g)]
+                        scope = scope_col.selectbox('查看范围', ['全部学生'] + groups, key='activity_scope')
+                        student_id = id_col.text_input('或输入学号查看个人', key='activity_student').strip()
+                        if student_id:
+                            ids = pd.Series([student_id])
+                            title = f'学号 {student_id}'
+                        else:
+                            ids = audit_df['学号'] if scope == '全部学生' else audit_df.loc[audit_df['学习群体'] == scope, '学号']
+                            title = scope
+                        fig_week = view_cache('week_hour', log_ver, lambda: fig_week_hour(activity.matrix(ids), title), scope, student_id)
+                        st.plotly_chart(fig_week, use_container_width=True)
+                        export_button('📥 导出群体星期×小时矩阵', '星期小时矩阵.xlsx', ('星期小时矩阵', log_ver),
+                                      lambda: excel_bytes([('群体星期小时', week_hour_table(activity, audit_df))], index=True))
+
                     # 时序热力图（基于最后活跃小时）
                     if '最后活跃小时' in audit_df.columns:
-                        df_hour = audit_df[audit_df['最后活跃小时'] >= 0].copy()
-                        if not df_hour.empty:
-                            group_col = '学习群体' if '学习群体' in audit_df.columns else ('综合分组' if '综合分组' in audit_df.columns else None)
-                            if group_col:
-                                pivot = pd.crosstab(df_hour[group_col], df_hour['最后活跃小时']).reindex(columns=list(range(24)), fill_value=0)
-                                fig_heat = px.imshow(pivot.values, x=pivot.columns, y=pivot.index, labels={'x':'小时','y':'群体','color':'人数'}, color_continuous_scale='YlOrRd')
-                                st.plotly_chart(fig_heat, use_container_width=True)
+                        pivot, fig_hour = view_cache('hour_activity', audit_ver, lambda: hour_activity(audit_df))
+                        if fig_hour is not None:
+                            st.plotly_chart(fig_hour, use_container_width=True)
+                            if pivot is not None:
                                 # 导出数据
-                                out_h = io.BytesIO()
-                                pivot.to_excel(out_h, sheet_name='hour_pivot')
-                                out_h.seek(0)
-                                st.download_button('📥 导出时序矩阵', out_h.getvalue(), '时序矩阵.xlsx')
-                            else:
-                                counts = df_hour['最后活跃小时'].value_counts().reindex(list(range(24)), fill_value=0)
-                                fig_bar = px.bar(x=counts.index, y=counts.values, labels={'x':'小时','y':'活跃人数'}, title='按小时活跃人数')
-                                st.plotly_chart(fig_bar, use_container_width=True)
+                                export_button('📥 导出时序矩阵', '时序矩阵.xlsx', ('时序矩阵', audit_ver),
+                                              lambda: excel_bytes([('hour_pivot', pivot)], index=True))
                         else:
                             st.info('未检测到可用于时序分析的活跃时间数据。')
                     else:
@@ -755,16 +3027,7 @@ def main():
                     if '进度' in audit_df.columns:
                         bins = list(range(0, 110, 10))
                         audit_df['进度区间'] = pd.cut(audit_df['进度'].fillna(0), bins=bins, include_lowest=True, right=False)
-                        cov_grp = audit_df.groupby('进度区间').size().reset_index(name='人数')
-                        cov_grp['占比'] = (cov_grp['人数'] / cov_grp['人数'].sum() * 100).round(1)
-                        # 将区间转换为字符串以避免 Plotly JSON 序列化错误
-                        cov_grp['进度区间'] = cov_grp['进度区间'].astype(str)
-                        # 使用 Plotly Graph Objects，确保传入的 x/y/text 为原生 Python 列表，避免序列化错误
-                        x_vals = cov_grp['进度区间'].astype(str).tolist()
-                        y_vals = cov_grp['人数'].tolist()
-                        text_vals = cov_grp['占比'].astype(str).tolist()
-                        fig_cov = go.Figure(data=[go.Bar(x=x_vals, y=y_vals, text=text_vals, marker_color='#7DD3FC')])
-                        fig_cov.update_layout(title='学习路径覆盖：进度区间人数分布', xaxis_title='进度区间', yaxis_title='人数')
+                        cov_grp, fig_cov = view_cache('coverage', audit_ver, lambda: coverage_analysis(audit_df))
                         st.plotly_chart(fig_cov, use_container_width=True)
                         st.markdown('**进度覆盖表**')
                         st.table(cov_grp)
@@ -774,190 +3037,45 @@ def main():
                     # --- 按章节统计与导出（增强版） ---
                     st.markdown('#### 🗂️ 按章节统计与导出（含按群体对比与低分清单）')
                     try:
-                        cols_raw = [str(c).strip() for c in raw_df.columns]
-                        chap_map = {}
-                        for c in cols_raw:
-                            nums = re.findall(r"(\d{1,2})", str(c))
-                            if nums:
-                                ch = nums[0]
-                                chap_map.setdefault(ch, []).append(c)
-
-                        def _parse_duration_min_local(val):
-                            if pd.isna(val):
-                                return None
-                            s = str(val)
-                            h = re.search(r"(\\d+)\\s*[时小时h]", s)
-                            m = re.search(r"(\\d+)\\s*分", s)
-                            ss = re.search(r"(\\d+)\\s*秒", s)
-                            if h or m or ss:
-                                total = 0
-                                if h: total += int(h.group(1)) * 60
-                                if m: total += int(m.group(1))
-                                if ss: total += int(ss.group(1)) / 60
-                                return total
-                            t = re.search(r"(\\d{1,2}):(\\d{2})(?::(\\d{2}))?", s)
-                            if t:
-                                hh = int(t.group(1)); mm = int(t.group(2)); sec = int(t.group(3) or 0)
-                                return hh * 60 + mm + sec / 60
-                            try:
-                                v = float(re.sub(r"[^0-9\\.]+", "", s))
-                                return v
-                            except:
-                                return None
-
-                        chapter_summaries = []
-                        low_perf_examples = []
-                        for ch in sorted(chap_map.keys(), key=lambda x: int(x)):
-                            clist = chap_map[ch]
-                            status_col = None
-                            dur_col = None
-                            score_col = None
-                            for cc in clist:
-                                if any(k in cc for k in ['状', '完成', '通过', '是否', '提交']):
-                                    status_col = cc
-                                if any(k in cc for k in ['时', '耗时', '时长']):
-                                    dur_col = cc
-                                if any(k in cc for k in ['得分', '成绩', '分']):
-                                    score_col = cc
-
-                            attempted_mask = raw_df[clist].notna().any(axis=1)
-                            attempts = int(attempted_mask.sum())
-                            completions = 0
-                            if status_col is not None:
-                                svals = raw_df[status_col].astype(str).fillna('')
-                                completions = int(svals.apply(lambda x: 1 if any(w in x for w in ['通过', '已完成', '完成', '合格', '✓']) else 0).sum())
-
-                            avg_dur = None
-                            if dur_col is not None and dur_col in raw_df.columns:
-                                vals = raw_df[dur_col].apply(_parse_duration_min_local).dropna()
-                                if not vals.empty:
-                                    avg_dur = float(vals.mean())
-
-                            # 章节得分相关的低分/未完成样例（优先使用 score_col，否则用审计表的进度）
-                            examples = []
-                            if score_col is not None and score_col in raw_df.columns:
-                                sseries = pd.to_numeric(raw_df[score_col], errors='coerce')
-                                if not sseries.dropna().empty:
-                                    thr = sseries.mean() - sseries.std()
-                                    low_idx = sseries[sseries < thr].dropna().index.tolist()
-                                    for idx in low_idx[:5]:
-                                        examples.append({'章节': ch, '姓名': raw_df.iloc[idx].get(chap_map[ch][0], ''), '分数列': score_col, '分数': raw_df.iloc[idx].get(score_col)})
-                            else:
-                                if status_col is not None and status_col in raw_df.columns:
-                                    mask_un = raw_df[status_col].astype(str).fillna('').apply(lambda x: not any(w in x for w in ['通过', '已完成', '完成', '合格', '✓']))
-                                    for idx in raw_df[mask_un].index[:5]:
-                                        examples.append({'章节': ch, '姓名': raw_df.iloc[idx].get(chap_map[ch][0], ''), '分数列': status_col, '分数': raw_df.iloc[idx].get(status_col)})
-
-                            completion_rate = (completions / attempts * 100) if attempts > 0 else None
-                            chapter_summaries.append({'章节': ch, '尝试人数': attempts, '完成人数': completions, '完成率(%)': round(completion_rate, 1) if completion_rate is not None else None, '平均时长(分)': round(avg_dur, 1) if avg_dur is not None else None, '示例列': ','.join(clist[:6])})
-                            low_perf_examples.extend(examples)
-
-                        chap_df = pd.DataFrame(chapter_summaries)
+                        raw_df = combined_raw()
+                        schema = get_chapter_schema(chapter_key, raw_df)
+                        chap_df = view_cache('chapter_summary', chapter_key, schema.summary)
                         if not chap_df.empty:
                             st.dataframe(chap_df, use_container_width=True)
-                            # 可序列化的章节完成人数柱状图
-                            x_vals = chap_df['章节'].astype(str).tolist()
-                            y_vals = chap_df['完成人数'].fillna(0).astype(int).tolist()
-                            fig_chap = go.Figure(data=[go.Bar(x=x_vals, y=y_vals, marker_color='#FFB6C1')])
-                            fig_chap.update_layout(title='各章节完成人数', xaxis_title='章节', yaxis_title='完成人数')
+                            fig_chap = view_cache('chapter_bar', chapter_key, lambda: fig_chapter_completion(chap_df))
                             st.plotly_chart(fig_chap, use_container_width=True)
 
                             # 低分/未完结示例
-                            if low_perf_examples:
+                            low_perf_examples = view_cache('chapter_examples', chapter_key, lambda: schema.examples(raw_df, audit_df['姓名']))
+                            if not low_perf_examples.empty:
                                 st.markdown('**每章低分 / 未完结示例（最多各章前5）**')
-                                st.table(pd.DataFrame(low_perf_examples).head(20))
+                                st.table(low_perf_examples.head(20))
 
                             # 若存在学习群体，则做按群体的章节通过率对比矩阵
                             if '学习群体' in audit_df.columns:
-                                pivot_rows = []
-                                for ch in chap_df['章节'].astype(str).tolist():
-                                    clist = chap_map.get(ch, [])
-                                    status_col = next((c for c in clist if any(k in c for k in ['状', '完成', '通过', '是否', '提交'])), None)
-                                    if status_col is None or status_col not in raw_df.columns:
-                                        continue
-                                    tmp = raw_df[[status_col]].copy()
-                                    tmp['学习群体'] = audit_df['学习群体'] if '学习群体' in audit_df.columns else '未知'
-                                    tmp['完成'] = tmp[status_col].astype(str).fillna('').apply(lambda x: 1 if any(w in x for w in ['通过', '已完成', '完成', '合格', '✓']) else 0)
-                                    grp = tmp.groupby('学习群体')['完成'].mean().mul(100).round(1).rename(ch)
-                                    pivot_rows.append(grp)
-                                if pivot_rows:
-                                    pivot_df = pd.concat(pivot_rows, axis=1).fillna(0)
+                                pivot_df = view_cache('chapter_group_rates', audit_ver, lambda: schema.group_pass_rates(audit_df['学习群体']))
+                                if not pivot_df.empty:
                                     st.markdown('**按学习群体的章节通过率对比（%）**')
                                     st.dataframe(pivot_df, use_container_width=True)
-                                    out_grp = io.BytesIO()
-                                    with pd.ExcelWriter(out_grp, engine='xlsxwriter') as writer:
-                                        pivot_df.to_excel(writer, sheet_name='群体章节通过率')
-                                    out_grp.seek(0)
-                                    st.download_button('📥 导出群体章节通过率矩阵', out_grp.getvalue(), '群体章节通过率.xlsx')
-
-                            # 导出章节汇总与全表（含注：已移除列表/emoji 写入问题）
-                            out = io.BytesIO()
-                            with pd.ExcelWriter(out, engine='xlsxwriter') as writer:
-                                chap_df.to_excel(writer, index=False, sheet_name='章节汇总')
-                                audit_copy = audit_df.copy()
-                                if '证据链' in audit_copy.columns:
-                                    audit_copy['证据链'] = audit_copy['证据链'].apply(lambda x: ','.join(x) if isinstance(x, list) else (str(x) if pd.notna(x) else ''))
-                                audit_copy.to_excel(writer, index=False, sheet_name='全班明细')
-
-                                # 写入每章明细为单独 sheet（包括状态/得分/时长），限长 sheet 名称
-                                low_perf_all = []
-                                unfin_all = []
-                                for ch in sorted(chap_map.keys(), key=lambda x: int(x)):
-                                    clist = chap_map.get(ch, [])
-                                    status_col = next((c for c in clist if any(k in c for k in ['状', '完成', '通过', '是否', '提交'])), None)
-                                    score_col = next((c for c in clist if any(k in c for k in ['得分', '成绩', '分'])), None)
-                                    dur_col = next((c for c in clist if any(k in c for k in ['时', '耗时', '时长'])), None)
-                                    rows = []
-                                    for i in raw_df.index:
-                                        name = audit_df.at[i, '姓名'] if '姓名' in audit_df.columns else (raw_df.iloc[i][clist[0]] if clist else '')
-                                        sid = audit_df.at[i, '学号'] if '学号' in audit_df.columns else ''
-                                        st_val = raw_df.at[i, status_col] if (status_col in raw_df.columns) else ''
-                                        sc = raw_df.at[i, score_col] if (score_col in raw_df.columns) else ''
-                                        dur = raw_df.at[i, dur_col] if (dur_col in raw_df.columns) else ''
-                                        rows.append({'姓名': name, '学号': sid, '章节状态': st_val, '章节得分': sc, '章节时长原始': dur})
-                                        # collect low-perf and unfin
-                                        if score_col in raw_df.columns:
-                                            try:
-                                                s_val = float(re.sub(r"[^0-9\.]+", "", str(raw_df.at[i, score_col])))
-                                            except:
-                                                s_val = None
-                                            # low if significantly below mean (will be filtered later if mean available)
-                                            low_perf_all.append({'章节': ch, '姓名': name, '学号': sid, '分数': s_val})
-                                        if status_col in raw_df.columns:
-                                            is_unfin = False
-                                            sval = str(raw_df.at[i, status_col])
-                                            if not any(w in sval for w in ['通过', '已完成', '完成', '合格', '✓']):
-                                                is_unfin = True
-                                            if is_unfin:
-                                                unfin_all.append({'章节': ch, '姓名': name, '学号': sid, '状态原文': sval})
-                                    df_ch = pd.DataFrame(rows)
-                                    sheet_name = f'章{ch}_详情'
-                                    try:
-                                        df_ch.to_excel(writer, index=False, sheet_name=sheet_name[:31])
-                                    except Exception:
-                                        df_ch.to_excel(writer, index=False, sheet_name=f'章{ch}'[:31])
-                                # post-process low_perf_all to pick truly low entries per chapter
-                                low_df = pd.DataFrame(low_perf_all)
-                                if not low_df.empty:
-                                    # compute per-chapter threshold mean-std
-                                    low_filtered = []
-                                    for ch, g in low_df.groupby('章节'):
-                                        vals = g['分数'].dropna().astype(float)
-                                        if vals.empty:
-                                            continue
-                                        thr = vals.mean() - vals.std()
-                                        sel = g[g['分数'].astype(float) < thr]
-                                        for _, r in sel.iterrows():
-                                            low_filtered.append(r.to_dict())
-                                    low_out = pd.DataFrame(low_filtered)
-                                    if not low_out.empty:
-                                        low_out.to_excel(writer, index=False, sheet_name='章节低分名单')
-                                unfin_df = pd.DataFrame(unfin_all)
-                                if not unfin_df.empty:
-                                    unfin_df.to_excel(writer, index=False, sheet_name='章节未完结名单')
-
-                            out.seek(0)
-                            st.download_button('📥 导出按章节汇总与明细', out.getvalue(), '章节汇总.xlsx')
+                                    export_button('📥 导出群体章节通过率矩阵', '群体章节通过率.xlsx', ('群体章节通过率', audit_ver),
+                                                  lambda: excel_bytes([('群体章节通过率', pivot_df)], index=True))
+
+                            # 多班级：按班级的章节通过率对比
+                            if '班级' in audit_df.columns and audit_df['班级'].nunique() > 1:
+                                class_rates = view_cache('chapter_class_rates', chapter_key, lambda: schema.group_pass_rates(audit_df['班级']))
+                                if not class_rates.empty:
+                                    st.markdown('**按班级的章节通过率对比（%）**')
+                                    st.dataframe(class_rates, use_container_width=True)
+                                    export_button('📥 导出班级章节通过率矩阵', '班级章节通过率.xlsx', ('班级章节通过率', chapter_key),
+                                                  lambda: excel_bytes([('班级章节通过率', class_rates)], index=True))
+
+                            # 导出章节汇总与全表：逐表流式写入磁盘临时文件，内存不随章节数增长
+                            detail = audit_df.copy(deep=False)
+                            n_sheets = 4 + len(schema.chapters)  # 汇总、明细、每章详情、低分与未完结名单
+                            job_export('📥 导出按章节汇总与明细', '章节汇总.xlsx', ('章节汇总', score_ver),
+                                       lambda job: streaming_xlsx_bytes(job.track(chapter_workbook_sheets(schema, raw_df, detail),
+                                                                                  n_sheets, lambda item: f'写入 {item[0]}'),
+                                                                        checkpoint=job.checkpoint))
                         else:
                             st.info('未检测到章节列或章节统计为空。')
                     except Exception as e:
@@ -966,33 +3084,26 @@ def main():
             # === VIEW 3: 异常数据分栏 (修复版) ===
             elif "异常数据分栏" in nav:
                 st.markdown("### 🚨 异常行为诊断中心")
-                risk_df = audit_df[audit_df['状态']=='异常'].copy()
+                # 只保留行掩码，名单与导出都从 audit_df 按需取列，不复制整张风险表
+                risk_rows = audit_df['标签码'].to_numpy() != 0
                 
-                if risk_df.empty:
+                if not risk_rows.any():
                     st.success("🎉 全班表现完美！")
                 else:
                     col_list, col_detail = st.columns([1, 2])
                     with col_list:
                         st.markdown("#### 📋 风险名单")
-                        output = io.BytesIO()
-                        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                            risk_df.drop(columns=['证据链', '主标签']).to_excel(writer, index=False)
-                        output.seek(0)
-                        st.download_button("📥 导出诊断报告", output.getvalue(), "异常诊断表.xlsx", use_container_width=True)
+                        export_button("📥 导出诊断报告", "异常诊断表.xlsx", ('异常诊断表', score_ver),
+                                      lambda: excel_bytes([('Sheet1', TagCodec.export_view(audit_df, rows=risk_rows, drop=('证据链', '主标签')))]),
+                                      use_container_width=True)
                         
-                        student_name = st.radio("点击查看详情：", risk_df['姓名'].unique(), key="s_select")
+                        student_name = st.radio("点击查看详情：", audit_df.loc[risk_rows, '姓名'].unique(), key="s_select")
                     
                     with col_detail:
                         if student_name:
-                            row = risk_df[risk_df['姓名'] == student_name].iloc[0]
-                            # 安全生成标签 HTML（适配 list / str / empty）
-                            entry = row.get('证据链', []) if isinstance(row, (pd.Series, dict)) else row['证据链']
-                            tags_list = []
-                            if isinstance(entry, list):
-                                tags_list = [t for t in entry if t != '🟢正常']
-                            elif isinstance(entry, str):
-                                if entry != '🟢正常':
-                                    tags_list = [entry]
+                            row = audit_df[(audit_df['姓名'] == student_name).to_numpy() & risk_rows].iloc[0]
+                            # 由位掩码解码出标签并生成 HTML
+                            tags_list = [t for t in TagCodec.tags_of(row['标签码']) if t != NORMAL_TAG]
                             tags_html = ''
                             for t in tags_list:
                                 if '秒刷' in t:
@@ -1030,34 +3141,43 @@ def main():
                                 </div>
                                 <h4 style="color:#C71585;">🩺 AI 诊断结论</h4>
                                 <p style="background:#FFF0F5; padding:15px; border-radius:8px; border-left:4px solid #FF69B4; color:#C71585; font-weight:bold;">
-                                    {row['异常原因']}
+                                    {TagCodec.reasons(audit_df.loc[[row.name]])[0]}
                                 </p>
                                 <h4 style="color:#C71585;">🏷️ 风险标签</h4>
                                 <div>{tags_html}</div>
                             </div>
                             """, unsafe_allow_html=True)
+                            # 以往存档中的标签（不含本次数据）
+                            if store is not None:
+                                past = {}
+                                for term, course, tag in store.flag_history(row['学号'], name=row['姓名'], exclude_source=file_key):
+                                    past.setdefault((term, course), []).append(tag)
+                                if past:
+                                    st.caption('📚 以往存档：' + '；'.join(f"{term} {course}：{'、'.join(tags)}" for (term, course), tags in past.items()))
 
             # === VIEW 4: 未完结名单统计 (修复版) ===
             elif "未完结名单统计" in nav:
                 st.markdown("### 📉 章节任务未完结统计")
-                unfinished_df = audit_df[pd.to_numeric(audit_df['进度'], errors='coerce').fillna(0) < 99.9].sort_values('进度')
+                # 先取名单需要的几列再筛行排序，导出直接用这张窄表
+                unfinished_df = audit_df.loc[unfinished_mask, [c for c in ['姓名', '学号', '班级', '进度', '时长'] if c in audit_df.columns]].sort_values('进度')
                 
                 if unfinished_df.empty:
                     st.success("🎉 全班已全部完成任务！")
                 else:
                     st.info(f"共有 **{len(unfinished_df)}** 名同学未完结，请督促。")
-                    output = io.BytesIO()
-                    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                        unfinished_df[['姓名', '学号', '进度', '时长']].to_excel(writer, index=False)
-                    output.seek(0)
-                    st.download_button("📥 导出未完结名单", output.getvalue(), "未完结名单.xlsx")
+                    export_button("📥 导出未完结名单", "未完结名单.xlsx", ('未完结名单', audit_ver),
+                                  lambda: excel_bytes([('Sheet1', unfinished_df)]))
                     
-                    unfinished_df['进度条'] = unfinished_df['进度'].apply(lambda x: f'<div style="background:#eee;width:100px;height:8px;border-radius:4px;"><div style="background:#3B82F6;width:{x}px;height:8px;border-radius:4px;"></div></div>')
-                    st.write(unfinished_df[['姓名', '学号', '进度', '进度条']].to_html(escape=False, index=False), unsafe_allow_html=True)
+                    bars = unfinished_df['进度'].apply(lambda x: f'<div style="background:#eee;width:100px;height:8px;border-radius:4px;"><div style="background:#3B82F6;width:{x}px;height:8px;border-radius:4px;"></div></div>')
+                    st.write(unfinished_df[['姓名', '学号', '进度']].assign(进度条=bars).to_html(escape=False, index=False), unsafe_allow_html=True)
 
             # === VIEW 5: 原始表 ===
             elif "原始数据表" in nav:
-                st.dataframe(audit_df, use_container_width=True)
+                st.dataframe(TagCodec.export_view(audit_df), use_container_width=True)
+
+            # === VIEW 6: 历史档案 ===
+            elif "历史档案" in nav:
+                history_view(store)
 
     else:
         st.markdown("""
@@ -1067,6 +3187,10 @@ def main():
                 <p>系统将自动诊断“时间不准”和“速刷”行为，并挖掘深层数据价值</p>
             </div>
         """, unsafe_allow_html=True)
+        # 未上传文件时也可直接查看以往存档
+        store = get_audit_store()
+        if store is not None and store.courses():
+            history_view(store)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,250 @@
+"""审计结果的本地历史存档（SQLite）：每次审计保存为一个快照，按学号与标签建索引。
+
+快照记录课程、学期、保存时间与数据来源；明细每名学生一行（含班级）。带标签的学生另在 ``result_tags``
+中每个标签占一行，因此“上学期是否也被标为秒刷”、某学生的历次记录、课程各学期趋势都是索引查询，
+不需要重新上传或解析原始表格。只依赖标准库 sqlite3，与页面、批量脚本共用。
+"""
+import datetime
+import json
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    course TEXT NOT NULL,
+    term TEXT NOT NULL,
+    taken_at TEXT NOT NULL,
+    source TEXT NOT NULL,
+    mode TEXT,
+    n_students INTEGER NOT NULL,
+    n_flagged INTEGER NOT NULL,
+    params TEXT,
+    UNIQUE (course, term, source)
+);
+CREATE TABLE IF NOT EXISTS results (
+    snapshot_id INTEGER NOT NULL,
+    student_id TEXT,
+    name TEXT,
+    class TEXT,
+    progress REAL,
+    duration REAL,
+    score REAL,
+    discussion REAL,
+    tag_code INTEGER NOT NULL,
+    primary_tag TEXT,
+    learner_group TEXT,
+    composite REAL,
+    percentile REAL,
+    tier TEXT,
+    participation REAL
+);
+CREATE INDEX IF NOT EXISTS idx_results_student ON results (student_id, snapshot_id);
+CREATE INDEX IF NOT EXISTS idx_results_snapshot ON results (snapshot_id);
+CREATE INDEX IF NOT EXISTS idx_results_name ON results (name, snapshot_id);
+CREATE INDEX IF NOT EXISTS idx_results_key ON results (snapshot_id, student_id, name);
+CREATE TABLE IF NOT EXISTS result_tags (
+    snapshot_id INTEGER NOT NULL,
+    student_id TEXT,
+    tag TEXT NOT NULL,
+    name TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_tags_tag ON result_tags (tag, student_id);
+CREATE INDEX IF NOT EXISTS idx_tags_student ON result_tags (student_id, snapshot_id);
+CREATE INDEX IF NOT EXISTS idx_tags_snapshot ON result_tags (snapshot_id, tag);
+CREATE INDEX IF NOT EXISTS idx_tags_name ON result_tags (name, snapshot_id);
+"""
+
+# 审计表列 -> 存档列；审计表中缺少的列存为 NULL
+COLUMNS = {
+    '学号': 'student_id', '姓名': 'name', '班级': 'class',
+    '进度': 'progress', '时长': 'duration', '成绩': 'score', '讨论': 'discussion',
+    '标签码': 'tag_code', '主标签': 'primary_tag', '学习群体': 'learner_group',
+    '综合得分': 'composite', '综合百分位': 'percentile', '综合分组': 'tier', '参与度': 'participation',
+}
+TEXT_COLUMNS = {'学号', '姓名', '班级', '主标签', '学习群体', '综合分组'}
+# 没有学号列时审计表填的占位值；与空白一样存为 NULL，历史查询改按姓名匹配
+MISSING_IDS = {'', '未知'}
+# 标签行对应的明细行：同一快照中学号与姓名都相同（学号为 NULL 时按姓名区分），可走 idx_results_key
+_SAME_STUDENT = 'r.student_id IS t.student_id AND r.name IS t.name'
+
+
+def _column(df, col):
+    """取一列为可直接写入 sqlite 的 Python 值列表（缺失值为 None）。"""
+    if col not in df.columns:
+        return [None] * len(df)
+    s = df[col]
+    if col == '标签码':
+        return s.to_numpy(dtype=np.int64).tolist()
+    if col in TEXT_COLUMNS:
+        values = s.to_numpy(dtype=object)
+        missing = pd.isna(values)
+        out = values.astype(str).astype(object)
+        if col == '学号':
+            missing |= pd.Series(out).str.strip().isin(MISSING_IDS).to_numpy()
+    else:
+        values = pd.to_numeric(s, errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        missing = np.isnan(values)
+        out = values.astype(object)
+    out[missing] = None
+    return out.tolist()
+
+
+def _student_filter(alias, student_id, name=None):
+    """按学号查某学生的 WHERE 条件与参数；给出 ``name`` 时同时匹配没有学号、姓名相同的记录。"""
+    if student_id is not None and not pd.isna(student_id):
+        student_id = str(student_id).strip()
+    if student_id is None or pd.isna(student_id) or student_id in MISSING_IDS:
+        return f'({alias}.student_id IS NULL AND {alias}.name = ?)', [str(name)]
+    if name is None or pd.isna(name):
+        return f'{alias}.student_id = ?', [student_id]
+    return f'({alias}.student_id = ? OR ({alias}.student_id IS NULL AND {alias}.name = ?))', [student_id, str(name)]
+
+
+class AuditStore:
+    """本地审计历史库。每次调用单独打开连接，可在 Streamlit 的多个会话线程中共用一个实例。"""
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.executescript(SCHEMA)
+
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout=30)
+        con.execute('PRAGMA synchronous=NORMAL')  # WAL 模式下仍保证一致性，提交时少一次 fsync
+        return con
+
+    def _query(self, sql, params=()):
+        with closing(self._connect()) as con:
+            return pd.read_sql_query(sql, con, params=params)
+
+    # ---------------------------------------------------------------- 写入
+    def find(self, course, term, source):
+        """同一课程、学期下同一份数据的快照 id；没有时返回 None。"""
+        with closing(self._connect()) as con:
+            row = con.execute('SELECT id FROM snapshots WHERE course = ? AND term = ? AND source = ?',
+                              (course, term, source)).fetchone()
+        return row[0] if row else None
+
+    def save(self, df, course, term, source, tag_bits, n_flagged, mode=None, params=None, replace=False, taken_at=None):
+        """保存一次审计结果，返回快照 id。
+
+        ``source`` 标识数据来源（如上传内容的哈希）：同一课程、学期下已存过时直接返回原快照，
+        ``replace`` 为真时用当前结果覆盖（例如调整权重后更新存档）。``tag_bits`` 为 标签 -> 位 的映射，
+        ``n_flagged`` 为预警人数（由调用方按看板的同一口径算好）。
+        """
+        old = self.find(course, term, source)
+        if old is not None and not replace:
+            return old
+        taken_at = (taken_at or datetime.datetime.now()).isoformat(timespec='seconds')
+        codes = df['标签码'].to_numpy(dtype=np.int64)
+        ids, names = _column(df, '学号'), _column(df, '姓名')
+        columns = [_column(df, col) for col in COLUMNS]
+        with closing(self._connect()) as con, con:
+            old = con.execute('SELECT id FROM snapshots WHERE course = ? AND term = ? AND source = ?',
+                              (course, term, source)).fetchone()
+            if old and not replace:
+                return old[0]
+            if old:
+                self._delete(con, old[0])
+            cur = con.execute(
+                'INSERT INTO snapshots (course, term, taken_at, source, mode, n_students, n_flagged, params) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (course, term, taken_at, source, mode, len(df), int(n_flagged),
+                 json.dumps(params, ensure_ascii=False, default=str) if params is not None else None))
+            sid = cur.lastrowid
+            con.executemany(f"INSERT INTO results (snapshot_id, {', '.join(COLUMNS.values())}) "
+                            f"VALUES ({', '.join('?' * (len(COLUMNS) + 1))})", zip([sid] * len(df), *columns))
+            for tag, bit in tag_bits.items():
+                hit = np.flatnonzero(codes & bit)
+                con.executemany('INSERT INTO result_tags (snapshot_id, student_id, tag, name) VALUES (?, ?, ?, ?)',
+                                ((sid, ids[i], tag, names[i]) for i in hit.tolist()))
+        return sid
+
+    @staticmethod
+    def _delete(con, snapshot_id):
+        for table, key in (('result_tags', 'snapshot_id'), ('results', 'snapshot_id'), ('snapshots', 'id')):
+            con.execute(f'DELETE FROM {table} WHERE {key} = ?', (snapshot_id,))
+
+    def delete(self, snapshot_id):
+        with closing(self._connect()) as con, con:
+            self._delete(con, snapshot_id)
+
+    # ---------------------------------------------------------------- 查询
+    def courses(self):
+        with closing(self._connect()) as con:
+            return [r[0] for r in con.execute('SELECT DISTINCT course FROM snapshots ORDER BY course')]
+
+    def snapshots(self, course=None):
+        """快照列表（按保存时间先后）。"""
+        where, params = ('WHERE course = ?', (course,)) if course else ('', ())
+        return self._query(
+            'SELECT id AS 快照, course AS 课程, term AS 学期, taken_at AS 保存时间, mode AS 平台, '
+            f'n_students AS 人数, n_flagged AS 预警人数 FROM snapshots {where} ORDER BY taken_at, id', params)
+
+    def student_history(self, student_id, name=None):
+        """某学生在各次快照中的记录与标签（按保存时间先后）；没有学号的存档按 ``name`` 匹配。"""
+        where, params = _student_filter('r', student_id, name)
+        return self._query(
+            'SELECT s.id AS 快照, s.course AS 课程, s.term AS 学期, s.taken_at AS 保存时间, r.class AS 班级, '
+            'r.name AS 姓名, r.primary_tag AS 主标签, '
+            '(SELECT group_concat(t.tag, \',\') FROM result_tags t '
+            f' WHERE t.snapshot_id = r.snapshot_id AND {_SAME_STUDENT}) AS 标签, '
+            'r.progress AS 进度, r.duration AS 时长, r.score AS 成绩, r.composite AS 综合得分, '
+            'r.percentile AS 综合百分位, r.participation AS 参与度 '
+            f'FROM results r JOIN snapshots s ON s.id = r.snapshot_id WHERE {where} ORDER BY s.taken_at, s.id', params)
+
+    def tagged(self, tag, course=None, term=None):
+        """被打上某标签的学生及所在快照。"""
+        sql = ('SELECT t.student_id AS 学号, r.name AS 姓名, s.course AS 课程, s.term AS 学期, r.class AS 班级, '
+               's.id AS 快照 FROM result_tags t JOIN snapshots s ON s.id = t.snapshot_id '
+               f'JOIN results r ON r.snapshot_id = t.snapshot_id AND {_SAME_STUDENT} '
+               'WHERE t.tag = ?')
+        params = [tag]
+        for col, value in (('s.course', course), ('s.term', term)):
+            if value:
+                sql += f' AND {col} = ?'
+                params.append(value)
+        return self._query(sql + ' ORDER BY s.taken_at, t.student_id, t.name', params)
+
+    def flag_history(self, student_id, name=None, exclude_source=None):
+        """某学生在以往快照中的标签，返回 [(学期, 课程, 标签), ...]；没有学号的存档按 ``name`` 匹配，
+        ``exclude_source`` 排除当前这份数据。"""
+        where, params = _student_filter('t', student_id, name)
+        sql = f'SELECT s.term, s.course, t.tag FROM result_tags t JOIN snapshots s ON s.id = t.snapshot_id WHERE {where}'
+        if exclude_source:
+            sql += ' AND s.source != ?'
+            params.append(exclude_source)
+        with closing(self._connect()) as con:
+            return con.execute(sql + ' ORDER BY s.taken_at, s.id', params).fetchall()
+
+    def results(self, snapshot_ids, columns=('student_id', 'name', 'progress', 'duration', 'score')):
+        """若干快照的明细，一次按快照索引读出；返回 ``snapshot_id`` 加所选存档列。"""
+        ids = [int(i) for i in snapshot_ids]
+        if not ids:
+            return pd.DataFrame(columns=['snapshot_id', *columns])
+        return self._query(f"SELECT snapshot_id, {', '.join(columns)} FROM results "
+                           f"WHERE snapshot_id IN ({', '.join('?' * len(ids))})", ids)
+
+    def course_trend(self, course):
+        """课程各快照的人数、预警率、主要指标均值与各标签人数（按保存时间先后）。"""
+        trend = self._query(
+            'SELECT s.id AS 快照, s.term AS 学期, s.taken_at AS 保存时间, s.n_students AS 人数, '
+            's.n_flagged AS 预警人数, ROUND(100.0 * s.n_flagged / MAX(s.n_students, 1), 1) AS "预警率(%)", '
+            'ROUND(AVG(r.progress), 1) AS 平均进度, ROUND(AVG(r.composite), 1) AS 平均综合得分, '
+            'ROUND(AVG(r.participation), 1) AS 平均参与度 '
+            'FROM snapshots s JOIN results r ON r.snapshot_id = s.id WHERE s.course = ? '
+            'GROUP BY s.id ORDER BY s.taken_at, s.id', (course,))
+        for col in ('平均进度', '平均综合得分', '平均参与度'):
+            trend[col] = pd.to_numeric(trend[col]).astype(float)  # 全为 NULL 时 read_sql 给出 object 列
+        tags = self._query(
+            'SELECT t.snapshot_id AS 快照, t.tag AS 标签, COUNT(*) AS 人数 FROM result_tags t '
+            'JOIN snapshots s ON s.id = t.snapshot_id WHERE s.course = ? GROUP BY t.snapshot_id, t.tag', (course,))
+        if tags.empty:
+            return trend
+        counts = tags.pivot(index='快照', columns='标签', values='人数').fillna(0).astype(int)
+        return trend.merge(counts, left_on='快照', right_index=True, how='left')
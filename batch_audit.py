@@ -0,0 +1,206 @@
+"""批量审计：不启动页面，直接对一批学习通/头歌导出文件做 加载 → 审计 → 评分。
+
+用法::
+
+    python batch_audit.py exports/ --mode LMS --out results/
+    python batch_audit.py "exports/*.xlsx" "more/*.csv" --format parquet --workers 8
+
+每个文件在进程池中独立处理（默认使用全部 CPU 核），输出：
+
+- ``<out>/<文件名>.xlsx|.parquet``：单班明细（与页面“原始数据表”导出一致）；
+- ``<out>/全部班级.xlsx|.parquet``：所有成功文件合并，带 ``班级`` 列；
+- ``<out>/耗时统计.csv``：每个文件的行数与加载/审计/评分耗时；
+- ``<out>/失败报告.csv``：解析或审计失败的文件与原因（没有失败时不生成）。
+
+指定 ``--store`` 时，合并结果另作为一个快照存入历史存档库（与页面共用，按课程/学期查询）。
+"""
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+logging.getLogger('streamlit').setLevel(logging.ERROR)
+
+from app import (DEFAULT_PART_WEIGHTS, DEFAULT_WEIGHTS, SCHEMA_PLANS_PATH, TAG_BITS, AuditCore, ParseCache,  # noqa: E402
+                 PlanRegistry, Scoring, TagCodec, UniversalLoader, class_labels, data_version, default_term,
+                 write_xlsx_streaming)
+from audit_store import AuditStore  # noqa: E402
+
+EXPORT_SUFFIXES = ('.xlsx', '.csv')
+
+
+def collect_files(inputs):
+    """展开目录与通配符，返回去重后的 xlsx/csv 路径列表（保持输入顺序）。"""
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = sorted(os.path.join(item, n) for n in os.listdir(item))
+        else:
+            matches = sorted(glob.glob(item)) or [item]
+        for path in matches:
+            name = os.path.basename(path)
+            # 跳过 Excel 打开时产生的 ~$ 锁文件
+            if name.lower().endswith(EXPORT_SUFFIXES) and not name.startswith('~$') and path not in files:
+                files.append(path)
+    return files
+
+
+def write_table(df, path, fmt):
+    if fmt == 'parquet':
+        # 混合类型的对象列（例如学号既有数字又有文本）统一转成字符串再写 Parquet
+        obj_cols = [c for c in df.columns if df[c].dtype == object]
+        df.astype({c: str for c in obj_cols}).to_parquet(path, index=False)
+    else:
+        write_xlsx_streaming([('审计结果', df)], path)
+
+
+def audit_file(path, label, opts):
+    """在子进程中处理单个文件，返回结果字典（失败时带 error，不抛异常）。"""
+    result = {'文件': path, '班级': label, '行数': 0, 'error': None, 'df': None, 'codes': None, 'key': None}
+    timings = {}
+    try:
+        t0 = time.perf_counter()
+        plans = PlanRegistry(opts['plans'])  # 与页面共用团队固定的表头模板
+        with open(path, 'rb') as fh:
+            raw_df, err = UniversalLoader.load_file(fh, plans=plans)
+            fh.seek(0)
+            result['key'] = ParseCache.make_key(fh.read())
+        timings['加载(s)'] = time.perf_counter() - t0
+        if err:
+            raise ValueError(err)
+
+        t0 = time.perf_counter()
+        audit_df, err = AuditCore(raw_df, plans=plans).execute_audit(
+            opts['mode'], detect_night=opts['detect_night'], night_window=opts['night_window'],
+            cluster_method=opts['cluster_method'], n_clusters=opts['n_clusters'])
+        timings['审计(s)'] = time.perf_counter() - t0
+        if err:
+            raise ValueError(err)
+        if audit_df is None or audit_df.empty:
+            raise ValueError('数据解析为空')
+
+        t0 = time.perf_counter()
+        Scoring.run(audit_df, opts['weights'], opts['part_weights'], opts['n_bins'], opts['low_part_thr'])
+        out_df = TagCodec.export_view(audit_df)
+        timings['评分(s)'] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        write_table(out_df, os.path.join(opts['out'], f"{result['班级']}.{opts['format']}"), opts['format'])
+        timings['写出(s)'] = time.perf_counter() - t0
+
+        result['行数'] = len(out_df)
+        result['df'] = out_df
+        result['codes'] = audit_df['标签码'].to_numpy()  # 存档时按位写入标签索引
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result.update(timings)
+    return result
+
+
+def parse_weights(text, keys):
+    values = [float(v) for v in text.split(',')]
+    if len(values) != len(keys):
+        raise argparse.ArgumentTypeError(f'需要 {len(keys)} 个以逗号分隔的权重')
+    return dict(zip(keys, values))
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description='批量审计学习通/头歌导出文件')
+    p.add_argument('inputs', nargs='+', help='导出文件所在目录或通配符（可多个）')
+    p.add_argument('--mode', choices=['LMS', 'HG'], default='LMS', help='平台：LMS=学习通，HG=头歌')
+    p.add_argument('--out', default='batch_results', help='输出目录')
+    p.add_argument('--format', choices=['xlsx', 'parquet'], default='xlsx')
+    p.add_argument('--workers', type=int, default=os.cpu_count(), help='进程数，默认全部 CPU 核')
+    p.add_argument('--weights', default=','.join(str(v) for v in DEFAULT_WEIGHTS.values()),
+                   help='综合得分权重：进度,成绩,时长,讨论')
+    p.add_argument('--part-weights', default=','.join(str(v) for v in DEFAULT_PART_WEIGHTS.values()),
+                   help='参与度权重：讨论,时长稳定性,完整率')
+    p.add_argument('--bins', type=int, default=4, help='综合分组层数')
+    p.add_argument('--low-part', type=float, default=40, help='低参与度阈值')
+    p.add_argument('--no-night', action='store_true', help='关闭深夜活跃检测')
+    p.add_argument('--night', default='0-5', help='深夜时间窗，如 0-5 或 23-4')
+    p.add_argument('--cluster', choices=['quadrant', 'kmeans'], default='quadrant', help='学习群体划分方式')
+    p.add_argument('--k', type=int, default=4, help='K-Means 聚类数')
+    p.add_argument('--plans', default=SCHEMA_PLANS_PATH, help='团队表头模板 JSON（页面中固定的列映射），默认与页面相同')
+    p.add_argument('--store', help='历史存档库路径（SQLite），指定后合并结果存为一个快照')
+    p.add_argument('--course', help='存档的课程名，默认取第一个输入的名称')
+    p.add_argument('--term', default=default_term(), help='存档的学期，默认按当前日期推断（如 2026秋）')
+    return p
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    files = collect_files(args.inputs)
+    if not files:
+        print('未找到 xlsx/csv 文件', file=sys.stderr)
+        return 2
+    os.makedirs(args.out, exist_ok=True)
+
+    night_start, night_end = (int(v) for v in args.night.split('-'))
+    opts = {
+        'mode': args.mode,
+        'detect_night': not args.no_night,
+        'night_window': (night_start, night_end),
+        'cluster_method': args.cluster,
+        'n_clusters': args.k,
+        'weights': parse_weights(args.weights, list(DEFAULT_WEIGHTS)),
+        'part_weights': parse_weights(args.part_weights, list(DEFAULT_PART_WEIGHTS)),
+        'n_bins': args.bins,
+        'low_part_thr': args.low_part,
+        'out': args.out,
+        'format': args.format,
+        'plans': args.plans,
+    }
+
+    t_start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(files)))) as pool:
+        futures = {pool.submit(audit_file, path, label, opts): path for path, label in zip(files, class_labels(files))}
+        for fut in as_completed(futures):
+            res = fut.result()
+            status = '❌ ' + res['error'] if res['error'] else f"✅ {res['行数']} 行"
+            print(f"[{len(results) + 1}/{len(files)}] {res['班级']}: {status}")
+            results.append(res)
+    # 按输入顺序输出，便于比对
+    order = {path: i for i, path in enumerate(files)}
+    results.sort(key=lambda r: order[r['文件']])
+
+    ok = [r for r in results if r['error'] is None]
+    if ok:
+        combined = pd.concat([r['df'].assign(班级=r['班级']) for r in ok], ignore_index=True)
+        write_table(combined, os.path.join(args.out, f'全部班级.{args.format}'), args.format)
+        if args.store:
+            course = args.course or os.path.splitext(os.path.basename(os.path.normpath(args.inputs[0])))[0]
+            params = {k: v for k, v in opts.items() if k not in ('out', 'format', 'plans')}
+            codes = np.concatenate([r['codes'] for r in ok])
+            snapshot = AuditStore(args.store).save(
+                combined.assign(标签码=codes), course, args.term, data_version(*[r['key'] for r in ok]),
+                TAG_BITS, int(TagCodec.at_risk(codes).sum()), args.mode, params)
+            print(f'已存档：{args.store} 快照 #{snapshot}（{args.term} · {course}）')
+
+    timing_cols = ['班级', '文件', '行数', '加载(s)', '审计(s)', '评分(s)', '写出(s)']
+    timing = pd.DataFrame([{k: r.get(k) for k in timing_cols} for r in results], columns=timing_cols)
+    timing.round(3).to_csv(os.path.join(args.out, '耗时统计.csv'), index=False, encoding='utf-8-sig')
+    failures = [{'班级': r['班级'], '文件': r['文件'], '原因': r['error']} for r in results if r['error']]
+    fail_path = os.path.join(args.out, '失败报告.csv')
+    if failures:
+        pd.DataFrame(failures).to_csv(fail_path, index=False, encoding='utf-8-sig')
+    elif os.path.exists(fail_path):
+        os.remove(fail_path)
+
+    elapsed = time.perf_counter() - t_start
+    print(f"\n共 {len(files)} 个文件：成功 {len(ok)}，失败 {len(failures)}，"
+          f"合计 {sum(r['行数'] for r in ok)} 行，用时 {elapsed:.1f}s")
+    if ok:
+        print(timing.drop(columns=['文件']).round(3).to_string(index=False))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""对比 UniversalLoader 的单遍流式读取与旧版双遍读取。
+
+用法::
+
+    python benchmarks/bench_loader.py --tall-rows 50000 --wide-cols 300 --repeat 3
+
+会在临时目录生成“宽表”（列多）与“高表”（行多）两个工作簿，表头前带几行说明文字，
+分别用两条路径解析并输出最短耗时。
+"""
+import argparse
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import xlsxwriter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.getLogger('streamlit').setLevel(logging.ERROR)
+
+from app import UniversalLoader  # noqa: E402
+
+
+def write_workbook(path, n_rows, n_chapters):
+    wb = xlsxwriter.Workbook(path, {'constant_memory': True})
+    ws = wb.add_worksheet('学生学习进度详情')
+    ws.write_row(0, 0, ['课程学情导出'])
+    ws.write_row(1, 0, ['导出时间：2024-06-01'])
+    header = ['姓名', '学号', '任务点完成进度', '观看时长', '综合成绩', '讨论数']
+    for c in range(1, n_chapters + 1):
+        header += [f'第{c}章状态', f'第{c}章得分', f'第{c}章时长']
+    ws.write_row(3, 0, header)
+    for i in range(n_rows):
+        row = [f'学生{i}', f'2023{i:06d}', f'{i % 101}%', f'{i % 3}小时{i % 60}分', i % 100, i % 7]
+        for c in range(n_chapters):
+            row += ['已完成' if (i + c) % 4 else '未完成', (i * 7 + c) % 100, f'{(i + c) % 50}分']
+        ws.write_row(4 + i, 0, row)
+    wb.close()
+
+
+class _Upload(io.BytesIO):
+    def __init__(self, path):
+        with open(path, 'rb') as fh:
+            super().__init__(fh.read())
+        self.name = os.path.basename(path)
+
+
+def best_of(fn, path, repeat):
+    best = float('inf')
+    shape = None
+    for _ in range(repeat):
+        upload = _Upload(path)
+        t0 = time.perf_counter()
+        df, err = fn(upload)
+        best = min(best, time.perf_counter() - t0)
+        if err:
+            raise RuntimeError(err)
+        shape = df.shape
+    return best, shape
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--tall-rows', type=int, default=50000)
+    ap.add_argument('--wide-rows', type=int, default=2000)
+    ap.add_argument('--wide-cols', type=int, default=300)
+    ap.add_argument('--repeat', type=int, default=3)
+    args = ap.parse_args(argv)
+
+    cases = {
+        'tall': (args.tall_rows, 4),
+        'wide': (args.wide_rows, max(1, (args.wide_cols - 6) // 3)),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'case':<6}{'shape':>16}{'two-pass(s)':>14}{'streaming(s)':>14}{'speedup':>9}")
+        for case, (n_rows, n_chapters) in cases.items():
+            path = os.path.join(tmp, f'{case}.xlsx')
+            write_workbook(path, n_rows, n_chapters)
+            t_old, shape = best_of(UniversalLoader._load_excel_two_pass, path, args.repeat)
+            t_new, _ = best_of(UniversalLoader._load_excel_streaming, path, args.repeat)
+            print(f"{case:<6}{str(shape):>16}{t_old:>14.3f}{t_new:>14.3f}{t_old / t_new:>8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
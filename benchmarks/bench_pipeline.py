@@ -0,0 +1,203 @@
+"""端到端基准：加载 → 审计 → 评分 → 各 Excel 导出，输出耗时、吞吐与内存峰值。
+
+用法::
+
+    python benchmarks/bench_pipeline.py --sizes 1000 10000 100000 --platform LMS HG --format xlsx csv
+    python benchmarks/bench_pipeline.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_pipeline.py --baseline benchmarks/baseline.json --tolerance 0.25
+
+输入文件由 synth_exports.py 生成并缓存在 benchmarks/data/。每个阶段取 ``--repeat`` 次中的最短耗时，
+内存峰值（tracemalloc）在单独一次运行中测量，不影响计时。``--baseline`` 与保存的结果逐项比较，
+任一阶段变慢超过容差时以退出码 1 结束，便于在 CI 或改动前后对比。
+"""
+import argparse
+import gc
+import io
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+import unicodedata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.getLogger('streamlit').setLevel(logging.ERROR)
+
+from app import (ChapterSchema, AuditCore, Scoring, TagCodec, UniversalLoader, chapter_workbook_sheets,  # noqa: E402
+                 excel_bytes, group_stats_sheets, group_summary, hour_activity, streaming_xlsx_bytes)
+from synth_exports import DEFAULT_DIR, PLATFORMS, ensure_export  # noqa: E402
+
+
+class _Upload(io.BytesIO):
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+
+
+def _export_group(ctx):
+    scored = ctx['scored']
+    return streaming_xlsx_bytes(group_stats_sheets(group_summary(scored), scored))
+
+
+def _export_risk(ctx):
+    scored = ctx['scored']
+    rows = scored['标签码'].to_numpy() != 0
+    return excel_bytes([('Sheet1', TagCodec.export_view(scored, rows=rows, drop=('证据链', '主标签')))])
+
+
+def _export_unfinished(ctx):
+    scored = ctx['scored']
+    unfinished_df = scored.loc[Scoring.unfinished_mask(scored), ['姓名', '学号', '进度', '时长']].sort_values('进度')
+    return excel_bytes([('Sheet1', unfinished_df)])
+
+
+def _export_hours(ctx):
+    pivot, _ = hour_activity(ctx['scored'])
+    return excel_bytes([('hour_pivot', pivot)], index=True) if pivot is not None else b''
+
+
+def _export_chapters(ctx):
+    schema = ChapterSchema(ctx['raw'])
+    return streaming_xlsx_bytes(chapter_workbook_sheets(schema, ctx['raw'], ctx['scored']))
+
+
+# 阶段名 -> (准备输入, 被计时的函数)；准备步骤不计入耗时（例如评分会原地加列，每次先复制审计结果）
+STAGES = {
+    'load': (lambda ctx: _Upload(ctx['bytes'], ctx['name']),
+             lambda ctx, upload: UniversalLoader.load_file(upload)[0]),
+    'audit': (lambda ctx: AuditCore(ctx['raw']),
+              lambda ctx, core: core.execute_audit(ctx['mode'])[0]),
+    'scoring': (lambda ctx: ctx['audit'].copy(),
+                lambda ctx, df: Scoring.run(df)),
+    'export:群体统计': (lambda ctx: None, lambda ctx, _: _export_group(ctx)),
+    'export:异常诊断表': (lambda ctx: None, lambda ctx, _: _export_risk(ctx)),
+    'export:未完结名单': (lambda ctx: None, lambda ctx, _: _export_unfinished(ctx)),
+    'export:时序矩阵': (lambda ctx: None, lambda ctx, _: _export_hours(ctx)),
+    'export:章节汇总': (lambda ctx: None, lambda ctx, _: _export_chapters(ctx)),
+}
+
+# 阶段产物写回上下文，供后续阶段使用
+PRODUCES = {'load': 'raw', 'audit': 'audit', 'scoring': 'scored'}
+
+
+def _ljust(text, width):
+    """按显示宽度左对齐（中文占两格）。"""
+    shown = sum(2 if unicodedata.east_asian_width(ch) in 'WF' else 1 for ch in text)
+    return text + ' ' * max(0, width - shown)
+
+
+def time_stage(ctx, stage, repeat):
+    prepare, fn = STAGES[stage]
+    best, out = float('inf'), None
+    for _ in range(repeat):
+        arg = prepare(ctx)
+        gc.collect()
+        t0 = time.perf_counter()
+        out = fn(ctx, arg)
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def peak_memory(ctx, stage):
+    """单独运行一次阶段，返回 tracemalloc 记录的峰值（MB）。"""
+    prepare, fn = STAGES[stage]
+    arg = prepare(ctx)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn(ctx, arg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024 ** 2
+
+
+def run_case(path, mode, repeat, memory):
+    with open(path, 'rb') as fh:
+        ctx = {'bytes': fh.read(), 'name': os.path.basename(path), 'mode': mode}
+    results = {}
+    for stage in STAGES:
+        seconds, out = time_stage(ctx, stage, repeat)
+        if stage in PRODUCES:
+            if out is None:
+                raise RuntimeError(f'{ctx["name"]}: {stage} 阶段没有产出')
+            ctx[PRODUCES[stage]] = out
+        results[stage] = {'seconds': seconds, 'peak_mb': peak_memory(ctx, stage) if memory else None}
+    rows = len(ctx['raw'])
+    for r in results.values():
+        r['rows'] = rows
+        r['rows_per_s'] = rows / r['seconds'] if r['seconds'] > 0 else None
+    # 评分后的审计结果每个学生占用的字节数（含字符串实际内容）
+    results['scoring']['bytes_per_row'] = int(ctx['scored'].memory_usage(deep=True).sum()) / max(rows, 1)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """返回 [(用例, 阶段, 当前耗时, 基线耗时, 比值)]，只列出变慢超过容差的项。"""
+    regressions = []
+    for case, stages in results.items():
+        for stage, r in stages.items():
+            base = baseline.get(case, {}).get(stage)
+            if base and base['seconds'] > 0:
+                ratio = r['seconds'] / base['seconds']
+                if ratio > 1 + tolerance:
+                    regressions.append((case, stage, r['seconds'], base['seconds'], ratio))
+    return regressions
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    ap.add_argument('--platform', nargs='+', choices=list(PLATFORMS), default=['LMS'])
+    ap.add_argument('--format', nargs='+', choices=['xlsx', 'csv'], default=['xlsx'])
+    ap.add_argument('--chapters', type=int, default=8)
+    ap.add_argument('--repeat', type=int, default=3)
+    ap.add_argument('--no-memory', dest='memory', action='store_false', help='跳过 tracemalloc 内存峰值测量')
+    ap.add_argument('--data', default=DEFAULT_DIR, help='合成文件目录')
+    ap.add_argument('--baseline', help='与此基线 JSON 比较')
+    ap.add_argument('--save-baseline', help='把本次结果写入基线 JSON（已有用例会被覆盖）')
+    ap.add_argument('--tolerance', type=float, default=0.2, help='允许的变慢比例，默认 0.2 即 20%%')
+    args = ap.parse_args(argv)
+
+    results = {}
+    print(f"{'case':<22}{'stage':<20}{'rows':>9}{'best(s)':>10}{'rows/s':>12}{'peak MB':>10}")
+    for platform in args.platform:
+        for n_rows in args.sizes:
+            for fmt in args.format:
+                case = f'{platform.lower()}_{n_rows}x{args.chapters}.{fmt}'
+                path = ensure_export(args.data, platform, n_rows, fmt, args.chapters)
+                results[case] = run_case(path, platform, args.repeat, args.memory)
+                for stage, r in results[case].items():
+                    peak = f"{r['peak_mb']:.1f}" if r['peak_mb'] is not None else '-'
+                    rate = f"{r['rows_per_s']:,.0f}" if r['rows_per_s'] else '-'
+                    print(f"{case:<22}{_ljust(stage, 20)}{r['rows']:>9}{r['seconds']:>10.3f}{rate:>12}{peak:>10}")
+                print(f"{case:<22}审计结果内存 {results[case]['scoring']['bytes_per_row']:.1f} B/学生")
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as fh:
+            baseline = json.load(fh)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            status = 1
+            print(f'\n⚠️ {len(regressions)} 项比基线慢 {args.tolerance:.0%} 以上：')
+            for case, stage, now, base, ratio in regressions:
+                print(f'  {case:<22}{_ljust(stage, 20)}{base:>9.3f}s -> {now:.3f}s ({ratio:.2f}x)')
+        else:
+            print(f'\n✅ 与基线 {args.baseline} 相比没有超过 {args.tolerance:.0%} 的退化')
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.save_baseline):
+            with open(args.save_baseline, encoding='utf-8') as fh:
+                baseline = json.load(fh)
+        baseline.update(results)
+        with open(args.save_baseline, 'w', encoding='utf-8') as fh:
+            json.dump(baseline, fh, ensure_ascii=False, indent=2)
+        print(f'基线已写入 {args.save_baseline}')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
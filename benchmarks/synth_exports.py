@@ -0,0 +1,175 @@
+"""生成学习通 / 头歌风格的合成导出文件，供基准测试与压测使用。
+
+用法::
+
+    python benchmarks/synth_exports.py --rows 1000 10000 100000 1000000 --platform LMS HG --format xlsx csv
+
+xlsx 与真实导出一样在表头前带几行说明文字；时长、进度混用多种写法（“1小时20分”、“01:20:00”、
+“3/5”、“0.4”…），并带章节列与最后活跃时间，便于覆盖解析、审计与章节统计的全部路径。
+同一参数生成的文件内容固定（按 seed），已存在时直接复用。
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+PLATFORMS = {
+    'LMS': {
+        'sheet': '学生学习进度详情',
+        'title': '学习通课程学情导出',
+        'columns': ['姓名', '学号', '任务点完成进度', '观看时长', '综合成绩', '讨论数', '最后学习时间'],
+        'chapter': ['第{c}章状态', '第{c}章得分', '第{c}章时长'],
+        'status': ['已完成', '未完成', '通过', '进行中'],
+        'csv_encoding': 'gb18030',
+    },
+    'HG': {
+        'sheet': '实训详情',
+        'title': '头歌实践教学平台 - 实训成绩导出',
+        'columns': ['学生姓名', '学号', '完成度', '总耗时', '最终成绩', '互动次数', '提交时间'],
+        'chapter': ['关卡{c}状态', '关卡{c}得分', '关卡{c}耗时'],
+        'status': ['通过', '未通过', '已完成', '未提交'],
+        'csv_encoding': 'utf-8-sig',
+    },
+}
+
+
+def _pick(rng, n, options):
+    return np.asarray(options, dtype=object)[rng.integers(0, len(options), n)]
+
+
+def _cat(*parts):
+    """逐元素拼接数组与字符串片段（np.char.add 的多参数版本）。"""
+    out = np.asarray(parts[0]).astype(str)
+    for part in parts[1:]:
+        out = np.char.add(out, np.asarray(part).astype(str) if not isinstance(part, str) else part)
+    return out
+
+
+def _mixed(rng, variants):
+    """每行随机选用 variants 中的一种写法（各写法为等长字符串数组）。"""
+    choice = rng.integers(0, len(variants), len(variants[0]))
+    return np.choose(choice, [v.astype(object) for v in variants])
+
+
+def _durations(rng, minutes):
+    """把分钟数随机写成几种导出里常见的格式。"""
+    m = np.round(minutes).astype(int)
+    h, mm = m // 60, m % 60
+    out = _mixed(rng, [
+        _cat(h, '小时', mm, '分'),
+        _cat(m, '分钟'),
+        _cat(np.char.zfill(h.astype(str), 2), ':', np.char.zfill(mm.astype(str), 2), ':00'),
+        _cat(m),
+        _cat(m, '分', rng.integers(0, 60, len(m)), '秒'),
+        _cat(h, '时', mm, '分'),
+    ])
+    out[rng.random(len(m)) < 0.02] = '--'
+    return out
+
+
+def _progress(rng, pct):
+    """进度写成 “40%”、“0.4”、“3/5”、“40” 等不同形式。"""
+    p = np.round(pct).astype(int)
+    return _mixed(rng, [
+        _cat(p, '%'),
+        np.char.mod('%.2f', p / 100),
+        _cat(np.round(p / 20).astype(int), '/5'),
+        _cat(p),
+    ])
+
+
+def make_frame(platform, n_rows, n_chapters=8, seed=0):
+    """生成一张合成导出表（所有取值为导出文件里的原始文本/数值）。"""
+    spec = PLATFORMS[platform]
+    rng = np.random.default_rng(seed)
+    idx = np.arange(n_rows)
+    # 一部分学生“秒刷”（进度高、时长极短），一部分未开始，其余正常
+    kind = rng.choice(3, n_rows, p=[0.08, 0.07, 0.85])
+    pct = np.where(kind == 1, 0, np.where(kind == 0, rng.uniform(90, 100, n_rows), rng.uniform(10, 100, n_rows)))
+    minutes = np.where(kind == 0, rng.uniform(0, 4, n_rows), rng.gamma(2.0, 40.0, n_rows))
+    minutes[kind == 1] = 0
+    score = np.clip(rng.normal(72, 15, n_rows), 0, 100).round(1)
+    active = (pd.Timestamp('2024-03-01') + pd.to_timedelta(rng.integers(0, 120 * 24 * 60, n_rows), unit='min'))
+
+    name_col, id_col, prog_col, time_col, score_col, discuss_col, active_col = spec['columns']
+    data = {
+        name_col: np.char.add('学生', idx.astype(str)).astype(object),
+        id_col: (2023000000 + idx).astype(str).astype(object),
+        prog_col: _progress(rng, pct),
+        time_col: _durations(rng, minutes),
+        score_col: np.where(rng.random(n_rows) < 0.03, None, score).astype(object),
+        discuss_col: rng.poisson(2, n_rows),
+        active_col: active.strftime('%Y-%m-%d %H:%M:%S').to_numpy(dtype=object),
+    }
+    status_col, ch_score_col, ch_time_col = spec['chapter']
+    for c in range(1, n_chapters + 1):
+        reached = pct / 100 * n_chapters >= c - rng.random(n_rows)
+        done, not_done = spec['status'][0::2], spec['status'][1::2] + [None]
+        data[status_col.format(c=c)] = np.where(reached, _pick(rng, n_rows, done), _pick(rng, n_rows, not_done))
+        data[ch_score_col.format(c=c)] = np.where(reached, np.clip(rng.normal(75, 18, n_rows), 0, 100).round(), np.nan)
+        data[ch_time_col.format(c=c)] = np.where(reached, _durations(rng, rng.gamma(2.0, 6.0, n_rows)), None)
+    return pd.DataFrame(data)
+
+
+def write_export(df, platform, path):
+    """按平台风格写出：xlsx 带说明行与空行后才是表头；csv 直接写表头。"""
+    spec = PLATFORMS[platform]
+    if path.endswith('.csv'):
+        df.to_csv(path, index=False, encoding=spec['csv_encoding'])
+        return path
+    wb = xlsxwriter.Workbook(path, {'constant_memory': True, 'strings_to_numbers': False, 'strings_to_urls': False})
+    ws = wb.add_worksheet(spec['sheet'])
+    ws.write_row(0, 0, [spec['title']])
+    ws.write_row(1, 0, ['导出时间：2024-07-01 09:00', '说明：时长与进度为平台原始格式'])
+    ws.write_row(3, 0, list(df.columns))
+    cols = [df[c].tolist() for c in df.columns]
+    for r, row in enumerate(zip(*cols), start=4):
+        ws.write_row(r, 0, [None if (isinstance(v, float) and np.isnan(v)) else v for v in row])
+    wb.close()
+    return path
+
+
+def export_path(out_dir, platform, n_rows, fmt, n_chapters=8):
+    return os.path.join(out_dir, f"{platform.lower()}_{n_rows}x{n_chapters}.{fmt}")
+
+
+def ensure_export(out_dir, platform, n_rows, fmt, n_chapters=8, seed=0):
+    """返回合成文件路径；文件不存在时生成。"""
+    path = export_path(out_dir, platform, n_rows, fmt, n_chapters)
+    if not os.path.exists(path):
+        os.makedirs(out_dir, exist_ok=True)
+        stem, ext = os.path.splitext(path)
+        # 先写临时文件再改名，中途中断不会留下半个文件被下次复用
+        tmp = write_export(make_frame(platform, n_rows, n_chapters, seed), platform, f"{stem}.part{ext}")
+        os.replace(tmp, path)
+    return path
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    ap.add_argument('--platform', nargs='+', choices=list(PLATFORMS), default=list(PLATFORMS))
+    ap.add_argument('--format', nargs='+', choices=['xlsx', 'csv'], default=['xlsx', 'csv'])
+    ap.add_argument('--chapters', type=int, default=8)
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--out', default=DEFAULT_DIR)
+    args = ap.parse_args(argv)
+
+    for platform in args.platform:
+        for n_rows in args.rows:
+            for fmt in args.format:
+                t0 = time.perf_counter()
+                path = ensure_export(args.out, platform, n_rows, fmt, args.chapters, args.seed)
+                size = os.path.getsize(path) / 1024 ** 2
+                print(f"{path}  {size:8.1f} MB  {time.perf_counter() - t0:6.1f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+"""后台任务：耗时的导出与分析交给线程池执行，页面在任务运行期间照常交互。
+
+``JobRunner.submit(owner, label, fn)`` 返回任务 id，``fn(job)`` 在线程池中运行并通过
+``job.progress(完成比例, 说明)`` 回报进度。取消是协作式的：``progress`` 与 ``checkpoint`` 发现取消请求时抛出
+``JobCancelled``，任务在下一个检查点停止；还在排队的任务直接从线程池撤下。结果或异常保存在 Job 上，
+由页面轮询展示。用线程而不是进程：任务直接读取会话中的审计结果，不必把整表序列化到子进程。
+"""
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+PENDING, RUNNING, DONE, FAILED, CANCELLED = '排队中', '运行中', '已完成', '失败', '已取消'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    """任务在进度回报点发现取消请求时抛出。"""
+
+
+class Job:
+    def __init__(self, job_id, owner, label, key=None, info=None):
+        self.id = job_id
+        self.owner = owner
+        self.label = label
+        self.key = key
+        self.info = info or {}  # 调用方附带的信息，例如下载文件名
+        self.status = PENDING
+        self.fraction = 0.0
+        self.message = ''
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = self.finished_at = None
+        self.future = None
+        self._cancel = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def cancel_requested(self):
+        return self._cancel.is_set()
+
+    def progress(self, fraction, message=None):
+        """回报进度（0-1）；已请求取消时抛出 JobCancelled。"""
+        if self._cancel.is_set():
+            raise JobCancelled()
+        self.fraction = min(max(float(fraction), 0.0), 1.0)
+        if message is not None:
+            self.message = message
+
+    def checkpoint(self):
+        """只检查取消请求、不更新进度，供长循环内部调用；已请求取消时抛出 JobCancelled。"""
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def track(self, items, total, describe=str):
+        """逐项产出 ``items`` 并按 已完成项数/total 回报进度，``describe(项)`` 作为进度说明。"""
+        for i, item in enumerate(items):
+            self.progress(i / max(total, 1), describe(item))
+            yield item
+        self.progress(1.0)
+
+    def cancel(self):
+        self._cancel.set()
+        if self.future is not None and self.future.cancel():
+            self.status = CANCELLED  # 尚未开始，直接撤下
+            self.finished_at = time.time()
+
+
+class JobRunner:
+    """各会话共用的后台任务池；任务按 owner（会话）归属，每个 owner 只保留最近 ``keep`` 个任务。"""
+
+    def __init__(self, max_workers=2, keep=10):
+        self.keep = keep
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='audit-job')
+        self._jobs = OrderedDict()  # id -> Job，按提交先后
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+
+    def submit(self, owner, label, fn, key=None, **info):
+        """提交任务并返回 id；同一 owner 下同一 ``key`` 的任务未结束时直接返回该任务，不重复提交。"""
+        with self._lock:
+            if key is not None:
+                running = self.find(owner, key)
+                if running is not None and not running.finished:
+                    return running.id
+            job = Job(next(self._ids), owner, label, key, info)
+            self._jobs[job.id] = job
+            self._prune(owner)
+        job.future = self._pool.submit(self._run, job, fn)
+        return job.id
+
+    @staticmethod
+    def _run(job, fn):
+        if job.cancel_requested:
+            job.status, job.finished_at = CANCELLED, time.time()
+            return
+        job.status, job.started_at = RUNNING, time.time()
+        try:
+            job.result = fn(job)
+            job.fraction, job.status = 1.0, DONE
+        except JobCancelled:
+            job.status = CANCELLED
+        except Exception as e:  # 任务失败只记录在任务上，不影响页面与其他任务
+            job.error, job.status = f'{type(e).__name__}: {e}', FAILED
+        finally:
+            job.finished_at = time.time()
+
+    def _prune(self, owner):
+        mine = [j for j in self._jobs.values() if j.owner == owner]
+        for job in mine[:max(0, len(mine) - self.keep)]:
+            if job.finished:
+                del self._jobs[job.id]
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def find(self, owner, key):
+        """owner 名下最近一个键为 ``key`` 的任务。"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in reversed(jobs):
+            if job.owner == owner and job.key == key:
+                return job
+        return None
+
+    def jobs(self, owner):
+        """owner 的任务，最新的在前。"""
+        with self._lock:
+            return [j for j in reversed(self._jobs.values()) if j.owner == owner]
+
+    def cancel(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is not None and not job.finished:
+            job.cancel()
+
+    def clear(self, owner):
+        """移除 owner 名下已结束的任务。"""
+        with self._lock:
+            for job in self.jobs(owner):
+                if job.finished:
+                    del self._jobs[job.id]
@@ -0,0 +1,121 @@
+"""学习通 / 头歌导出中文本字段的共享解析器。
+
+真实导出里同一列的取值高度重复（例如成千上万个 "1小时20分"、"40%"），
+因此所有解析都先对整列做 factorize，只对去重后的值跑一次预编译正则，
+再按编码把结果广播回原列。主表的 时长/进度 与章节明细的时长列共用这里的实现。
+"""
+import re
+
+import numpy as np
+import pandas as pd
+
+# 视为空值的占位符
+_BLANKS = {'', '--', '-', 'nan', 'None', 'NaN'}
+
+_NUM = r'(\d+(?:\.\d+)?)'
+_RE_DURATION_NUMS = re.compile(r'(\d+\.?\d*)')
+_RE_FRACTION = re.compile(r'^' + _NUM + r'\s*/\s*' + _NUM + r'$')
+
+
+def map_unique(series, fn, na_value=np.nan):
+    """对 series 的去重值调用 fn（返回 float），再按 factorize 编码广播回整列。"""
+    series = pd.Series(series)
+    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+    parsed = np.array([fn(u) for u in uniques], dtype=float)
+    out = np.full(len(series), na_value, dtype=float)
+    hit = codes >= 0
+    out[hit] = parsed[codes[hit]]
+    return pd.Series(out, index=series.index)
+
+
+def _is_blank(val):
+    return val is None or (isinstance(val, float) and np.isnan(val)) or str(val).strip() in _BLANKS
+
+
+def duration_minutes(val):
+    """把单个时长描述解析为分钟数，无法识别时返回 NaN。
+
+    口径与原主表解析一致："1小时20分" 按 时/分 取前两个数，"2时" 按小时计，
+    其余写法（"45分钟"、"12.5"、"46分4秒"）取第一个数作为分钟。
+    """
+    if _is_blank(val):
+        return np.nan
+    if isinstance(val, (int, float, np.integer, np.floating)):
+        return float(val)
+    s = str(val)
+    nums = _RE_DURATION_NUMS.findall(s)
+    if not nums:
+        return np.nan
+    if '分钟' in s:
+        return float(nums[0])
+    if '时' in s and '分' in s and len(nums) > 1:
+        return float(nums[0]) * 60 + float(nums[1])
+    if '时' in s:
+        return float(nums[0]) * 60
+    return float(nums[0])
+
+
+def progress_percent(val):
+    """把单个进度值解析为 0-100 的百分数。
+
+    支持 '40%'、'0.4'、'40'、'3/5'、'40/40' 等写法；无法识别时返回 0。
+    """
+    if _is_blank(val):
+        return 0.0
+    s = str(val).strip()
+    # fraction like 3/5 or 10/10
+    m = _RE_FRACTION.match(s)
+    if m:
+        den = float(m.group(2))
+        return 100.0 * (float(m.group(1)) / den) if den != 0 else 0.0
+    # percentage
+    if '%' in s:
+        try:
+            return float(s.replace('%', '').strip())
+        except ValueError:
+            pass
+    # plain number
+    try:
+        v = float(s)
+    except ValueError:
+        return 0.0
+    # if in 0..1 treat as fraction; if >1 and <=1000 assume percent already
+    if 0.0 <= v <= 1.0:
+        return v * 100.0
+    if 1.0 < v <= 1000.0:
+        return v
+    return 0.0
+
+
+def number(val):
+    """宽松数值解析：去掉单位等非数字字符后取值（如 "85分" -> 85），失败返回 NaN。"""
+    if _is_blank(val):
+        return np.nan
+    if isinstance(val, (int, float, np.integer, np.floating)):
+        return float(val)
+    s = re.sub(r'[^0-9.]+', '', str(val))
+    try:
+        return float(s)
+    except ValueError:
+        return np.nan
+
+
+def parse_duration(series):
+    """整列时长（分钟），无法解析的为 NaN；数值列直接返回。"""
+    series = pd.Series(series)
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype(float)
+    return map_unique(series, duration_minutes)
+
+
+def parse_progress(series):
+    """整列进度（0-100）。"""
+    return map_unique(series, progress_percent, na_value=0.0)
+
+
+def parse_number(series):
+    """整列宽松数值。"""
+    series = pd.Series(series)
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype(float)
+    return map_unique(series, number)
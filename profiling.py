@@ -0,0 +1,187 @@
+"""分阶段计时：记录每个阶段的耗时、行数与 tracemalloc 内存峰值，可导出 JSON trace 与 cProfile。
+
+业务代码只写 ``with stage('规则评估') as rec: ...``（整个函数计时用 ``@staged(...)``）；没有激活的 StageProfiler 时这是空操作，
+因此批处理脚本与基准直接调用时没有额外开销。当前激活的记录器保存在 ContextVar 中，
+交给线程池或延迟执行的回调（例如导出按钮）时用 ``bind`` 带上。
+"""
+import contextvars
+import cProfile
+import datetime
+import functools
+import io
+import json
+import marshal
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+_active = contextvars.ContextVar('stage_profiler', default=None)
+# tracemalloc 是进程级的，多个会话同时记录时按引用计数启停
+_trace_lock = threading.Lock()
+_trace_users = 0
+
+MB = 1024 ** 2
+
+
+def _start_tracing():
+    global _trace_users
+    with _trace_lock:
+        if _trace_users == 0 and tracemalloc.is_tracing():
+            return False  # 外部（例如基准脚本）已在记录，不接管启停
+        if _trace_users == 0:
+            tracemalloc.start()
+        _trace_users += 1
+        return True
+
+
+def _stop_tracing():
+    global _trace_users
+    with _trace_lock:
+        _trace_users -= 1
+        if _trace_users == 0:
+            tracemalloc.stop()
+
+
+class StageProfiler:
+    """一次运行的阶段记录。
+
+    ``trace_memory`` 为真时每个阶段记录“相对阶段开始时的内存增量峰值”；嵌套阶段的峰值会计入外层。
+    tracemalloc 为进程级统计，线程池中并发的阶段之间会互相影响，峰值只作参考。
+    """
+
+    def __init__(self, trace_memory=False, cprofile=False):
+        self.trace_memory = trace_memory
+        self.started_at = datetime.datetime.now()
+        self.records = []
+        self.wall = None
+        self.cprofile_error = None
+        self._profile = cProfile.Profile() if cprofile else None
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._tracing = False
+
+    @property
+    def label(self):
+        wall = f'{self.wall:.2f}s' if self.wall is not None else '进行中'
+        return f"{self.started_at:%H:%M:%S} · {wall} · {len(self.records)} 个阶段"
+
+    @contextmanager
+    def activate(self):
+        """在此上下文内，stage() 记录到本实例；可选地开启 tracemalloc 与 cProfile。"""
+        token = _active.set(self)
+        self._tracing = self.trace_memory and _start_tracing()
+        if self._profile is not None:
+            try:
+                self._profile.enable()
+            except ValueError as e:
+                # 同一进程里已有别的 profiler（例如另一会话的 cProfile）时放弃本次采样
+                self.cprofile_error, self._profile = str(e), None
+        try:
+            yield self
+        finally:
+            if self._profile is not None:
+                self._profile.disable()
+            if self._tracing:
+                _stop_tracing()
+                self._tracing = False
+            _active.reset(token)
+            self.wall = time.perf_counter() - self._t0
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """记录一个阶段；yield 出的记录字典可在阶段内补写 ``行数``。"""
+        stack = self._local.__dict__.setdefault('stack', [])
+        rec = {'阶段': name, '耗时(s)': None, '行数': rows, '内存峰值(MB)': None, '层级': len(stack),
+               '线程': threading.current_thread().name, '开始(s)': time.perf_counter() - self._t0}
+        # frame = [阶段开始时的内存, 目前见到的峰值]
+        frame = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            for outer in stack:
+                if outer is not None:
+                    outer[1] = max(outer[1], peak)
+            tracemalloc.reset_peak()
+            frame = [current, current]
+        stack.append(frame)
+        t0 = time.perf_counter()
+        try:
+            yield rec
+        finally:
+            rec['耗时(s)'] = time.perf_counter() - t0
+            stack.pop()
+            if frame is not None and tracemalloc.is_tracing():
+                peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+                rec['内存峰值(MB)'] = max(0, peak - frame[0]) / MB
+                for outer in stack:
+                    if outer is not None:
+                        outer[1] = max(outer[1], peak)
+            with self._lock:
+                self.records.append(rec)
+
+    def table(self):
+        """按开始时间排序的记录列表（外层阶段在前）。"""
+        with self._lock:
+            return sorted(self.records, key=lambda r: (r['开始(s)'], r['层级']))
+
+    def trace_json(self):
+        """Chrome Trace Event 格式，可拖进 chrome://tracing 或 Perfetto 查看时间线。"""
+        events = [{
+            'name': r['阶段'], 'ph': 'X', 'pid': 1, 'tid': r['线程'],
+            'ts': round(r['开始(s)'] * 1e6), 'dur': round(r['耗时(s)'] * 1e6),
+            'args': {'rows': r['行数'], 'peak_mb': r['内存峰值(MB)']},
+        } for r in self.table()]
+        meta = {'started_at': self.started_at.isoformat(timespec='seconds'), 'wall_s': self.wall,
+                'trace_memory': self.trace_memory}
+        return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms', 'metadata': meta},
+                          ensure_ascii=False, indent=1)
+
+    @property
+    def has_cprofile(self):
+        return self._profile is not None
+
+    def pstats_text(self, limit=30, sort='cumulative'):
+        out = io.StringIO()
+        pstats.Stats(self._profile, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def pstats_bytes(self):
+        """与 ``Stats.dump_stats`` 相同的 .prof 内容，可用 snakeviz / pstats 打开。"""
+        self._profile.create_stats()
+        return marshal.dumps(self._profile.stats)
+
+
+def active():
+    return _active.get()
+
+
+def activate(profiler):
+    """profiler 为 None 时返回空上下文。"""
+    return profiler.activate() if profiler is not None else nullcontext()
+
+
+def stage(name, rows=None):
+    """在当前激活的 StageProfiler 上记录阶段；未激活时为空操作（仍 yield 一个可写的记录字典）。"""
+    profiler = _active.get()
+    if profiler is None:
+        return nullcontext({'阶段': name, '行数': rows})
+    return profiler.stage(name, rows)
+
+
+def staged(name, rows=None):
+    """装饰器形式的 ``stage``：整个函数记为一个阶段；``rows`` 可为以函数参数求行数的可调用对象。"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name, rows(*args, **kwargs) if callable(rows) else rows):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def bind(fn):
+    """绑定当前上下文（含激活的 StageProfiler），供线程池或延迟回调中执行；每次调用使用独立副本。"""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.copy().run(fn, *args, **kwargs)